@@ -12,15 +12,13 @@ sys.path.append( Path(__file__).resolve().parent.parent.as_posix() ) #repo path
 sys.path.append( Path(__file__).resolve().parent.as_posix() ) #file path
 from params import *
 # original import
-import subprocess as sp
 from pathlib import Path
+import fed
 
 ITER_MAX = 10
-counter = 0
-print(ENTRY_FILE)
 
-while counter < ITER_MAX:
-    print('===================== %d ====================='%counter)
-    sp.run([ENTRY_FILE, str(counter)])
-    counter += 1
-    pass
+if __name__ == '__main__':
+    print(ENTRY_FILE)
+    # all the rounds run in one process, the clients stay resident between them
+    sys.argv = [ENTRY_FILE, '--rounds', str(ITER_MAX)] + sys.argv[1:]
+    fed.main()
@@ -2,23 +2,99 @@
 # -*- coding: utf-8 -*-
 # Python version: 3.6
 
-import copy
+import logging
 import torch
-from torch import nn
-
-
-def average_weights(w):
-    counter = 0
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            try:
-                w_avg[k] += w[i][k]
-            except Exception as e:
-                w_avg[k] = 2*w[0][k]
-                counter += 1
-                pass
-            
-        w_avg[k] = torch.div(w_avg[k], len(w))
-
-    return w_avg
+
+
+class StreamingAverager(object):
+    """
+    weighted average of client state dicts added one at a time, the float tensors are accumulated in fp64 in place so
+    that only one model is held whatever the number of clients
+    the non float tensors (e.g. num_batches_tracked of the BatchNorm) are not averaged, the value of the first client
+    is kept
+    """
+    def __init__(self, strict=False, logger=None):
+        """
+        :param strict: raise on a missing key or a shape mismatch, otherwise the tensor of this client is skipped and
+                       the mismatch is logged and kept in self.mismatches
+        """
+        self.strict = strict
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.sum_state = None
+        self.key_weights = {}
+        self.dtypes = {}
+        self.num_clients = 0
+        self.mismatches = []
+
+    def add(self, state_dict, weight=1.0):
+        """
+        :param state_dict: model_state of a client
+        :param weight: e.g. the number of training samples of the client
+        """
+        assert weight > 0, 'the weight of a client must be positive'
+        if self.sum_state is None:
+            self.sum_state = {}
+            for key, val in state_dict.items():
+                self.dtypes[key] = val.dtype
+                if val.is_floating_point():
+                    self.sum_state[key] = val.detach().to(device='cpu', dtype=torch.float64) * weight
+                    self.key_weights[key] = weight
+                else:
+                    self.sum_state[key] = val.detach().cpu().clone()
+        else:
+            for key in self.sum_state:
+                if key not in state_dict:
+                    self._mismatch(key, 'missing')
+            for key, val in state_dict.items():
+                if key not in self.sum_state:
+                    self._mismatch(key, 'unexpected')
+                elif val.shape != self.sum_state[key].shape:
+                    self._mismatch(key, 'shape %s instead of %s' % (tuple(val.shape), tuple(self.sum_state[key].shape)))
+                elif key in self.key_weights:
+                    self.sum_state[key].add_(val.detach().to(device='cpu', dtype=torch.float64), alpha=weight)
+                    self.key_weights[key] += weight
+        self.num_clients += 1
+
+    def _mismatch(self, key, reason):
+        msg = 'client %d: %s %s' % (self.num_clients, key, reason)
+        if self.strict:
+            raise ValueError('state dicts do not match, %s' % msg)
+        self.logger.warning('average_weights skips %s' % msg)
+        self.mismatches.append(msg)
+
+    def average(self):
+        """
+        :return: the averaged state dict with the dtypes of the first client, the accumulators are released
+        """
+        assert self.sum_state is not None, 'no client state to average'
+        avg_state = {}
+        for key in list(self.sum_state.keys()):
+            val = self.sum_state.pop(key)
+            if key in self.key_weights:
+                val = val.div_(self.key_weights[key]).to(self.dtypes[key])
+            avg_state[key] = val
+        self.sum_state = None
+        return avg_state
+
+
+def average_weights(w, weights=None, strict=False):
+    """
+    :param w: list or iterable of state dicts, a generator keeps a single one loaded at a time
+    :param weights: weight of each state dict, e.g. the numbers of training samples, None for the plain mean
+    :return: the averaged state dict
+    """
+    averager = StreamingAverager(strict=strict)
+    for k, state_dict in enumerate(w):
+        averager.add(state_dict, weight=1.0 if weights is None else weights[k])
+    return averager.average()
+
+
+def average_checkpoints(filenames, weights=None, strict=False):
+    """
+    :param filenames: checkpoints with a model_state, loaded one after the other
+    :return: the averaged model_state
+    """
+    def load_model_states():
+        for filename in filenames:
+            yield torch.load(filename, map_location=torch.device('cpu'))['model_state']
+    return average_weights(load_model_states(), weights=weights, strict=strict)
@@ -6,19 +6,18 @@ sys.path.append( Path(__file__).resolve().parent.parent.as_posix() ) #repo path
 sys.path.append( Path(__file__).resolve().parent.as_posix() ) #file path
 from params import *
 # original import
-import os
-import subprocess as sp
-import torch
-import pdb
-import copy
-import time
-from sys import argv
-from averaging import average_weights
-import numpy as np
-
-ITER = int(argv[1])
-train_file = Path(__file__, '..', 'tools', 'train.py').resolve().as_posix()
-cfg_folder = Path(__file__, '..', 'tools', 'cfgs')
+import argparse
+import datetime
+from pcdet.utils import common_utils
+from fed_engine import FedEngine, GlobalModelEvaluator, OPTIMIZER_STATE_POLICIES
+from pcdet.utils.checkpoint_store import CheckpointStore
+from fed_compression import COMPRESSION_MODES
+from fed_server import AsyncAggregationServer, TRANSPORTS, run_async
+from fed_sim import find_vehicle_dirs
+from fed_distill import DistillStage
+from fed_eval import FedEvalService
+
+cfg_folder = Path(__file__, '..', 'tools', 'cfgs').resolve()
 
 #------------------------------ Attention ------------------------------#
 #       The following codes demonstrate federated learning              #
@@ -26,58 +25,161 @@ cfg_folder = Path(__file__, '..', 'tools', 'cfgs')
 #       https://cloud.189.cn/t/jQJvuimquaEj                             #
 #-----------------------------------------------------------------------#
 
-model713_file = MODEL_FOLDER / 'model713.pth'
-model714_file = MODEL_FOLDER / 'model714.pth'
-try:
-    model713_file.unlink()
-    model714_file.unlink()
-except Exception as e: 
-    pass
-
-with workSpace(TRAIN_ROOT) as wrk: #chdir to 'tools' folder
-    if ITER == 0: # no pretrain model
-        sp.run(['bash', '-c', 'python3 train.py --cfg_file cfgs/tesla713.yaml --batch_size 1 --workers 0 --epochs 1 --root_dir %s'%ROOT_PATH])
-        sp.run(['bash', '-c', 'python3 train.py --cfg_file cfgs/tesla714.yaml --batch_size 1 --workers 0 --epochs 1 --root_dir %s'%ROOT_PATH])
-
-    if ITER >= 1: # train from last global model
-        sp.run(['bash', '-c', 'python3 train.py --cfg_file cfgs/tesla713.yaml --batch_size 1 --workers 0 --epochs 1 --pretrained_model %s --root_dir %s'%(model713_file, ROOT_PATH)])
-        sp.run(['bash', '-c', 'python3 train.py --cfg_file cfgs/tesla714.yaml --batch_size 1 --workers 0 --epochs 1 --pretrained_model %s --root_dir %s'%(model714_file, ROOT_PATH)])
-    pass
-
-  
-# save model to dictionary
-model_dict0 = torch.load( str(MODEL_FOLDER/'checkpoint_epoch_0.pth') ); params0 = model_dict0['model_state']
-model_dict1 = torch.load( str(MODEL_FOLDER/'checkpoint_epoch_1.pth') ); params1 = model_dict1['model_state']
-
-# append parameters into a list
-w_locals = []
-w_locals.append(params0)
-w_locals.append(params1)
-
-# compute perfect global model
-params_avg = average_weights(w_locals)
-
-# remove the model files
-del(params0)
-del(params1)
-(MODEL_FOLDER/'checkpoint_epoch_0.pth').unlink()
-(MODEL_FOLDER/'checkpoint_epoch_1.pth').unlink()
-
-# save global model at each vehicle
-torch.save({'model_state':params_avg,
-            'optimizer_state': model_dict0['optimizer_state'],
-            'accumulated_iter': model_dict0['accumulated_iter']
-            },
-            str(model713_file)
-        )
-
-torch.save({'model_state':params_avg,
-            'optimizer_state': model_dict1['optimizer_state'],
-            'accumulated_iter': model_dict1['accumulated_iter']
-            },
-            str(model714_file)
-        )
-
-# finish one FL iteration
-print('---------------------------------FL Iteration %r is completed.'%argv[1])
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='federated training rounds of the vehicles')
+    parser.add_argument('--rounds', type=int, default=1, help='number of FL iterations')
+    parser.add_argument('--start_round', type=int, default=0,
+                        help='resume from the global model of round start_round - 1 in MODEL_FOLDER if greater '
+                             'than 0, from the latest global version for --async_versions')
+    parser.add_argument('--cfg_files', type=str, default='tesla713.yaml,tesla714.yaml',
+                        help='comma separated configs of the clients, relative to tools/cfgs')
+    parser.add_argument('--record', type=str, default=None,
+                        help='a client per ego vehicle of this recording (relative to ROOT_PATH, e.g. '
+                             'data/record2020_1027_1957) with the first config of --cfg_files')
+    parser.add_argument('--distill_task', type=str, default=None,
+                        help='with --record, fuse the detections in <vehicle>/<distill_task>/ over the vehicles and '
+                             'train on the fused labels, kept in memory by the datasets of the clients')
+    parser.add_argument('--distill_interval', type=int, default=0,
+                        help='fuse again every distill_interval rounds, e.g. with updated detections, 0 to fuse once')
+    parser.add_argument('--fusion_task', choices=['dynamic', 'mean', 'max'], default='dynamic',
+                        help='weighting of the detections of a fused object')
+    parser.add_argument('--frame_list', type=str, default=None,
+                        help='list file of the frames to fuse in the recording, e.g. test for test.txt, all of them '
+                             'by default')
+    parser.add_argument('--num_procs', type=int, default=2,
+                        help='worker processes running the clients concurrently, 0 to run them in this process')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=0, help='number of workers for the dataloader of a client')
+    parser.add_argument('--epochs', type=int, default=1, help='epochs of a client in each round')
+    parser.add_argument('--compression', choices=['full'] + COMPRESSION_MODES, default='full',
+                        help='client updates as full weights, or as their delta from the global model: dense, top-k '
+                             'sparsified or 8 bit quantized')
+    parser.add_argument('--topk_ratio', type=float, default=0.01, help='fraction of each tensor sent by topk')
+    parser.add_argument('--no_error_feedback', action='store_true', default=False,
+                        help='drop the compression error instead of adding it to the next update')
+    parser.add_argument('--optimizer_state', choices=OPTIMIZER_STATE_POLICIES, default='keep',
+                        help='momentum buffers of the optimizer of a client: kept from its last round, reset at each '
+                             'round or averaged over the clients (synchronous rounds only)')
+    parser.add_argument('--secure_aggregation', action='store_true', default=False,
+                        help='pairwise masked client weights, only their weighted sum is seen by the aggregation '
+                             '(synchronous rounds with full weights only, not with --optimizer_state average)')
+    parser.add_argument('--keep_rounds', type=int, default=None,
+                        help='global models (and client models) kept in MODEL_FOLDER, all of them by default')
+    parser.add_argument('--keep_every', type=int, default=None,
+                        help='keep the rounds multiple of keep_every as well, e.g. for a later evaluation')
+    parser.add_argument('--save_clients', action='store_true', default=False,
+                        help='save the trained weights of each client at each round, full weights only')
+    parser.add_argument('--async_versions', type=int, default=0,
+                        help='run an asynchronous aggregation server up to this number of global versions instead '
+                             'of synchronous rounds')
+    parser.add_argument('--alpha', type=float, default=0.6, help='async: mixing weight of a fresh update, in (0, 1]')
+    parser.add_argument('--staleness_exponent', type=float, default=0.5,
+                        help='async: the weight decays as (staleness + 1) ** -staleness_exponent')
+    parser.add_argument('--max_staleness', type=int, default=None, help='async: drop older updates')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='pipe', help='async: pipes or a local socket')
+    parser.add_argument('--eval_interval', type=int, default=0,
+                        help='async: evaluate the global model every eval_interval versions on the val split of '
+                             'the first client')
+    parser.add_argument('--eval_procs', type=int, default=0,
+                        help='evaluation workers scoring the global model of each round on the val split of the '
+                             'first client while the next rounds train, the AP table goes to MODEL_FOLDER/eval')
+    parser.add_argument('--eval_threads', type=int, default=None, help='torch threads of each evaluation worker')
+    return parser.parse_args()
+
+
+def get_client_kwargs_list(args):
+    client_kwargs = {
+        'batch_size': args.batch_size, 'workers': args.workers, 'epochs': args.epochs, 'root_dir': ROOT_PATH,
+        'compression': None if args.compression == 'full' else args.compression, 'topk_ratio': args.topk_ratio,
+        'error_feedback': not args.no_error_feedback, 'optimizer_state': args.optimizer_state
+    }
+    cfg_files = args.cfg_files.split(',')
+    if args.record is not None:
+        cfg_file = (cfg_folder / cfg_files[0]).as_posix()
+        return [dict(client_kwargs, cfg_file=cfg_file, data_dir=data_dir)
+                for data_dir in find_vehicle_dirs(args.record, ROOT_PATH)]
+    return [dict(client_kwargs, cfg_file=(cfg_folder / cfg_file).as_posix()) for cfg_file in cfg_files]
+
+
+def build_engine(args, logger):
+    client_kwargs_list = get_client_kwargs_list(args)
+    engine = FedEngine(client_kwargs_list, num_procs=args.num_procs, ckpt_store=CheckpointStore(MODEL_FOLDER),
+                       keep_last=args.keep_rounds, keep_every=args.keep_every, save_clients=args.save_clients,
+                       secure_aggregation=args.secure_aggregation, logger=logger)
+    if args.start_round > 0:
+        # train from last global model
+        engine.load_global_round(args.start_round - 1)
+    return engine
+
+
+def build_eval_service(args, logger):
+    client_kwargs = get_client_kwargs_list(args)[0]
+    evaluator_kwargs = {'eval_cfg_file': client_kwargs['cfg_file'], 'root_dir': ROOT_PATH,
+                        'data_dir': client_kwargs.get('data_dir', None), 'resident_voxels': True}
+    return FedEvalService(evaluator_kwargs, MODEL_FOLDER / 'eval', num_procs=args.eval_procs,
+                          num_threads=args.eval_threads, logger=logger)
+
+
+def run_rounds(engine, start_round, num_rounds, logger, distill_stage=None, distill_interval=0, eval_service=None):
+    for cur_round in range(start_round, start_round + num_rounds):
+        logger.info('===================== %d =====================' % cur_round)
+        k = cur_round - start_round
+        if distill_stage is not None and (k == 0 or (distill_interval > 0 and k % distill_interval == 0)):
+            labels, _ = distill_stage.fuse()
+            distill_stage.apply(engine, labels)
+        engine.run_round(cur_round)
+        if eval_service is not None:
+            eval_service.publish(cur_round, engine.global_state)
+        # finish one FL iteration
+        logger.info('---------------------------------FL Iteration %r is completed.' % cur_round)
+
+
+def run_async_server(args, logger):
+    global_state = None
+    ckpt_store = CheckpointStore(MODEL_FOLDER)
+    if args.start_round > 0:
+        global_state = ckpt_store.load(ckpt_store.latest('global'))['model_state']
+    eval_fn = GlobalModelEvaluator((cfg_folder / args.cfg_files.split(',')[0]).as_posix(), MODEL_FOLDER / 'eval',
+                                   logger=logger, root_dir=ROOT_PATH) if args.eval_interval > 0 else None
+    server = AsyncAggregationServer(
+        global_state, alpha=args.alpha, staleness_exponent=args.staleness_exponent,
+        max_staleness=args.max_staleness, eval_fn=eval_fn, eval_interval=args.eval_interval,
+        ckpt_store=ckpt_store, keep_last=args.keep_rounds, keep_every=args.keep_every, logger=logger
+    )
+    run_async(get_client_kwargs_list(args), server, transport=args.transport, max_versions=args.async_versions)
+    logger.info('%d global versions, %.1f updates/min, %d stale updates dropped'
+                % (server.version, server.updates_per_min(), server.num_dropped))
+
+
+def main():
+    args = parse_args()
+    MODEL_FOLDER.mkdir(parents=True, exist_ok=True)
+    log_file = MODEL_FOLDER / ('log_fed_%s.txt' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    logger = common_utils.create_logger(log_file)
+
+    # the datasets and the models are built once, with TRAIN_ROOT as working dir as train.py
+    with workSpace(TRAIN_ROOT):
+        if args.async_versions > 0:
+            run_async_server(args, logger)
+            return
+        assert not (args.secure_aggregation and args.optimizer_state == 'average'), \
+            '--secure_aggregation loses the precision of the averaged Adam buffers, use --optimizer_state keep or reset'
+        distill_stage = None
+        if args.distill_task is not None:
+            assert args.record is not None, '--distill_task needs the vehicles of a --record'
+            distill_stage = DistillStage(ROOT_PATH / args.record, task=args.distill_task,
+                                         fusion_task=args.fusion_task, frame_list=args.frame_list, logger=logger)
+        eval_service = build_eval_service(args, logger) if args.eval_procs > 0 else None
+        engine = build_engine(args, logger)
+        try:
+            run_rounds(engine, args.start_round, args.rounds, logger, distill_stage=distill_stage,
+                       distill_interval=args.distill_interval, eval_service=eval_service)
+        finally:
+            engine.close()
+            if eval_service is not None:
+                eval_service.close()
+
+
+if __name__ == '__main__':
+    main()
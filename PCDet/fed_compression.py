@@ -0,0 +1,157 @@
+"""
+Compressed client updates of the federated rounds
+A client sends the delta of its trained weights from the global model of the round: as is, as the top-k entries of
+each tensor, or quantized to 8 bits per tensor. The compression error is kept by the client and added to its delta of
+the next round (error feedback). The aggregation accumulates the deltas as they are, without densifying an update
+"""
+import math
+import torch
+from averaging import StreamingAverager
+
+COMPRESSION_MODES = ['delta', 'topk', 'int8']
+
+
+class DeltaCompressor(object):
+    """
+    resident on the client with its error feedback residuals
+    """
+    def __init__(self, mode='delta', topk_ratio=0.01, error_feedback=True):
+        """
+        :param mode: delta (dense fp32 delta), topk (the topk_ratio largest entries of each tensor) or int8
+        :param error_feedback: add the compression error of the last round to the delta
+        """
+        assert mode in COMPRESSION_MODES, 'unknown compression %s' % mode
+        self.mode = mode
+        self.topk_ratio = topk_ratio
+        self.error_feedback = error_feedback and mode != 'delta'
+        self.residuals = {}
+
+    def compress_tensor(self, delta):
+        """
+        :param delta: float tensor
+        :return: payload of the tensor and its decompressed delta
+        """
+        if self.mode == 'delta':
+            return {'dense': delta}, delta
+        if self.mode == 'topk':
+            flat_delta = delta.reshape(-1)
+            num_topk = min(max(int(math.ceil(self.topk_ratio * flat_delta.numel())), 1), flat_delta.numel())
+            indices = torch.topk(flat_delta.abs(), num_topk, sorted=False)[1]
+            values = flat_delta[indices]
+            decompressed = torch.zeros_like(flat_delta).index_copy_(0, indices, values).view_as(delta)
+            return {'indices': indices.int(), 'values': values, 'shape': tuple(delta.shape)}, decompressed
+        # int8, symmetric per tensor
+        scale = delta.abs().max().clamp(min=1e-12) / 127
+        quantized = torch.round(delta / scale).clamp(-127, 127).to(torch.int8)
+        return {'int8': quantized, 'scale': scale}, quantized.float() * scale
+
+    def compress(self, model_state, global_state):
+        """
+        :param model_state: trained state dict of the client
+        :param global_state: global state dict the client started the round from
+        :return: update dict of {key: payload}, the non float tensors are sent as they are
+        """
+        update = {}
+        for key, val in model_state.items():
+            val = val.detach().cpu()
+            if not val.is_floating_point() or key not in global_state or \
+                    global_state[key].shape != val.shape:
+                update[key] = {'raw': val}
+                continue
+            delta = val.float() - global_state[key].float()
+            if self.error_feedback and key in self.residuals:
+                delta += self.residuals[key]
+            update[key], decompressed = self.compress_tensor(delta)
+            if self.error_feedback:
+                self.residuals[key] = delta - decompressed
+        return update
+
+
+def decompress_payload(payload):
+    """
+    :return: dense delta of a float payload, or the raw tensor
+    """
+    if 'raw' in payload:
+        return payload['raw']
+    if 'dense' in payload:
+        return payload['dense']
+    if 'indices' in payload:
+        delta = payload['values'].new_zeros(int(torch.Size(payload['shape']).numel()))
+        return delta.index_copy_(0, payload['indices'].long(), payload['values']).view(payload['shape'])
+    return payload['int8'].float() * payload['scale']
+
+
+def payload_shape(payload):
+    if 'shape' in payload:
+        return torch.Size(payload['shape'])
+    return [val for key, val in payload.items() if key in ['raw', 'dense', 'int8']][0].shape
+
+
+def update_num_bytes(update):
+    """
+    :return: bytes of the tensors of an update or a state dict
+    """
+    num_bytes = 0
+    for val in update.values():
+        tensors = val.values() if isinstance(val, dict) else [val]
+        num_bytes += sum([x.numel() * x.element_size() for x in tensors if isinstance(x, torch.Tensor)])
+    return num_bytes
+
+
+class DeltaAverager(StreamingAverager):
+    """
+    weighted average of the client updates from DeltaCompressor, the new global model is the old one plus the average
+    delta, the accumulators of the deltas are fp64 and updated in place
+    """
+    def __init__(self, global_state, strict=False, logger=None):
+        super().__init__(strict=strict, logger=logger)
+        self.global_state = global_state
+        self.sum_state = {}
+        for key, val in global_state.items():
+            self.dtypes[key] = val.dtype
+            if val.is_floating_point():
+                self.sum_state[key] = torch.zeros(val.shape, dtype=torch.float64)
+                self.key_weights[key] = 0
+        self.raw_state = {}
+
+    def add(self, update, weight=1.0):
+        """
+        :param update: from DeltaCompressor.compress
+        """
+        assert weight > 0, 'the weight of a client must be positive'
+        for key in self.global_state:
+            if key not in update:
+                self._mismatch(key, 'missing')
+        for key, payload in update.items():
+            if key not in self.global_state:
+                self._mismatch(key, 'unexpected')
+            elif payload_shape(payload) != self.global_state[key].shape:
+                self._mismatch(key, 'shape %s instead of %s' % (
+                    tuple(payload_shape(payload)), tuple(self.global_state[key].shape)))
+            elif 'raw' in payload:
+                # the non float tensors of the first client are kept
+                self.raw_state.setdefault(key, payload['raw'])
+            elif key in self.key_weights:
+                cur_sum = self.sum_state[key]
+                if 'dense' in payload:
+                    cur_sum.add_(payload['dense'].double(), alpha=weight)
+                elif 'indices' in payload:
+                    cur_sum.view(-1).index_add_(0, payload['indices'].long(), payload['values'].double() * weight)
+                else:
+                    cur_sum.add_(payload['int8'].double(), alpha=weight * payload['scale'].item())
+                self.key_weights[key] += weight
+        self.num_clients += 1
+
+    def average(self):
+        """
+        :return: the new global state dict, the keys without any delta keep their global value
+        """
+        avg_state = {}
+        for key, val in self.global_state.items():
+            if key in self.key_weights and self.key_weights[key] > 0:
+                avg_delta = self.sum_state.pop(key).div_(self.key_weights[key])
+                avg_state[key] = (val.double() + avg_delta).to(self.dtypes[key])
+            else:
+                avg_state[key] = self.raw_state.get(key, val)
+        self.sum_state = None
+        return avg_state
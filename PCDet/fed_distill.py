@@ -0,0 +1,94 @@
+"""
+Federated distillation of the ego vehicles of a recording
+The detections of the vehicles are fused over the vehicles (fusion/Fusion.py) and the fused labels go straight to the
+label overlay of the dataset of each client, whose infos are updated in place: the next round trains on them without
+label_fusion files, new info files nor a rebuild of the clients
+"""
+import sys
+import time
+import logging
+from pathlib import Path
+
+sys.path.append((Path(__file__).resolve().parents[1] / 'fusion').as_posix())  # Fusion
+
+
+def label_rows_to_lines(label_list):
+    """
+    :param label_list: KITTI label rows of Fusion.py, lists of str and numbers
+    :return: KITTI label lines
+    """
+    return [' '.join([str(x) for x in row]) for row in label_list]
+
+
+def detections_from_annos(det_annos, infos):
+    """
+    :param det_annos: annos of eval_one_epoch for the samples of infos in order, e.g. the result.pkl of test.py
+    :param infos: kitti_infos of the evaluated dataset
+    :return: {sample_idx: KITTI label rows with score} as the detection files of Fusion.py
+    """
+    detections = {}
+    for anno, info in zip(det_annos, infos):
+        rows = []
+        for k in range(len(anno['name'])):
+            # lhw -> hwl as generate_annotations with save_to_file
+            values = [anno['alpha'][k]] + list(anno['bbox'][k]) + list(anno['dimensions'][k][[1, 2, 0]]) + \
+                list(anno['location'][k]) + [anno['rotation_y'][k], anno['score'][k]]
+            rows.append([anno['name'][k], '-1', '-1'] + ['%.4f' % x for x in values])
+        detections[info['point_cloud']['lidar_idx']] = rows
+    return detections
+
+
+class DistillStage(object):
+    """
+    fused labels of the vehicles of a recording for the label overlay of the datasets of the federated clients, the
+    vehicle dirs are the client names (fed.py --record) and the frame ids their sample ids
+    """
+    def __init__(self, record_dir, task='distill', fusion_task='dynamic', frame_list=None, logger=None):
+        """
+        :param record_dir: recording with global_label and the vehicle dirs, their detections in <vehicle>/<task>/
+        :param fusion_task: weighting of the detections of a cluster, dynamic, mean or max
+        :param frame_list: list file of the frames in record_dir without .txt (e.g. test for test.txt), all the frames
+                           of global_label by default
+        """
+        # open3d and sklearn are only needed by the distill stage
+        import Fusion
+        self.fusion = Fusion
+        self.record_dir = Path(record_dir)
+        self.task = task
+        self.fusion_task = fusion_task
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        if frame_list is not None:
+            with open(str(self.record_dir / (frame_list + '.txt')), 'r') as f:
+                self.frame_id_list = sorted([x.strip() for x in f.readlines() if x.strip()])
+        else:
+            self.frame_id_list = sorted([x.stem for x in (self.record_dir / 'global_label').glob('*.txt')])
+
+    def fuse(self, detections=None):
+        """
+        :param detections: {vehicle dir: {frame id: KITTI label rows with score}}, e.g. from detections_from_annos,
+                           None to read the detection files of task
+        :return: {vehicle dir: {sample_idx: KITTI label lines}}, {vehicle dir: frame ids to distill}
+        """
+        start = time.perf_counter()
+        labels = {}
+
+        def label_sink(test_id, frame_id, label_list):
+            labels.setdefault(test_id, {})[frame_id] = label_rows_to_lines(label_list)
+
+        distill_id = self.fusion.run_fusion(str(self.record_dir), self.frame_id_list, self.task, self.fusion_task,
+                                            label_sink=label_sink, detections=detections)
+        self.logger.info('fused %d frames of %d vehicles in %.1f s, %d frames to distill' % (
+            len(self.frame_id_list), len(labels), time.perf_counter() - start,
+            sum([len(x) for x in distill_id.values()])
+        ))
+        return labels, distill_id
+
+    def apply(self, engine, labels):
+        """
+        :param engine: fed_engine.FedEngine with a client per vehicle dir
+        :return: {client name: number of infos updated}
+        """
+        names = [name for name in engine.client_names if name in labels]
+        updated = engine.call_clients('labels', {name: (labels[name],) for name in names})
+        self.logger.info('fused labels of %s' % ', '.join(['%s: %d samples' % x for x in updated.items()]))
+        return updated
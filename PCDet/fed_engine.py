@@ -0,0 +1,550 @@
+"""
+In-process federated learning rounds
+Each client keeps its dataset, model, optimizer and lr schedulers resident in a worker process for all the rounds, a
+round only ships the global weights to the clients and their trained weights back to the aggregation
+The momentum buffers of the optimizer of a client are kept across the rounds, reset at each round or averaged over the
+clients as the weights
+With secure aggregation the clients send their weights under pairwise masks (fed_secure) and a client failing during
+a round drops out of it, its masks are removed with the seeds of the others
+"""
+import sys
+import copy
+import time
+import traceback
+import logging
+from pathlib import Path
+import torch
+import torch.multiprocessing as mp
+from multiprocessing import connection as mp_connection
+import tqdm
+
+sys.path.append(Path(__file__).resolve().parent.as_posix())  # averaging
+sys.path.append((Path(__file__).resolve().parent / 'tools').as_posix())  # train_utils
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.datasets import build_dataloader
+from pcdet.models import build_network, model_fn_decorator, get_default_device
+from train_utils.optimization import build_optimizer, build_scheduler
+from train_utils.train_utils import train_one_epoch, model_state_to_cpu
+from eval_utils import eval_utils
+from averaging import StreamingAverager
+from fed_compression import DeltaCompressor, DeltaAverager, update_num_bytes
+from fed_secure import PairwiseMasker, SecureAverager, WEIGHTS_STREAM
+from pcdet.utils.checkpoint_store import load_checkpoint
+
+ROUND_TIME_KEYS = ['restart', 'load', 'train', 'aggregate', 'save']
+OPTIMIZER_STATE_POLICIES = ['keep', 'reset', 'average']
+# requests of the engine to the clients of a worker: (request, client name, *args) calls the method
+CLIENT_REQUESTS = {'train': 'train_round', 'public_key': 'get_public_key', 'peer_keys': 'set_peer_keys',
+                   'unmask': 'unmask_seeds', 'labels': 'update_labels'}
+# names in the CheckpointStore
+GLOBAL_MODEL_NAME = 'global/round_%04d'
+CLIENT_MODEL_NAME = 'client/%s/round_%04d'
+
+
+def set_vehicle_data(data_dir):
+    """
+    point the data config of the global cfg to the KITTI data of one ego vehicle, e.g.
+    data/record2020_1027_1957/vehicle.tesla.model3_713 with its kitti_infos_train / val and kitti_dbinfos_train
+    """
+    data_dir = Path(data_dir)
+    cfg.DATA_CONFIG.DATA_DIR = data_dir.as_posix()
+    cfg.DATA_CONFIG.TRAIN.INFO_PATH = [(data_dir / 'kitti_infos_train.pkl').as_posix()]
+    cfg.DATA_CONFIG.TEST.INFO_PATH = [(data_dir / 'kitti_infos_val.pkl').as_posix()]
+    cfg.DATA_CONFIG.AUGMENTATION.DB_SAMPLER.DB_INFO_PATH = [(data_dir / 'kitti_dbinfos_train.pkl').as_posix()]
+
+
+class FedClient(object):
+    """
+    resident training state of one client, the config of the client is set to the global cfg before each use as the
+    clients of a worker share it
+    """
+    def __init__(self, cfg_file, batch_size=1, workers=0, epochs=1, root_dir=None, show_progress=False,
+                 compression=None, topk_ratio=0.01, error_feedback=True, optimizer_state='keep', data_dir=None,
+                 point_store=None, secure_aggregation=False):
+        """
+        :param data_dir: data of the ego vehicle of the client, replaces the data paths of cfg_file
+        :param point_store: pcdet.datasets.shared_points.SharedPointStore with the points of the client
+        :param compression: None to send the full weights, or a mode of fed_compression.DeltaCompressor to send the
+                            delta from the global model
+        :param optimizer_state: keep the momentum buffers of the optimizer from the last round of the client, reset
+                                them at each round, or average them over the clients (their global average is
+                                given to train_round)
+        :param secure_aggregation: mask the weights sent in the rounds with a secure_round, after the key exchange of
+                                   the engine
+        """
+        assert optimizer_state in OPTIMIZER_STATE_POLICIES, 'unknown optimizer state policy %s' % optimizer_state
+        assert not (secure_aggregation and compression is not None), \
+            'secure aggregation needs the full weights, the masks do not cancel over compressed updates'
+        # the fixed point encoding has an absolute resolution, the tiny second moments of Adam (~1e-9) would be lost
+        assert not (secure_aggregation and optimizer_state == 'average'), \
+            'secure aggregation does not average the optimizer buffers, use the keep or reset policy'
+        cfg_from_yaml_file(cfg_file, cfg)
+        cfg.TAG = Path(cfg_file).stem
+        if data_dir is not None:
+            set_vehicle_data(data_dir)
+            cfg.TAG = Path(data_dir).name
+        if root_dir is not None:
+            cfg.ROOT_DIR = Path(root_dir)
+        self.name = cfg.TAG
+        self.point_store = point_store
+        self.epochs = epochs
+        self.show_progress = show_progress
+        self.logger = logging.getLogger(__name__)
+
+        self.train_set, self.train_loader = self.build_dataloader(batch_size, workers)
+        self.model = build_network(self.train_set)
+        self.model.to(get_default_device())
+        self.model_func = model_fn_decorator()
+        self.cfg = copy.deepcopy(cfg)
+
+        self.optim_cfg = cfg.MODEL.TRAIN.OPTIMIZATION
+        self.optimizer = build_optimizer(self.model, self.optim_cfg)
+        # schedule of one round, restarted at each round as the train.py run of each round of INVS_main.py did
+        self.lr_scheduler, self.lr_warmup_scheduler = build_scheduler(
+            self.optimizer, total_iters_each_epoch=len(self.train_loader), total_epochs=epochs, last_epoch=1,
+            optim_cfg=self.optim_cfg
+        )
+        self.accumulated_iter = 0
+        self.optimizer_state = optimizer_state
+        self.compressor = DeltaCompressor(compression, topk_ratio=topk_ratio, error_feedback=error_feedback) \
+            if compression is not None else None
+        self.masker = PairwiseMasker(self.name) if secure_aggregation else None
+
+    def build_dataloader(self, batch_size, workers):
+        train_set, train_loader, _ = build_dataloader(
+            cfg.DATA_CONFIG.DATA_DIR, batch_size, False, workers=workers, logger=self.logger, training=True
+        )
+        train_set.point_store = self.point_store
+        return train_set, train_loader
+
+    @property
+    def num_samples(self):
+        return len(self.train_set)
+
+    def get_optimizer_buffers(self):
+        """
+        :return: {param_name.buffer_name: tensor on cpu} of the buffers of the optimizer with the shape of their
+                 parameter, e.g. exp_avg and exp_avg_sq of Adam or momentum_buffer of SGD, the step counts are not in
+        """
+        buffers = {}
+        for name, param in self.model.named_parameters():
+            for buffer_name, val in self.optimizer.state.get(param, {}).items():
+                if isinstance(val, torch.Tensor) and val.shape == param.shape:
+                    buffers['%s.%s' % (name, buffer_name)] = val.detach().cpu()
+        return buffers
+
+    def set_optimizer_buffers(self, buffers):
+        """
+        :param buffers: from get_optimizer_buffers, copied in place into the existing state of the optimizer
+        """
+        for name, param in self.model.named_parameters():
+            for buffer_name, val in self.optimizer.state.get(param, {}).items():
+                key = '%s.%s' % (name, buffer_name)
+                if key in buffers:
+                    val.copy_(buffers[key])
+
+    def restart(self, global_state, optimizer_buffers=None):
+        """
+        swap the global weights in and apply the optimizer state policy, the lr schedulers restart their cycle in
+        train_round
+        """
+        self.model.load_state_dict(global_state)
+        if self.optimizer_state == 'reset':
+            # Adam starts again from zero moments and step
+            self.optimizer.state.clear()
+        elif self.optimizer_state == 'average' and optimizer_buffers is not None:
+            self.set_optimizer_buffers(optimizer_buffers)
+
+    def update_labels(self, labels):
+        """
+        :param labels: {sample_idx: KITTI label lines} for the label overlay of the dataset of the client, e.g. the
+                       fused labels of fed_distill.DistillStage
+        :return: number of infos updated
+        """
+        return self.train_set.update_labels(labels)
+
+    def get_public_key(self):
+        return self.masker.public_key
+
+    def set_peer_keys(self, public_keys):
+        self.masker.set_peer_keys(public_keys)
+
+    def unmask_seeds(self, dropped, cur_round, stream=WEIGHTS_STREAM):
+        return self.masker.unmask_seeds(dropped, cur_round, stream)
+
+    def train_round(self, global_state=None, optimizer_buffers=None, secure_round=None):
+        """
+        :param global_state: state dict of the global model, None to go on from the weights of the client
+        :param optimizer_buffers: average of the optimizer buffers of the clients for the average policy
+        :param secure_round: (cur_round, names of the clients of the round) to send the weights masked
+        :return: dict of the trained model_state on cpu (or its compressed delta as update, or masked_update),
+                 num_samples, accumulated_iter, num_bytes of the weights to send, the load (round restart) / train
+                 times, the optimizer_buffers for the average policy and the mask cpu time
+        """
+        cfg.update(self.cfg)
+        start = time.perf_counter()
+        if global_state is not None:
+            self.restart(global_state, optimizer_buffers)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.model.train()
+        # the progress bars of concurrent clients would interleave, they log as a non master rank by default
+        rank = 0 if self.show_progress else 1
+        # the schedulers are stepped with the iterations of the round, they span a round only
+        round_iter = 0
+        with tqdm.trange(self.epochs, desc=self.name, dynamic_ncols=True, disable=not self.show_progress) as tbar:
+            for cur_epoch in tbar:
+                if self.lr_warmup_scheduler is not None and cur_epoch < self.optim_cfg.WARMUP_EPOCH:
+                    cur_scheduler = self.lr_warmup_scheduler
+                else:
+                    cur_scheduler = self.lr_scheduler
+                round_iter = train_one_epoch(
+                    self.model, self.optimizer, self.train_loader, self.model_func,
+                    lr_scheduler=cur_scheduler, accumulated_iter=round_iter, optim_cfg=self.optim_cfg,
+                    rank=rank, tbar=tbar, leave_pbar=(cur_epoch + 1 == self.epochs)
+                )
+        self.accumulated_iter += round_iter
+        model_state = model_state_to_cpu(self.model.state_dict())
+        train_time = time.perf_counter() - start
+
+        result = {'num_samples': self.num_samples, 'accumulated_iter': self.accumulated_iter,
+                  'load': load_time, 'train': train_time}
+        if self.masker is not None and secure_round is not None:
+            start = time.process_time()
+            cur_round, peers = secure_round
+            result['masked_update'] = self.masker.mask(model_state, self.num_samples, peers, cur_round)
+            result['num_bytes'] = update_num_bytes(result['masked_update'])
+            result['mask'] = time.process_time() - start
+            return result
+
+        if self.compressor is not None and global_state is not None:
+            result['update'] = self.compressor.compress(model_state, global_state)
+        else:
+            # there is no global model to take the delta from before the first round
+            result['model_state'] = model_state
+        result['num_bytes'] = update_num_bytes(result.get('update', model_state))
+        if self.optimizer_state == 'average':
+            result['optimizer_buffers'] = self.get_optimizer_buffers()
+            result['num_bytes'] += update_num_bytes(result['optimizer_buffers'])
+        return result
+
+
+def client_worker(conn, client_class, client_kwargs_list):
+    """
+    loop of a worker process, builds its clients once and trains them on the requests of the engine
+    :param conn: end of the pipe to the engine, gets (request of CLIENT_REQUESTS, name, *args), e.g.
+                 ('train', name, global_state, optimizer_buffers, secure_round), or ('close',)
+    """
+    try:
+        clients = {}
+        for client_kwargs in client_kwargs_list:
+            client = client_class(**client_kwargs)
+            clients[client.name] = client
+        conn.send(('ready', {name: client.num_samples for name, client in clients.items()}))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+
+    while True:
+        request = conn.recv()
+        if request[0] == 'close':
+            break
+        try:
+            conn.send(('done', getattr(clients[request[1]], CLIENT_REQUESTS[request[0]])(*request[2:])))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class GlobalModelEvaluator(object):
+    """
+    the val split of a client config with a resident model to load the global weights in
+    """
+    def __init__(self, eval_cfg_file, output_dir, logger=None, root_dir=None, data_dir=None, point_store=None,
+                 resident_voxels=False):
+        """
+        :param data_dir: data of an ego vehicle, replaces the data paths of eval_cfg_file
+        :param resident_voxels: keep the voxels of the val split in memory after the first evaluation
+        """
+        cfg_from_yaml_file(eval_cfg_file, cfg)
+        if data_dir is not None:
+            set_vehicle_data(data_dir)
+        if root_dir is not None:
+            cfg.ROOT_DIR = Path(root_dir)
+        self.cfg = copy.deepcopy(cfg)
+        self.output_dir = Path(output_dir)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.test_set, self.test_loader, _ = build_dataloader(
+            cfg.DATA_CONFIG.DATA_DIR, 1, False, workers=0, logger=self.logger, training=False
+        )
+        self.test_set.point_store = point_store
+        if resident_voxels:
+            self.test_set.init_voxel_cache(self.logger, resident=True)
+        self.model = build_network(self.test_set)
+        self.model.to(get_default_device())
+
+    def __call__(self, global_state, tag):
+        """
+        :return: ret_dict of eval_one_epoch, with the AP of the KITTI evaluation
+        """
+        cfg.update(self.cfg)
+        self.model.load_state_dict(global_state)
+        with torch.no_grad():
+            return eval_utils.eval_one_epoch(self.model, self.test_loader, tag, self.logger,
+                                             result_dir=self.output_dir / tag)
+
+
+class FedEngine(object):
+    """
+    synchronous federated rounds over resident clients: swap the global weights in, train, average, save
+    any number of clients, the global model is their average weighted by their numbers of training samples
+    a client failing during a round drops out of it, the round goes on with the others
+    """
+    def __init__(self, client_kwargs_list, num_procs=0, client_class=FedClient, ckpt_store=None, keep_last=None,
+                 keep_every=None, save_clients=False, secure_aggregation=False, logger=None):
+        """
+        :param client_kwargs_list: kwargs of client_class for each client
+        :param num_procs: number of worker processes, the clients are spread over them and run concurrently,
+                          0 to train them one after the other in this process
+        :param client_class: FedClient or a subclass with another build_dataloader, importable by the workers
+        :param ckpt_store: pcdet.utils.checkpoint_store.CheckpointStore, the global model of each round is saved as
+                           GLOBAL_MODEL_NAME, None to not save it
+        :param keep_last: the keep_last latest rounds are kept in the store and the rounds multiple of keep_every,
+                          None to keep all of them
+        :param save_clients: save the trained weights of each client as CLIENT_MODEL_NAME as well, not the
+                             compressed updates
+        :param secure_aggregation: the clients exchange their keys once and send pairwise masked weights, the engine
+                                   only sees their weighted sum
+        """
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.ckpt_store = ckpt_store
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.save_clients = save_clients and ckpt_store is not None
+        self.secure_aggregation = secure_aggregation
+        if secure_aggregation:
+            client_kwargs_list = [dict(client_kwargs, secure_aggregation=True) for client_kwargs in client_kwargs_list]
+        self.global_state = None
+        self.global_optimizer_buffers = None
+        self.round_times = []
+        self.num_procs = min(num_procs, len(client_kwargs_list))
+
+        start = time.perf_counter()
+        self.workers = []
+        if self.num_procs == 0:
+            self.clients = [client_class(**client_kwargs) for client_kwargs in client_kwargs_list]
+            self.client_names = [client.name for client in self.clients]
+            self.num_samples = {client.name: client.num_samples for client in self.clients}
+        else:
+            # spawn, the workers may use CUDA
+            ctx = mp.get_context('spawn')
+            self.clients = None
+            self.client_names, self.num_samples, self.worker_of_client = [], {}, {}
+            for k in range(self.num_procs):
+                conn, worker_conn = ctx.Pipe()
+                process = ctx.Process(target=client_worker, daemon=True,
+                                      args=(worker_conn, client_class, client_kwargs_list[k::self.num_procs]))
+                process.start()
+                self.workers.append((process, conn))
+            for k, (process, conn) in enumerate(self.workers):
+                num_samples = self._recv(conn)
+                for name in num_samples:
+                    self.worker_of_client[name] = k
+                self.num_samples.update(num_samples)
+            self.client_names = list(self.worker_of_client.keys())
+        self.logger.info('%d clients ready in %.1f s: %s' % (
+            len(self.client_names), time.perf_counter() - start,
+            ', '.join(['%s (%d samples)' % (name, self.num_samples[name]) for name in self.client_names])
+        ))
+        if secure_aggregation:
+            self.exchange_keys()
+
+    @staticmethod
+    def _recv(conn):
+        status, result = conn.recv()
+        if status == 'error':
+            raise RuntimeError('federated client worker failed:\n%s' % result)
+        return result
+
+    def call_clients(self, request, args_of_client):
+        """
+        :param request: a key of CLIENT_REQUESTS
+        :param args_of_client: {client name: args of the method}
+        :return: {client name: return value of the method}
+        """
+        if self.num_procs == 0:
+            clients = {client.name: client for client in self.clients}
+            return {name: getattr(clients[name], CLIENT_REQUESTS[request])(*args)
+                    for name, args in args_of_client.items()}
+        for name, args in args_of_client.items():
+            self.workers[self.worker_of_client[name]][1].send((request, name) + tuple(args))
+        # the requests of a worker are answered in order
+        return {name: self._recv(self.workers[self.worker_of_client[name]][1]) for name in args_of_client}
+
+    def exchange_keys(self):
+        """
+        relay the Diffie-Hellman public keys of the clients to all of them for their pairwise masks
+        """
+        start = time.perf_counter()
+        public_keys = self.call_clients('public_key', {name: () for name in self.client_names})
+        self.call_clients('peer_keys', {name: (public_keys,) for name in self.client_names})
+        self.logger.info('secure aggregation keys of %d clients exchanged in %.2f s' % (
+            len(public_keys), time.perf_counter() - start))
+
+    def load_global_model(self, filename):
+        """
+        :param filename: checkpoint with a model_state, a torch.save file or a manifest of a CheckpointStore
+        """
+        self.global_state = load_checkpoint(filename, map_location=torch.device('cpu'))['model_state']
+
+    def load_global_round(self, cur_round):
+        self.global_state = self.ckpt_store.load(GLOBAL_MODEL_NAME % cur_round)['model_state']
+
+    def train_clients(self, secure_round=None):
+        """
+        :param secure_round: (cur_round, names of the clients) for the masks of secure aggregation
+        :return: generator of (name, train_round result) of the clients in the order they finish, the result is None
+                 for a client that failed or whose worker died
+        """
+        if self.num_procs == 0:
+            for client in self.clients:
+                try:
+                    result = client.train_round(self.global_state, self.global_optimizer_buffers, secure_round)
+                except Exception:
+                    self.logger.warning('client %s dropped out:\n%s' % (client.name, traceback.format_exc()))
+                    result = None
+                yield client.name, result
+            return
+
+        pending = {}
+        for name in self.client_names:
+            _, conn = self.workers[self.worker_of_client[name]]
+            conn.send(('train', name, self.global_state, self.global_optimizer_buffers, secure_round))
+            pending.setdefault(conn, []).append(name)
+        while len(pending) > 0:
+            # the requests of a worker are answered in order
+            for conn in mp_connection.wait(list(pending.keys())):
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    # the worker process died, its clients leave the federation
+                    dead = pending.pop(conn)
+                    self.client_names = [name for name in self.client_names if name not in dead]
+                    self.logger.warning('worker of %s died, they dropped out' % ', '.join(dead))
+                    for name in dead:
+                        yield name, None
+                    continue
+                name = pending[conn].pop(0)
+                if status == 'error':
+                    self.logger.warning('client %s dropped out:\n%s' % (name, result))
+                    result = None
+                yield name, result
+                if len(pending[conn]) == 0:
+                    del pending[conn]
+
+    def run_round(self, cur_round):
+        """
+        the trained weights are averaged as they arrive, weighted by the numbers of samples of the clients
+        :return: dict of the wall times of the round, train is the slowest worker, aggregate is the accumulation,
+                 restart is the slowest round restart of a client (weight swap and optimizer state), load is the rest
+                 of the time of the clients (restart and shipping), upload_bytes of the weights / updates of the
+                 clients and save_bytes newly written to the store
+        """
+        start = time.perf_counter()
+        averager, buffer_averager = None, None
+        restart_time, save_time, save_bytes = 0, 0, 0
+        worker_train_time, aggregate_time, upload_bytes = {}, 0, 0
+        secure_round = (cur_round, list(self.client_names)) if self.secure_aggregation else None
+        dropped, mask_time, client_train_time = [], 0, 0
+        for name, result in self.train_clients(secure_round):
+            if result is None:
+                dropped.append(name)
+                continue
+            client_train_time += result['train']
+            # the clients of a worker train one after the other
+            worker_idx = self.worker_of_client[name] if self.num_procs > 0 else 0
+            worker_train_time[worker_idx] = worker_train_time.get(worker_idx, 0) + result['train']
+            restart_time = max(restart_time, result['load'])
+            upload_bytes += result['num_bytes']
+            if self.save_clients and 'model_state' in result:
+                stats = self.ckpt_store.save(CLIENT_MODEL_NAME % (name, cur_round), {
+                    'model_state': result['model_state'], 'accumulated_iter': result['accumulated_iter'],
+                    'round': cur_round
+                }, step=cur_round)
+                save_time += stats['time']
+                save_bytes += stats['new_bytes']
+            cur_time = time.perf_counter()
+            if 'masked_update' in result:
+                mask_time += result['mask']
+                averager = SecureAverager() if averager is None else averager
+                averager.add(result['masked_update'])
+                del result
+                aggregate_time += time.perf_counter() - cur_time
+                continue
+            if averager is None:
+                averager = DeltaAverager(self.global_state, logger=self.logger) if 'update' in result \
+                    else StreamingAverager(logger=self.logger)
+            averager.add(result['update'] if 'update' in result else result['model_state'],
+                         weight=result['num_samples'])
+            if 'optimizer_buffers' in result:
+                buffer_averager = StreamingAverager(logger=self.logger) if buffer_averager is None else buffer_averager
+                buffer_averager.add(result['optimizer_buffers'], weight=result['num_samples'])
+            del result
+            aggregate_time += time.perf_counter() - cur_time
+
+        if averager is None:
+            raise RuntimeError('all the clients dropped out of round %d' % cur_round)
+        times = {'train': max(worker_train_time.values())}
+        times['load'] = max(time.perf_counter() - start - times['train'] - aggregate_time - save_time, 0)
+        cur_time = time.perf_counter()
+        if self.secure_aggregation and len(dropped) > 0:
+            self.remove_dropped_masks(averager, cur_round, secure_round[1], dropped)
+        self.global_state = averager.average()
+        if buffer_averager is not None:
+            self.global_optimizer_buffers = buffer_averager.average()
+        times['restart'] = restart_time
+        times['aggregate'] = aggregate_time + time.perf_counter() - cur_time
+
+        cur_time = time.perf_counter()
+        if self.ckpt_store is not None:
+            stats = self.ckpt_store.save(GLOBAL_MODEL_NAME % cur_round,
+                                         {'model_state': self.global_state, 'round': cur_round}, step=cur_round)
+            save_bytes += stats['new_bytes']
+            self.ckpt_store.apply_retention(keep_last=self.keep_last, keep_every=self.keep_every)
+        times['save'] = save_time + time.perf_counter() - cur_time
+        times['total'] = time.perf_counter() - start
+        times['upload_bytes'] = upload_bytes
+        times['save_bytes'] = save_bytes
+        times['dropped'] = len(dropped)
+        self.round_times.append(times)
+
+        secure_msg = ''
+        if self.secure_aggregation:
+            # cpu time of the masking on the clients and of the masked sum, unmasking and decoding here
+            times['secure'] = mask_time + averager.cpu_time
+            secure_msg = ', secure aggregation %.2f s cpu (%.1f%% of the client training)' % (
+                times['secure'], 100 * times['secure'] / max(client_train_time, 1e-9))
+        self.logger.info('round %d: %.2f s (%s), upload %.2f MB, saved %.2f MB%s%s' % (
+            cur_round, times['total'], ', '.join(['%s %.2f s' % (key, times[key]) for key in ROUND_TIME_KEYS]),
+            upload_bytes / 2 ** 20, save_bytes / 2 ** 20, secure_msg,
+            ', dropped out: %s' % ', '.join(dropped) if len(dropped) > 0 else ''
+        ))
+        return times
+
+    def remove_dropped_masks(self, averager, cur_round, peers, dropped):
+        """
+        the clients that sent their masked update reveal their pair seeds with the dropped ones, whose masks are
+        removed from the sum
+        """
+        survivors = [name for name in peers if name not in dropped]
+        seeds = self.call_clients('unmask', {name: (dropped, cur_round) for name in survivors})
+        for name in survivors:
+            averager.remove_masks(name, seeds[name])
+
+    def close(self):
+        for process, conn in self.workers:
+            if process.is_alive():
+                conn.send(('close',))
+            process.join()
+        self.workers = []
@@ -0,0 +1,192 @@
+"""
+Federated evaluation service scoring the global model of each round
+The engine publishes an event per completed round with its global weights, the events go to a pool of evaluation
+worker processes that keep the val split, its voxels and a model resident: a worker loads the weights, runs the KITTI
+evaluation and the AP of the round is appended to a table, while the next rounds train. Nothing polls the checkpoint
+dir as tools/test.py --eval_all does
+"""
+import csv
+import time
+import queue
+import traceback
+import logging
+from pathlib import Path
+import torch
+import torch.multiprocessing as mp
+
+from pcdet.utils import common_utils
+from fed_engine import GlobalModelEvaluator
+
+EVAL_TABLE_NAME = 'fed_eval_rounds.csv'
+EVAL_ROUND_KEYS = ['round', 'worker', 'eval']
+ROUND_TAG = 'round_%d'
+
+
+def eval_worker(worker_idx, event_queue, result_queue, evaluator_kwargs, log_file, num_threads=None):
+    """
+    loop of an evaluation worker, builds its evaluator once and scores the global models of the events
+    :param event_queue: gets (cur_round, global_state) events, None to stop
+    :param result_queue: gets ('ready', worker_idx, None, number of val samples), ('start', worker_idx, cur_round),
+                         ('done', worker_idx, cur_round, ret_dict with the eval time) or
+                         ('error', worker_idx, cur_round, traceback), cur_round is None for the build
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        logger = common_utils.create_logger(log_file)
+        evaluator = GlobalModelEvaluator(logger=logger, **evaluator_kwargs)
+    except Exception:
+        result_queue.put(('error', worker_idx, None, traceback.format_exc()))
+        return
+    result_queue.put(('ready', worker_idx, None, len(evaluator.test_set)))
+
+    while True:
+        event = event_queue.get()
+        if event is None:
+            break
+        cur_round, global_state = event
+        result_queue.put(('start', worker_idx, cur_round))
+        try:
+            start = time.perf_counter()
+            ret_dict = evaluator(global_state, ROUND_TAG % cur_round)
+            ret_dict['eval'] = time.perf_counter() - start
+            result_queue.put(('done', worker_idx, cur_round, ret_dict))
+        except Exception:
+            result_queue.put(('error', worker_idx, cur_round, traceback.format_exc()))
+        del event, global_state
+
+
+class FedEvalService(object):
+    """
+    evaluation worker pool fed by the round completion events of a FedEngine, the rounds are scored in parallel in
+    the order they were published and their metrics appended to output_dir/fed_eval_rounds.csv as they finish
+    each worker holds its own copy of the val split and of its voxels
+    """
+    def __init__(self, evaluator_kwargs, output_dir, num_procs=1, num_threads=None, log_key='Car_3d_moderate',
+                 logger=None):
+        """
+        :param evaluator_kwargs: kwargs of GlobalModelEvaluator but output_dir and logger, e.g. eval_cfg_file,
+                                 root_dir, data_dir and resident_voxels
+        :param output_dir: the table, the logs of the workers and the results of each round (round_<k>/result.pkl)
+        :param num_procs: number of evaluation workers
+        :param num_threads: torch threads of each worker, None for the default
+        :param log_key: metric of ret_dict logged for each round
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.table_file = self.output_dir / EVAL_TABLE_NAME
+        self.log_key = log_key
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        # global states of the rounds published and not evaluated yet, the shared tensors stay alive until then
+        self.pending = {}
+        self.running = {}
+        self.records = {}
+        self.num_val_samples = None
+
+        # spawn, the workers may use CUDA
+        ctx = mp.get_context('spawn')
+        self.event_queue, self.result_queue = ctx.Queue(), ctx.Queue()
+        self.workers = []
+        evaluator_kwargs = dict(evaluator_kwargs, output_dir=self.output_dir)
+        for k in range(num_procs):
+            process = ctx.Process(target=eval_worker, daemon=True, args=(
+                k, self.event_queue, self.result_queue, evaluator_kwargs,
+                self.output_dir / ('log_eval_worker_%d.txt' % k), num_threads
+            ))
+            process.start()
+            self.workers.append(process)
+        self.dead_workers = set()
+
+    def publish(self, cur_round, global_state):
+        """
+        round completion event, returns at once: the round is evaluated by the next idle worker
+        :param global_state: the global weights of the round, not to be modified in place afterwards
+        :return: records of the rounds evaluated since the last call, see collect
+        """
+        assert cur_round not in self.pending, 'round %d already published' % cur_round
+        self.pending[cur_round] = global_state
+        self.event_queue.put((cur_round, global_state))
+        return self.collect()
+
+    def collect(self, timeout=None):
+        """
+        handle the messages of the workers
+        :param timeout: wait up to timeout seconds for the first message, None to not wait
+        :return: {cur_round: ret_dict with the eval time and the worker} of the rounds evaluated since the last call
+        """
+        records = {}
+        while True:
+            try:
+                message = self.result_queue.get(timeout=timeout) if timeout is not None \
+                    else self.result_queue.get_nowait()
+            except queue.Empty:
+                return records
+            timeout = None
+            status, worker_idx, cur_round = message[:3]
+            if status == 'ready':
+                self.num_val_samples = message[3]
+            elif status == 'start':
+                self.running[worker_idx] = cur_round
+            elif status == 'error' and cur_round is None:
+                raise RuntimeError('federated evaluation worker %d failed:\n%s' % (worker_idx, message[3]))
+            elif status == 'error':
+                self.running.pop(worker_idx, None)
+                self.pending.pop(cur_round, None)
+                self.logger.warning('evaluation of round %d failed:\n%s' % (cur_round, message[3]))
+            else:
+                self.running.pop(worker_idx, None)
+                self.pending.pop(cur_round, None)
+                records[cur_round] = dict(message[3], worker=worker_idx)
+                self.add_record(cur_round, records[cur_round])
+
+    def add_record(self, cur_round, record):
+        self.records[cur_round] = record
+        metric_keys = [key for key in record if key not in EVAL_ROUND_KEYS]
+        new_table = not self.table_file.exists() or self.table_file.stat().st_size == 0
+        with open(str(self.table_file), 'a') as f:
+            writer = csv.writer(f)
+            if new_table:
+                writer.writerow(EVAL_ROUND_KEYS + metric_keys)
+            writer.writerow([cur_round, record['worker'], '%.2f' % record['eval']] +
+                            [record[key] for key in metric_keys])
+        self.logger.info('round %d evaluated by worker %d in %.1f s: %s %s, %d rounds pending' % (
+            cur_round, record['worker'], record['eval'], self.log_key, record.get(self.log_key), len(self.pending)
+        ))
+
+    def check_workers(self):
+        """
+        :return: number of live workers, the round of a dead worker is dropped
+        """
+        for k, process in enumerate(self.workers):
+            if k in self.dead_workers or process.is_alive():
+                continue
+            self.dead_workers.add(k)
+            cur_round = self.running.pop(k, None)
+            if cur_round is not None:
+                self.pending.pop(cur_round, None)
+            self.logger.warning('evaluation worker %d died%s' % (
+                k, ', round %d is not evaluated' % cur_round if cur_round is not None else ''))
+        return len(self.workers) - len(self.dead_workers)
+
+    def wait(self):
+        """
+        block until the rounds published are evaluated
+        :return: {cur_round: record} of all the rounds evaluated
+        """
+        while len(self.pending) > 0:
+            self.collect(timeout=1.0)
+            if self.check_workers() == 0 and len(self.pending) > 0:
+                self.logger.warning('no evaluation worker left, rounds %s are not evaluated' % sorted(self.pending))
+                self.pending = {}
+        return self.records
+
+    def close(self):
+        """
+        evaluate the rounds published, then stop the workers
+        """
+        self.wait()
+        for _ in self.workers:
+            self.event_queue.put(None)
+        for process in self.workers:
+            process.join()
+        self.workers = []
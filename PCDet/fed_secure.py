@@ -0,0 +1,177 @@
+"""
+Pairwise masked secure aggregation of the federated rounds
+Each pair of clients agrees on a secret with a Diffie-Hellman exchange relayed by the engine. At each round a client
+encodes its weighted float tensors to 64 bit fixed point and adds a mask drawn from a PRG keyed by the secret of each
+other client of the round, +mask towards a peer with a greater name and -mask towards a smaller one: the masks cancel in
+the sum of the clients (modulo 2 ** 64) and the server only learns the weighted sum. The masks of a client dropping out
+after the round started are removed with the pair seeds the survivors reveal for it
+The server is assumed honest but curious, there are no self masks nor secret shares of the keys as in the full protocol
+of Bonawitz et al. 2017
+"""
+import time
+import hashlib
+import secrets
+import numpy as np
+import torch
+
+# RFC 3526 group 14, 2048 bit MODP
+DH_PRIME = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16
+)
+DH_GENERATOR = 2
+FIXED_POINT_BITS = 24
+# stream of the masks of the weights of a round, other tensors masked in the same round need a distinct PRG key
+WEIGHTS_STREAM = 0
+
+
+def pair_mask(seed, numel):
+    """
+    :param seed: 128 bit key of a pair, round and stream from PairwiseMasker.pair_seed
+    :return: int64 tensor of numel uniform values of the Philox PRG
+    """
+    bit_generator = np.random.Philox(key=int.from_bytes(seed, 'little'))
+    return torch.from_numpy(bit_generator.random_raw(numel).view(np.int64))
+
+
+def add_pair_mask(masked, seed, sign):
+    """
+    add (sign > 0) or subtract the mask of the pair to masked in place, wrapping around modulo 2 ** 64
+    """
+    mask = pair_mask(seed, masked.numel())
+    if sign > 0:
+        masked.add_(mask)
+    else:
+        masked.sub_(mask)
+
+
+class PairwiseMasker(object):
+    """
+    resident on a client with its Diffie-Hellman secret and the secrets shared with the other clients
+    """
+    def __init__(self, name, fixed_point_bits=FIXED_POINT_BITS):
+        """
+        :param fixed_point_bits: fractional bits of the encoding, the weighted values must stay below
+                                 2 ** (63 - fixed_point_bits) / number of clients of the round
+        """
+        self.name = name
+        self.fixed_point_bits = fixed_point_bits
+        self.secret = secrets.randbelow(DH_PRIME - 3) + 2
+        self.public_key = pow(DH_GENERATOR, self.secret, DH_PRIME)
+        self.shared_secrets = {}
+
+    def set_peer_keys(self, public_keys):
+        """
+        :param public_keys: {client name: public key} of all the clients, relayed by the engine
+        """
+        for name, public_key in public_keys.items():
+            if name == self.name:
+                continue
+            if not 1 < public_key < DH_PRIME - 1:
+                raise ValueError('invalid public key of client %s' % name)
+            shared = pow(public_key, self.secret, DH_PRIME)
+            self.shared_secrets[name] = shared.to_bytes((DH_PRIME.bit_length() + 7) // 8, 'big')
+
+    def pair_seed(self, peer, cur_round, stream=WEIGHTS_STREAM):
+        return hashlib.blake2b(self.shared_secrets[peer] + b'%d/%d' % (cur_round, stream), digest_size=16).digest()
+
+    def mask(self, state_dict, weight, peers, cur_round, stream=WEIGHTS_STREAM):
+        """
+        :param state_dict: e.g. the trained model_state of the client
+        :param weight: weight of the client in the average, e.g. its number of samples, applied before the masking
+        :param peers: names of the clients of the round, all of them get the same list
+        :return: masked update: masked (flat int64 of the float tensors), layout [(key, shape, dtype)], raw (the non
+                 float tensors as they are), weight and fixed_point_bits
+        """
+        layout, raw, values = [], {}, []
+        for key, val in state_dict.items():
+            if val.is_floating_point():
+                layout.append((key, tuple(val.shape), val.dtype))
+                values.append(val.detach().cpu().reshape(-1).double())
+            else:
+                raw[key] = val.detach().cpu()
+        scaled = torch.cat(values).mul_(weight * 2 ** self.fixed_point_bits) if len(values) > 0 \
+            else torch.zeros(0, dtype=torch.float64)
+        # the sum over the clients of the round must fit in int64 as well, it would wrap around silently
+        if scaled.numel() > 0 and scaled.abs().max() >= 2 ** 63 // max(len(peers), 1):
+            raise ValueError('weighted values of %s overflow the sum of %d clients with %d fixed point bits' % (
+                self.name, len(peers), self.fixed_point_bits))
+        masked = scaled.round_().long()
+        for peer in peers:
+            if peer != self.name:
+                add_pair_mask(masked, self.pair_seed(peer, cur_round, stream), 1 if self.name < peer else -1)
+        return {'masked': masked, 'layout': layout, 'raw': raw, 'weight': weight,
+                'fixed_point_bits': self.fixed_point_bits}
+
+    def unmask_seeds(self, dropped, cur_round, stream=WEIGHTS_STREAM):
+        """
+        :param dropped: clients of the round whose masked update did not arrive
+        :return: {dropped client: pair seed} to remove the masks this client added for them
+        """
+        return {peer: self.pair_seed(peer, cur_round, stream) for peer in dropped if peer in self.shared_secrets}
+
+
+class SecureAverager(object):
+    """
+    in place sum of the masked updates of a round modulo 2 ** 64, the masks of the clients that dropped out are removed
+    with the seeds of the survivors before the average
+    """
+    def __init__(self):
+        self.sum_masked = None
+        self.layout = None
+        self.raw_state = None
+        self.fixed_point_bits = None
+        self.total_weight = 0
+        self.num_clients = 0
+        self.cpu_time = 0
+
+    def add(self, update):
+        """
+        :param update: from PairwiseMasker.mask
+        """
+        start = time.process_time()
+        if self.sum_masked is None:
+            self.sum_masked = update['masked'].clone()
+            self.layout = update['layout']
+            self.fixed_point_bits = update['fixed_point_bits']
+            # the non float tensors of the first client are kept
+            self.raw_state = update['raw']
+        elif update['layout'] != self.layout or update['fixed_point_bits'] != self.fixed_point_bits:
+            raise ValueError('masked updates with different tensors or encodings, the masks do not cancel')
+        else:
+            self.sum_masked.add_(update['masked'])
+        self.total_weight += update['weight']
+        self.num_clients += 1
+        self.cpu_time += time.process_time() - start
+
+    def remove_masks(self, name, seeds):
+        """
+        :param name: a client whose update was added
+        :param seeds: {dropped client: pair seed} from PairwiseMasker.unmask_seeds of this client
+        """
+        start = time.process_time()
+        for peer, seed in seeds.items():
+            # undo the mask added by the client towards the peer
+            add_pair_mask(self.sum_masked, seed, -1 if name < peer else 1)
+        self.cpu_time += time.process_time() - start
+
+    def average(self):
+        """
+        :return: the average state dict with the dtypes of the clients, the accumulator is released
+        """
+        assert self.sum_masked is not None, 'no masked update to average'
+        start = time.process_time()
+        flat = self.sum_masked.double().div_(2 ** self.fixed_point_bits * self.total_weight)
+        self.sum_masked = None
+        avg_state, offset = {}, 0
+        for key, shape, dtype in self.layout:
+            numel = int(torch.Size(shape).numel())
+            avg_state[key] = flat[offset:offset + numel].view(shape).to(dtype)
+            offset += numel
+        avg_state.update(self.raw_state)
+        self.cpu_time += time.process_time() - start
+        return avg_state
@@ -0,0 +1,231 @@
+"""
+Asynchronous federated aggregation
+The server applies each client update as it arrives and publishes a new global version at once, a slow client does not
+hold back the others. An update trained from an older version is mixed in with a weight decaying with its staleness
+(FedAsync): global = (1 - w) * global + w * client, w = alpha * (staleness + 1) ** -staleness_exponent
+The transport is a duplex multiprocessing connection per client: a pipe between local processes or a local socket
+"""
+import sys
+import time
+import logging
+import threading
+import traceback
+from pathlib import Path
+import torch.multiprocessing as mp
+from multiprocessing import connection as mp_connection
+
+sys.path.append(Path(__file__).resolve().parent.as_posix())  # averaging
+from averaging import StreamingAverager
+from fed_compression import decompress_payload
+from fed_engine import FedClient
+
+TRANSPORTS = ['pipe', 'socket']
+
+
+def staleness_weight(staleness, alpha=0.6, staleness_exponent=0.5):
+    return alpha * (staleness + 1) ** (-staleness_exponent)
+
+
+GLOBAL_VERSION_NAME = 'global/version_%06d'
+
+
+class AsyncAggregationServer(object):
+    def __init__(self, global_state=None, alpha=0.6, staleness_exponent=0.5, max_staleness=None, eval_fn=None,
+                 eval_interval=0, ckpt_store=None, keep_last=None, keep_every=None, logger=None):
+        """
+        :param global_state: initial global model, None to take the first update as it is
+        :param alpha: weight of a fresh update in (0, 1], 1 to replace the global model with it
+        :param max_staleness: updates older than this number of versions are dropped, None to keep all of them
+        :param eval_fn: eval_fn(global_state, version) -> dict of metrics, e.g. a fed_engine.GlobalModelEvaluator
+        :param eval_interval: evaluate every eval_interval versions, 0 for never
+        :param ckpt_store: pcdet.utils.checkpoint_store.CheckpointStore, each global version is saved as
+                           GLOBAL_VERSION_NAME, None to not save it
+        :param keep_last: the keep_last latest versions are kept in the store and the versions multiple of keep_every,
+                          None to keep all of them
+        """
+        assert 0 < alpha <= 1, 'alpha must be in (0, 1], got %s' % alpha
+        self.global_state = global_state
+        self.version = 0
+        self.alpha = alpha
+        self.staleness_exponent = staleness_exponent
+        self.max_staleness = max_staleness
+        self.eval_fn = eval_fn
+        self.eval_interval = eval_interval
+        self.ckpt_store = ckpt_store
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.history = []
+        self.num_dropped = 0
+        self.start_time = None
+
+    def apply_update(self, name, base_version, result):
+        """
+        :param base_version: version of the global model the client trained from
+        :param result: FedClient.train_round result, with the full model_state or a compressed update (its delta is
+                       applied to the current global model, which must be set)
+        :return: the new version, None if the update is dropped
+        """
+        staleness = self.version - base_version
+        if self.max_staleness is not None and staleness > self.max_staleness:
+            self.num_dropped += 1
+            self.logger.info('drop the update of %s, staleness %d' % (name, staleness))
+            return None
+
+        if 'update' in result:
+            if self.global_state is None:
+                raise ValueError('compressed update of %s without a global model to apply it to, the first update '
+                                 'or the initial global_state must be a full model_state' % name)
+            client_state = {key: val + decompress_payload(result['update'][key]).to(val.dtype)
+                            if val.is_floating_point() and key in result['update'] else val
+                            for key, val in self.global_state.items()}
+        else:
+            client_state = result['model_state']
+
+        weight = staleness_weight(staleness, self.alpha, self.staleness_exponent) \
+            if self.global_state is not None else 1.0
+        if weight >= 1:
+            # the update replaces the global model, the averager takes positive weights only
+            self.global_state = client_state
+        else:
+            averager = StreamingAverager(logger=self.logger)
+            averager.add(self.global_state, weight=1 - weight)
+            averager.add(client_state, weight=weight)
+            self.global_state = averager.average()
+        self.version += 1
+
+        record = {'version': self.version, 'time': time.perf_counter() - self.start_time, 'client': name,
+                  'staleness': staleness, 'weight': weight}
+        if self.eval_fn is not None and self.eval_interval > 0 and self.version % self.eval_interval == 0:
+            record['eval'] = self.eval_fn(self.global_state, 'version_%d' % self.version)
+        if self.ckpt_store is not None:
+            self.ckpt_store.save(GLOBAL_VERSION_NAME % self.version,
+                                 {'model_state': self.global_state, 'version': self.version}, step=self.version)
+            self.ckpt_store.apply_retention(keep_last=self.keep_last, keep_every=self.keep_every)
+        self.history.append(record)
+        self.logger.info('version %d from %s: staleness %d, weight %.3f, %.1f updates/min' % (
+            self.version, name, staleness, weight, self.updates_per_min()
+        ))
+        return self.version
+
+    def updates_per_min(self):
+        elapsed = time.perf_counter() - self.start_time
+        return len(self.history) / max(elapsed, 1e-6) * 60
+
+    def reached(self, max_versions=None, max_time=None):
+        elapsed = time.perf_counter() - self.start_time
+        return (max_versions is not None and len(self.history) >= max_versions) or \
+            (max_time is not None and elapsed >= max_time)
+
+    def serve(self, conns, listener=None, max_versions=None, max_time=None):
+        """
+        answer the clients until max_versions or max_time (seconds) is reached, then tell them to stop
+        :param conns: connections of the clients, ('pull', name) gets the latest global model and
+                      ('push', name, base_version, result) applies an update
+        :param listener: mp_connection.Listener, the connections accepted on it are served as well
+        """
+        self.start_time = time.perf_counter() if self.start_time is None else self.start_time
+        conns = list(conns)
+        lock = threading.Lock()
+        if listener is not None:
+            def accept():
+                while True:
+                    try:
+                        conn = listener.accept()
+                    except OSError:
+                        break
+                    with lock:
+                        conns.append(conn)
+            threading.Thread(target=accept, daemon=True).start()
+
+        stopping = False
+        while not stopping or len(conns) > 0:
+            with lock:
+                cur_conns = list(conns)
+            for conn in mp_connection.wait(cur_conns, timeout=0.1):
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    with lock:
+                        conns.remove(conn)
+                    continue
+                if request[0] == 'pull':
+                    conn.send(('stop',) if stopping else ('global', self.version, self.global_state))
+                    if stopping:
+                        conn.close()
+                        with lock:
+                            conns.remove(conn)
+                elif request[0] == 'push':
+                    # the updates pushed once stopping are not applied, max_versions is not exceeded
+                    conn.send(('ack', None if stopping else self.apply_update(*request[1:])))
+                elif request[0] == 'error':
+                    raise RuntimeError('federated client %s failed:\n%s' % (request[1], request[2]))
+                stopping = stopping or self.reached(max_versions, max_time)
+            stopping = stopping or self.reached(max_versions, max_time)
+            if stopping and listener is not None:
+                listener.close()
+                listener = None
+        return self.history
+
+
+def async_client_worker(address, client_class, client_kwargs, authkey=None, delay=0.0):
+    """
+    pull the latest global model, train a round from it and push the update, until the server stops
+    :param address: Connection of a pipe, or address of the socket of the server
+    :param delay: seconds to wait before each push, to simulate a slow vehicle or link
+    """
+    conn = address if isinstance(address, mp_connection.Connection) else mp_connection.Client(address, authkey=authkey)
+    name = client_kwargs.get('cfg_file', '')
+    try:
+        client = client_class(**client_kwargs)
+        name = client.name
+        while True:
+            conn.send(('pull', name))
+            reply = conn.recv()
+            if reply[0] == 'stop':
+                break
+            _, version, global_state = reply
+            result = client.train_round(global_state)
+            del global_state
+            if delay > 0:
+                time.sleep(delay)
+            conn.send(('push', name, version, result))
+            conn.recv()
+    except Exception:
+        conn.send(('error', name, traceback.format_exc()))
+    conn.close()
+
+
+def run_async(client_kwargs_list, server, client_class=FedClient, transport='pipe', client_delays=None,
+              max_versions=None, max_time=None, authkey=b'pcdet-fed'):
+    """
+    spawn a process per client and serve them until max_versions or max_time
+    :param server: AsyncAggregationServer
+    :param client_delays: seconds of delay of each client, None for no delay
+    :return: server.history
+    """
+    assert transport in TRANSPORTS, 'unknown transport %s' % transport
+    ctx = mp.get_context('spawn')
+    client_delays = [0.0] * len(client_kwargs_list) if client_delays is None else client_delays
+    conns, listener, processes = [], None, []
+    if transport == 'socket':
+        listener = mp_connection.Listener(('localhost', 0), authkey=authkey)
+    for client_kwargs, delay in zip(client_kwargs_list, client_delays):
+        if transport == 'pipe':
+            conn, address = ctx.Pipe()
+            conns.append(conn)
+        else:
+            address = listener.address
+        process = ctx.Process(target=async_client_worker, daemon=True,
+                              args=(address, client_class, client_kwargs, authkey, delay))
+        process.start()
+        processes.append(process)
+
+    try:
+        server.serve(conns, listener=listener, max_versions=max_versions, max_time=max_time)
+    finally:
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+    return server.history
@@ -0,0 +1,313 @@
+#! /usr/bin/env python3
+"""
+Federated simulation of the ego vehicles of a recording
+Each vehicle dir of the recording with KITTI infos is a virtual client. The clients sampled for a round are trained
+over a fixed pool of worker processes, each worker holds one model and optimizer and switches between the data of the
+clients it gets. The lidar points of the recording are decoded once into shared memory for all the workers
+"""
+import sys
+import csv
+import time
+import argparse
+import traceback
+import logging
+import datetime
+from pathlib import Path
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from multiprocessing import connection as mp_connection
+
+sys.path.append(Path(__file__).resolve().parent.as_posix())  # averaging
+sys.path.append((Path(__file__).resolve().parent / 'tools').as_posix())  # train_utils
+from pcdet.config import cfg
+from pcdet.datasets.shared_points import SharedPointStore
+from pcdet.utils import common_utils
+from train_utils.optimization import build_scheduler
+from train_utils.train_utils import model_state_to_cpu
+from averaging import StreamingAverager
+from fed_engine import FedClient, FedEngine, GlobalModelEvaluator, set_vehicle_data, GLOBAL_MODEL_NAME
+from pcdet.utils.checkpoint_store import CheckpointStore
+
+cfg_folder = Path(__file__, '..', 'tools', 'cfgs').resolve()
+SIM_ROUND_KEYS = ['round', 'num_clients', 'total', 'train', 'aggregate', 'eval', 'ap']
+
+
+def find_vehicle_dirs(record_dir, root_dir=None):
+    """
+    :param record_dir: recording with a KITTI data dir per ego vehicle, relative to root_dir (cfg.ROOT_DIR) as the
+                       DATA_DIR of the configs, e.g. data/record2020_1027_1957
+    :return: sorted data dirs of the vehicles with a kitti_infos_train.pkl, relative as record_dir
+    """
+    root_dir = Path(root_dir) if root_dir is not None else cfg.ROOT_DIR
+    vehicle_dirs = sorted([x for x in (root_dir / record_dir).iterdir() if (x / 'kitti_infos_train.pkl').exists()])
+    return [(Path(record_dir) / x.name).as_posix() for x in vehicle_dirs]
+
+
+class SimTrainer(FedClient):
+    """
+    model, optimizer and lr schedulers of a simulation worker, shared by the clients it trains
+    a client is the data of its vehicle, built at its first round on this worker and kept, and its accumulated
+    iterations, the optimizer state is reset for each client and the lr cycle restarts at each round of a client
+    """
+    def __init__(self, cfg_file, data_dir, batch_size=1, epochs=1, max_samples=None, point_store=None,
+                 root_dir=None):
+        """
+        :param max_samples: training samples of a client, None for all of them
+        """
+        self.batch_size = batch_size
+        self.max_samples = max_samples
+        super().__init__(cfg_file, batch_size=batch_size, epochs=epochs, root_dir=root_dir, optimizer_state='reset',
+                         data_dir=data_dir, point_store=point_store)
+        self.loaders = {self.name: (self.train_set, self.train_loader)}
+
+    def build_dataloader(self, batch_size, workers):
+        train_set, train_loader = super().build_dataloader(batch_size, workers)
+        if self.max_samples is not None:
+            train_set.kitti_infos = train_set.kitti_infos[:self.max_samples]
+        return train_set, train_loader
+
+    def switch_client(self, data_dir, accumulated_iter):
+        cfg.update(self.cfg)
+        self.name = Path(data_dir).name
+        if self.name not in self.loaders:
+            set_vehicle_data(data_dir)
+            self.loaders[self.name] = self.build_dataloader(self.batch_size, 0)
+        self.train_set, self.train_loader = self.loaders[self.name]
+        self.accumulated_iter = accumulated_iter
+        # one round of the client, train_round steps it with the iterations of the round, not accumulated_iter
+        self.lr_scheduler, self.lr_warmup_scheduler = build_scheduler(
+            self.optimizer, total_iters_each_epoch=len(self.train_loader), total_epochs=self.epochs, last_epoch=1,
+            optim_cfg=self.optim_cfg
+        )
+
+    def train_client(self, data_dir, accumulated_iter, global_state):
+        self.switch_client(data_dir, accumulated_iter)
+        return self.train_round(global_state)
+
+
+def sim_worker(conn, trainer_class, trainer_kwargs, num_threads=None):
+    """
+    loop of a simulation worker, the trainer is built at the first request
+    :param conn: end of the pipe to the simulation, gets ('init', data_dir) for the initial model_state,
+                 ('train', data_dir, accumulated_iter, global_state) or ('close',)
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    trainer = None
+    while True:
+        request = conn.recv()
+        if request[0] == 'close':
+            break
+        try:
+            if trainer is None:
+                trainer = trainer_class(data_dir=request[1], **trainer_kwargs)
+            if request[0] == 'init':
+                conn.send(('done', model_state_to_cpu(trainer.model.state_dict())))
+            else:
+                conn.send(('done', trainer.train_client(*request[1:])))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class FedSimulation(object):
+    """
+    synchronous rounds of a sample of the virtual clients, the clients go to the workers as they get idle and the
+    global model is the average of the trained weights weighted by the numbers of samples
+    """
+    def __init__(self, data_dirs, trainer_kwargs, num_procs=2, num_threads=None, clients_per_round=None,
+                 trainer_class=SimTrainer, eval_fn=None, eval_interval=1, output_dir=None, keep_last=None, seed=0,
+                 logger=None):
+        """
+        :param data_dirs: data dir of each client, e.g. from find_vehicle_dirs
+        :param trainer_kwargs: kwargs of trainer_class but the data_dir
+        :param num_procs: size of the worker pool, 0 to train the clients in this process
+        :param num_threads: torch threads of each worker, None for the default
+        :param clients_per_round: clients sampled at each round, None for all of them
+        :param eval_fn: eval_fn(global_state, tag) -> ret_dict of eval_one_epoch, e.g. a GlobalModelEvaluator
+        :param output_dir: the table of the rounds (fed_sim_rounds.csv) is written there and the global model of each
+                           round to the CheckpointStore output_dir/ckpt
+        :param keep_last: global models kept in the store, None for all of them
+        """
+        self.data_dirs = {Path(data_dir).name: data_dir for data_dir in data_dirs}
+        self.client_names = list(self.data_dirs.keys())
+        self.accumulated_iters = {name: 0 for name in self.client_names}
+        self.clients_per_round = clients_per_round
+        self.eval_fn = eval_fn
+        self.eval_interval = eval_interval
+        self.output_dir = Path(output_dir) if output_dir is not None else None
+        self.ckpt_store = CheckpointStore(self.output_dir / 'ckpt') if output_dir is not None else None
+        self.keep_last = keep_last
+        self.seed = seed
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.history = []
+        self.num_procs = min(num_procs, len(self.client_names))
+
+        self.trainer, self.workers = None, []
+        if self.num_procs == 0:
+            self.trainer = trainer_class(data_dir=data_dirs[0], **trainer_kwargs)
+            # a copy, the trainer updates its weights in place
+            self.global_state = {key: val.clone() for key, val in
+                                 model_state_to_cpu(self.trainer.model.state_dict()).items()}
+        else:
+            ctx = mp.get_context('spawn')
+            for k in range(self.num_procs):
+                conn, worker_conn = ctx.Pipe()
+                process = ctx.Process(target=sim_worker, daemon=True,
+                                      args=(worker_conn, trainer_class, trainer_kwargs, num_threads))
+                process.start()
+                self.workers.append((process, conn))
+            # the first worker builds its trainer for the initial global model, the others at their first client
+            self.workers[0][1].send(('init', data_dirs[0]))
+            self.global_state = FedEngine._recv(self.workers[0][1])
+
+        if self.output_dir is not None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            with open(str(self.output_dir / 'fed_sim_rounds.csv'), 'w') as f:
+                csv.writer(f).writerow(SIM_ROUND_KEYS)
+
+    def sample_clients(self, cur_round):
+        if self.clients_per_round is None or self.clients_per_round >= len(self.client_names):
+            return list(self.client_names)
+        rng = np.random.RandomState(self.seed + cur_round)
+        return [self.client_names[k] for k in sorted(rng.choice(len(self.client_names), self.clients_per_round,
+                                                                replace=False))]
+
+    def train_clients(self, names):
+        """
+        :return: generator of (name, train_round result) of the clients in the order they finish
+        """
+        if self.num_procs == 0:
+            for name in names:
+                yield name, self.trainer.train_client(self.data_dirs[name], self.accumulated_iters[name],
+                                                      self.global_state)
+            return
+
+        queue, busy = list(names), {}
+
+        def send_next(conn):
+            name = queue.pop(0)
+            conn.send(('train', self.data_dirs[name], self.accumulated_iters[name], self.global_state))
+            busy[conn] = name
+
+        for _, conn in self.workers:
+            if len(queue) > 0:
+                send_next(conn)
+        while len(busy) > 0:
+            for conn in mp_connection.wait(list(busy.keys())):
+                name = busy.pop(conn)
+                result = FedEngine._recv(conn)
+                if len(queue) > 0:
+                    send_next(conn)
+                yield name, result
+
+    def run_round(self, cur_round):
+        """
+        :return: record of the round: sampled clients, wall times (train is the sum over the clients), AP if evaluated
+        """
+        start = time.perf_counter()
+        names = self.sample_clients(cur_round)
+        averager = StreamingAverager(logger=self.logger)
+        train_time, aggregate_time = 0, 0
+        for name, result in self.train_clients(names):
+            self.accumulated_iters[name] = result['accumulated_iter']
+            train_time += result['train']
+            cur_time = time.perf_counter()
+            averager.add(result['model_state'], weight=result['num_samples'])
+            del result
+            aggregate_time += time.perf_counter() - cur_time
+        cur_time = time.perf_counter()
+        self.global_state = averager.average()
+        aggregate_time += time.perf_counter() - cur_time
+        record = {'round': cur_round, 'num_clients': len(names), 'train': train_time, 'aggregate': aggregate_time,
+                  'total': time.perf_counter() - start, 'eval': None, 'ap': None}
+
+        if self.eval_fn is not None and self.eval_interval > 0 and (cur_round + 1) % self.eval_interval == 0:
+            cur_time = time.perf_counter()
+            record['ap'] = self.eval_fn(self.global_state, 'round_%d' % cur_round).get('Car_3d_moderate')
+            record['eval'] = time.perf_counter() - cur_time
+        if self.output_dir is not None:
+            self.ckpt_store.save(GLOBAL_MODEL_NAME % cur_round, {'model_state': self.global_state, 'round': cur_round},
+                                 step=cur_round)
+            self.ckpt_store.apply_retention(keep_last=self.keep_last)
+            with open(str(self.output_dir / 'fed_sim_rounds.csv'), 'a') as f:
+                csv.writer(f).writerow([record[key] for key in SIM_ROUND_KEYS])
+        self.history.append(record)
+        self.logger.info('round %d: %d clients in %.2f s (client train %.2f s, aggregate %.2f s)%s' % (
+            cur_round, len(names), record['total'], train_time, aggregate_time,
+            ', Car_3d_moderate %.2f' % record['ap'] if record['ap'] is not None else ''
+        ))
+        return record
+
+    def close(self):
+        for process, conn in self.workers:
+            conn.send(('close',))
+            process.join()
+        self.workers = []
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='federated simulation of the ego vehicles of a recording')
+    parser.add_argument('--record', type=str, required=True,
+                        help='recording with a KITTI data dir per vehicle, relative to --root_dir, '
+                             'e.g. data/record2020_1027_1957')
+    parser.add_argument('--cfg_file', type=str, default='fed_sim_pointpillar.yaml',
+                        help='config of all the clients, relative to tools/cfgs, its data paths are replaced')
+    parser.add_argument('--root_dir', type=str, default=None, help='root of the data paths, PCDet by default')
+    parser.add_argument('--num_clients', type=int, default=None, help='first vehicles of the recording only')
+    parser.add_argument('--clients_per_round', type=int, default=None, help='clients sampled at each round')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--num_procs', type=int, default=2, help='size of the worker pool, 0 to run in this process')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch threads of each worker')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--epochs', type=int, default=1, help='epochs of a client in each round')
+    parser.add_argument('--max_samples', type=int, default=None, help='training samples of each client')
+    parser.add_argument('--no_shared_points', action='store_true', default=False,
+                        help='read the velodyne files in each worker instead of the shared memory')
+    parser.add_argument('--eval_interval', type=int, default=1, help='evaluate every eval_interval rounds, 0 for never')
+    parser.add_argument('--eval_client', type=int, default=0, help='the val split of this client is evaluated')
+    parser.add_argument('--output_dir', type=str, default=None, help='PCDet/output/fed_sim/<record> by default')
+    parser.add_argument('--keep_rounds', type=int, default=None, help='global models kept, all of them by default')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    root_dir = Path(args.root_dir).resolve() if args.root_dir is not None else cfg.ROOT_DIR
+    output_dir = Path(args.output_dir) if args.output_dir is not None else \
+        Path(__file__).resolve().parent / 'output' / 'fed_sim' / Path(args.record).name
+    output_dir.mkdir(parents=True, exist_ok=True)
+    log_file = output_dir / ('log_fed_sim_%s.txt' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    logger = common_utils.create_logger(log_file)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    data_dirs = find_vehicle_dirs(args.record, root_dir)[:args.num_clients]
+    logger.info('%d clients: %s' % (len(data_dirs), ', '.join([Path(x).name for x in data_dirs])))
+    point_store = None
+    if not args.no_shared_points:
+        point_store = SharedPointStore.create([root_dir / x for x in data_dirs], logger=logger)
+
+    cfg_file = (cfg_folder / args.cfg_file).as_posix()
+    eval_fn = None
+    if args.eval_interval > 0:
+        eval_fn = GlobalModelEvaluator(cfg_file, output_dir / 'eval', logger=logger, root_dir=root_dir,
+                                       data_dir=data_dirs[args.eval_client], point_store=point_store)
+    trainer_kwargs = {'cfg_file': cfg_file, 'batch_size': args.batch_size, 'epochs': args.epochs,
+                      'max_samples': args.max_samples, 'point_store': point_store, 'root_dir': root_dir}
+    sim = FedSimulation(data_dirs, trainer_kwargs, num_procs=args.num_procs, num_threads=args.num_threads,
+                        clients_per_round=args.clients_per_round, eval_fn=eval_fn, eval_interval=args.eval_interval,
+                        output_dir=output_dir, keep_last=args.keep_rounds, seed=args.seed, logger=logger)
+    try:
+        for cur_round in range(args.rounds):
+            sim.run_round(cur_round)
+    finally:
+        sim.close()
+        if point_store is not None:
+            point_store.release()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 import os
+from functools import partial
 from pathlib import Path
 import torch
 from torch.utils.data import DataLoader
 from ..config import cfg
 from .dataset import DatasetTemplate
+from .collate_buffers import CollateBuffers
 from .kitti.kitti_dataset import BaseKittiDataset, KittiDataset
 
 __all__ = {
@@ -24,9 +26,16 @@ def build_dataloader(data_dir, batch_size, dist, workers=4, logger=None, trainin
     )
 
     sampler = torch.utils.data.distributed.DistributedSampler(dataset) if dist else None
+    if workers == 0:
+        # collate in the main process straight into reusable pinned buffers, no extra pinning copy is needed
+        collate_fn = partial(dataset.collate_batch, buffers=CollateBuffers(pin_memory=True))
+        pin_memory = False
+    else:
+        collate_fn = dataset.collate_batch
+        pin_memory = True
     dataloader = DataLoader(
-        dataset, batch_size=batch_size, pin_memory=True, num_workers=workers,
-        shuffle=(sampler is None) and training, collate_fn=dataset.collate_batch,
+        dataset, batch_size=batch_size, pin_memory=pin_memory, num_workers=workers,
+        shuffle=(sampler is None) and training, collate_fn=collate_fn,
         drop_last=False, sampler=sampler, timeout=0
     )
     return dataset, dataloader, sampler
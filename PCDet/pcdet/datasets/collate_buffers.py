@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+
+class CollateBuffers(object):
+    """
+    Reusable host buffers for DatasetTemplate.collate_batch, the batch arrays are written straight into them
+    The buffers are kept in a ring of num_slots slots, so a batch stays valid while the next num_slots - 1 batches
+    are collated. With pin_memory the buffers are page-locked and can be copied to GPU with non_blocking=True
+    Only use it when collate_batch runs in the main process (num_workers=0)
+    """
+    GROW_RATIO = 1.25
+
+    def __init__(self, num_slots=2, pin_memory=False):
+        self.num_slots = num_slots
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.slots = [{} for _ in range(num_slots)]
+        self.events = [None] * num_slots
+        self.cur_slot = -1
+
+    def next_slot(self):
+        """
+        move to the next slot, waits for the transfers issued from the batch that last used this slot
+        """
+        if self.cur_slot >= 0 and self.pin_memory:
+            # all the copies of the previous batch are enqueued on the current stream before the next collate
+            event = torch.cuda.Event()
+            event.record()
+            self.events[self.cur_slot] = event
+        self.cur_slot = (self.cur_slot + 1) % self.num_slots
+        if self.events[self.cur_slot] is not None:
+            self.events[self.cur_slot].synchronize()
+            self.events[self.cur_slot] = None
+
+    def empty(self, key, shape, dtype):
+        """
+        :param key: name of the batch array
+        :param shape: shape of the batch array
+        :param dtype: numpy dtype
+        :return: numpy array of the given shape, sharing memory with the buffer of the current slot
+        """
+        dtype = np.dtype(dtype)
+        num_elems = int(np.prod(shape))
+        buffers = self.slots[self.cur_slot]
+        buf = buffers.get(key, None)
+        if buf is None or buf.dtype != dtype or buf.size < num_elems:
+            capacity = max(int(num_elems * self.GROW_RATIO), 1)
+            buf_torch = torch.from_numpy(np.empty(0, dtype=dtype)).new_empty(capacity, pin_memory=self.pin_memory)
+            buf = buf_torch.numpy()
+            buffers[key] = buf
+        return buf[:num_elems].reshape(shape)
@@ -13,6 +13,8 @@ try:
 except:
     pass
 
+CELL_KEY_STRIDE = 1 << 32
+
 
 @numba.njit
 def corner_to_standup_nd_jit(boxes_corner):
@@ -27,16 +29,74 @@ def corner_to_standup_nd_jit(boxes_corner):
     return result
 
 
+@numba.njit
+def _box_pair_collision_jit(box, qbox, clockwise=True):
+    """
+    :param box: (4, 2) BEV corners
+    :param qbox: (4, 2) BEV corners
+    :return: whether the two boxes collide, edges crossing or one box containing the other
+    """
+    for k in range(4):
+        for l in range(4):
+            A = box[k]
+            B = box[(k + 1) % 4]
+            C = qbox[l]
+            D = qbox[(l + 1) % 4]
+            acd = (D[1] - A[1]) * (C[0] - A[0]) > (
+                C[1] - A[1]) * (D[0] - A[0])
+            bcd = (D[1] - B[1]) * (C[0] - B[0]) > (
+                C[1] - B[1]) * (D[0] - B[0])
+            if acd != bcd:
+                abc = (C[1] - A[1]) * (B[0] - A[0]) > (
+                    B[1] - A[1]) * (C[0] - A[0])
+                abd = (D[1] - A[1]) * (B[0] - A[0]) > (
+                    B[1] - A[1]) * (D[0] - A[0])
+                if abc != abd:
+                    return True  # collision.
+
+    # now check complete overlap.
+    # box overlap qbox:
+    box_overlap_qbox = True
+    for l in range(4):  # point l in qboxes
+        for k in range(4):  # corner k in boxes
+            vec = box[k] - box[(k + 1) % 4]
+            if clockwise:
+                vec = -vec
+            cross = vec[1] * (
+                box[k, 0] - qbox[l, 0])
+            cross -= vec[0] * (
+                box[k, 1] - qbox[l, 1])
+            if cross >= 0:
+                box_overlap_qbox = False
+                break
+        if box_overlap_qbox is False:
+            break
+    if box_overlap_qbox:
+        return True  # collision.
+
+    qbox_overlap_box = True
+    for l in range(4):  # point l in boxes
+        for k in range(4):  # corner k in qboxes
+            vec = qbox[k] - qbox[(k + 1) % 4]
+            if clockwise:
+                vec = -vec
+            cross = vec[1] * (
+                qbox[k, 0] - box[l, 0])
+            cross -= vec[0] * (
+                qbox[k, 1] - box[l, 1])
+            if cross >= 0:  #
+                qbox_overlap_box = False
+                break
+        if qbox_overlap_box is False:
+            break
+    return qbox_overlap_box
+
+
 @numba.jit(nopython=True)
 def box_collision_test(boxes, qboxes, clockwise=True):
     N = boxes.shape[0]
     K = qboxes.shape[0]
     ret = np.zeros((N, K), dtype=np.bool_)
-    slices = np.array([1, 2, 3, 0])
-    lines_boxes = np.stack(
-        (boxes, boxes[:, slices, :]), axis=2)  # [N, 4, 2(line), 2(xy)]
-    lines_qboxes = np.stack((qboxes, qboxes[:, slices, :]), axis=2)
-    # vec = np.zeros((2,), dtype=boxes.dtype)
     boxes_standup = corner_to_standup_nd_jit(boxes)
     qboxes_standup = corner_to_standup_nd_jit(qboxes)
     for i in range(N):
@@ -48,65 +108,70 @@ def box_collision_test(boxes, qboxes, clockwise=True):
                 ih = (min(boxes_standup[i, 3], qboxes_standup[j, 3]) - max(
                     boxes_standup[i, 1], qboxes_standup[j, 1]))
                 if ih > 0:
-                    for k in range(4):
-                        for l in range(4):
-                            A = lines_boxes[i, k, 0]
-                            B = lines_boxes[i, k, 1]
-                            C = lines_qboxes[j, l, 0]
-                            D = lines_qboxes[j, l, 1]
-                            acd = (D[1] - A[1]) * (C[0] - A[0]) > (
-                                C[1] - A[1]) * (D[0] - A[0])
-                            bcd = (D[1] - B[1]) * (C[0] - B[0]) > (
-                                C[1] - B[1]) * (D[0] - B[0])
-                            if acd != bcd:
-                                abc = (C[1] - A[1]) * (B[0] - A[0]) > (
-                                    B[1] - A[1]) * (C[0] - A[0])
-                                abd = (D[1] - A[1]) * (B[0] - A[0]) > (
-                                    B[1] - A[1]) * (D[0] - A[0])
-                                if abc != abd:
-                                    ret[i, j] = True  # collision.
-                                    break
-                        if ret[i, j] is True:
+                    ret[i, j] = _box_pair_collision_jit(boxes[i], qboxes[j], clockwise)
+    return ret
+
+
+@numba.njit
+def box_cell_entries_jit(cell_min, cell_max, id_offset):
+    """
+    :param cell_min: (N, 2) first grid cell covered by each standup box
+    :param cell_max: (N, 2) last grid cell covered by each standup box
+    :return: cell keys and box ids of every (cell, box) entry
+    """
+    num_entries = 0
+    for i in range(cell_min.shape[0]):
+        num_entries += (cell_max[i, 0] - cell_min[i, 0] + 1) * (cell_max[i, 1] - cell_min[i, 1] + 1)
+    keys = np.zeros(num_entries, dtype=np.int64)
+    box_ids = np.zeros(num_entries, dtype=np.int64)
+    cnt = 0
+    for i in range(cell_min.shape[0]):
+        for ix in range(cell_min[i, 0], cell_max[i, 0] + 1):
+            for iy in range(cell_min[i, 1], cell_max[i, 1] + 1):
+                keys[cnt] = ix * CELL_KEY_STRIDE + iy
+                box_ids[cnt] = i + id_offset
+                cnt += 1
+    return keys, box_ids
+
+
+@numba.njit
+def box_collision_test_indexed(qboxes, qboxes_standup, qcell_min, qcell_max,
+                               boxes, boxes_standup, cell_keys, cell_box_ids, clockwise=True):
+    """
+    Same collision rule as box_collision_test(qboxes, boxes).any(axis=1), but only the boxes
+    sharing a grid cell with the query are tested
+    :param qboxes: (K, 4, 2) query BEV corners
+    :param qboxes_standup: (K, 4)
+    :param qcell_min: (K, 2)
+    :param qcell_max: (K, 2)
+    :param boxes: (N, 4, 2) indexed BEV corners
+    :param boxes_standup: (N, 4)
+    :param cell_keys: (M) sorted cell keys of the index
+    :param cell_box_ids: (M) box id of each cell key
+    :return: (K) bool
+    """
+    K = qboxes.shape[0]
+    ret = np.zeros(K, dtype=np.bool_)
+    for i in range(K):
+        for ix in range(qcell_min[i, 0], qcell_max[i, 0] + 1):
+            for iy in range(qcell_min[i, 1], qcell_max[i, 1] + 1):
+                key = ix * CELL_KEY_STRIDE + iy
+                lo = np.searchsorted(cell_keys, key, side='left')
+                hi = np.searchsorted(cell_keys, key, side='right')
+                for t in range(lo, hi):
+                    j = cell_box_ids[t]
+                    iw = (min(qboxes_standup[i, 2], boxes_standup[j, 2]) - max(
+                        qboxes_standup[i, 0], boxes_standup[j, 0]))
+                    if iw > 0:
+                        ih = (min(qboxes_standup[i, 3], boxes_standup[j, 3]) - max(
+                            qboxes_standup[i, 1], boxes_standup[j, 1]))
+                        if ih > 0 and _box_pair_collision_jit(qboxes[i], boxes[j], clockwise):
+                            ret[i] = True
                             break
-                    if ret[i, j] is False:
-                        # now check complete overlap.
-                        # box overlap qbox:
-                        box_overlap_qbox = True
-                        for l in range(4):  # point l in qboxes
-                            for k in range(4):  # corner k in boxes
-                                vec = boxes[i, k] - boxes[i, (k + 1) % 4]
-                                if clockwise:
-                                    vec = -vec
-                                cross = vec[1] * (
-                                    boxes[i, k, 0] - qboxes[j, l, 0])
-                                cross -= vec[0] * (
-                                    boxes[i, k, 1] - qboxes[j, l, 1])
-                                if cross >= 0:
-                                    box_overlap_qbox = False
-                                    break
-                            if box_overlap_qbox is False:
-                                break
-
-                        if box_overlap_qbox is False:
-                            qbox_overlap_box = True
-                            for l in range(4):  # point l in boxes
-                                for k in range(4):  # corner k in qboxes
-                                    vec = qboxes[j, k] - qboxes[j, (k + 1) % 4]
-                                    if clockwise:
-                                        vec = -vec
-                                    cross = vec[1] * (
-                                        qboxes[j, k, 0] - boxes[i, l, 0])
-                                    cross -= vec[0] * (
-                                        qboxes[j, k, 1] - boxes[i, l, 1])
-                                    if cross >= 0:  #
-                                        qbox_overlap_box = False
-                                        break
-                                if qbox_overlap_box is False:
-                                    break
-                            if qbox_overlap_box:
-                                ret[i, j] = True  # collision.
-                        else:
-                            ret[i, j] = True  # collision.
+                if ret[i]:
+                    break
+            if ret[i]:
+                break
     return ret
 
 
@@ -308,3 +373,80 @@ def global_scaling(gt_boxes, points, min_scale=0.95, max_scale=1.05):
     gt_boxes[:, :6] *= noise_scale
     return gt_boxes, points
 
+
+
+def sample_global_transform(flip_probability=0.5, rotation=np.pi / 4, min_scale=0.95, max_scale=1.05):
+    """
+    Draw the flip, rotation and scale noise in the same order as random_flip, global_rotation and global_scaling
+    :return:
+        transform: (4, 4) homogeneous transform applied to column vectors, scale @ rotation @ flip
+        enable_flip: bool
+        noise_rotation: float
+        noise_scale: float
+    """
+    enable_flip = np.random.choice(
+        [False, True], replace=False, p=[1 - flip_probability, flip_probability])
+    if not isinstance(rotation, list):
+        rotation = [-rotation, rotation]
+    noise_rotation = np.random.uniform(rotation[0], rotation[1])
+    noise_scale = np.random.uniform(min_scale, max_scale) if max_scale - min_scale >= 1e-3 else 1.0
+
+    cosa, sina = np.cos(noise_rotation), np.sin(noise_rotation)
+    flip = np.diag([1.0, -1.0 if enable_flip else 1.0, 1.0, 1.0])
+    rot = np.array([[cosa, sina, 0, 0],
+                    [-sina, cosa, 0, 0],
+                    [0, 0, 1, 0],
+                    [0, 0, 0, 1]], dtype=np.float64)  # same direction as common_utils.rotate_pc_along_z
+    scale = np.diag([noise_scale, noise_scale, noise_scale, 1.0])
+    transform = scale @ rot @ flip
+    return transform, enable_flip, noise_rotation, noise_scale
+
+
+@numba.njit
+def transform_points_with_range_mask_(points, transform, limit_range):
+    """
+    Transform the xyz of the points in place and mask them by range in the same pass
+    :param points: (N, 3 + C)
+    :param transform: (4, 4)
+    :param limit_range: (6) [minx, miny, minz, maxx, maxy, maxz] with the dtype of points, only xy are used
+    :return: (N) bool, points inside the xy range after the transform
+    """
+    num_points = points.shape[0]
+    mask = np.zeros(num_points, dtype=np.bool_)
+    for i in range(num_points):
+        x = points[i, 0]
+        y = points[i, 1]
+        z = points[i, 2]
+        points[i, 0] = transform[0, 0] * x + transform[0, 1] * y + transform[0, 2] * z + transform[0, 3]
+        points[i, 1] = transform[1, 0] * x + transform[1, 1] * y + transform[1, 2] * z + transform[1, 3]
+        points[i, 2] = transform[2, 0] * x + transform[2, 1] * y + transform[2, 2] * z + transform[2, 3]
+        mask[i] = (points[i, 0] >= limit_range[0]) and (points[i, 0] <= limit_range[3]) \
+            and (points[i, 1] >= limit_range[1]) and (points[i, 1] <= limit_range[4])
+    return mask
+
+
+def global_augmentation_fused_(gt_boxes, points, rotation=np.pi / 4, min_scale=0.95, max_scale=1.05,
+                               limit_range=None):
+    """
+    random_flip, global_rotation and global_scaling composed into one transform, applied in place
+    with a single pass over the points, which also produces the mask of mask_points_by_range
+    :param gt_boxes: (N, 7) [x, y, z, w, l, h, rz] in LiDAR coordinate
+    :param points: (M, 3 + C)
+    :param limit_range: [minx, miny, minz, maxx, maxy, maxz] or None
+    :return:
+        gt_boxes, points: transformed in place
+        points_mask: (M) bool or None, points inside limit_range
+    """
+    transform, enable_flip, noise_rotation, noise_scale = sample_global_transform(
+        rotation=rotation, min_scale=min_scale, max_scale=max_scale
+    )
+    range_array = np.array(limit_range if limit_range is not None else [-np.inf] * 3 + [np.inf] * 3,
+                           dtype=points.dtype)
+    points_mask = transform_points_with_range_mask_(points, transform, range_array)
+
+    gt_boxes[:, 0:3] = gt_boxes[:, 0:3] @ transform[0:3, 0:3].T
+    gt_boxes[:, 3:6] *= noise_scale
+    if enable_flip:
+        gt_boxes[:, 6] = -gt_boxes[:, 6] + np.pi
+    gt_boxes[:, 6] += noise_rotation
+    return gt_boxes, points, points_mask if limit_range is not None else None
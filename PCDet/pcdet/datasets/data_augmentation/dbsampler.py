@@ -40,6 +40,57 @@ class BatchSampler:
         return [self._sampled_list[i] for i in indices]
 
 
+class BEVCollisionIndex(object):
+    """
+    Incremental BEV grid over the standup rectangles of the boxes to avoid,
+    candidates only run the exact collision test against boxes sharing a cell
+    """
+    def __init__(self, cell_size=4.0):
+        self.cell_size = cell_size
+        self.corners = np.zeros((0, 4, 2), dtype=np.float32)
+        self.standup = np.zeros((0, 4), dtype=np.float32)
+        self.cell_keys = np.zeros(0, dtype=np.int64)
+        self.cell_box_ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.corners.shape[0]
+
+    def _cell_range(self, standup):
+        cell_min = np.floor(standup[:, 0:2] / self.cell_size).astype(np.int64)
+        cell_max = np.floor(standup[:, 2:4] / self.cell_size).astype(np.int64)
+        return cell_min, cell_max
+
+    def insert(self, boxes_bv):
+        """
+        :param boxes_bv: (N, 4, 2) BEV corners of the boxes to add
+        """
+        if boxes_bv.shape[0] == 0:
+            return
+        standup = augmentation_utils.corner_to_standup_nd_jit(boxes_bv)
+        cell_min, cell_max = self._cell_range(standup)
+        keys, box_ids = augmentation_utils.box_cell_entries_jit(cell_min, cell_max, self.corners.shape[0])
+
+        keys = np.concatenate([self.cell_keys, keys])
+        box_ids = np.concatenate([self.cell_box_ids, box_ids])
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys, self.cell_box_ids = keys[order], box_ids[order]
+        self.corners = np.concatenate([self.corners, boxes_bv], axis=0)
+        self.standup = np.concatenate([self.standup, standup], axis=0)
+
+    def query(self, boxes_bv):
+        """
+        :param boxes_bv: (K, 4, 2) BEV corners of the candidate boxes
+        :return: (K) bool, whether each candidate collides with any indexed box
+        """
+        if boxes_bv.shape[0] == 0 or self.corners.shape[0] == 0:
+            return np.zeros(boxes_bv.shape[0], dtype=np.bool_)
+        standup = augmentation_utils.corner_to_standup_nd_jit(boxes_bv)
+        cell_min, cell_max = self._cell_range(standup)
+        return augmentation_utils.box_collision_test_indexed(
+            boxes_bv, standup, cell_min, cell_max, self.corners, self.standup, self.cell_keys, self.cell_box_ids
+        )
+
+
 class DataBaseSampler(object):
     def __init__(self, db_infos, sampler_cfg, class_names, logger=None):
         super().__init__()
@@ -62,6 +113,8 @@ class DataBaseSampler(object):
                 continue
             self.sample_groups.append({name: int(num)})
 
+        self.collision_cell_size = sampler_cfg.get('COLLISION_CELL_SIZE', 4.0)
+
         self.group_db_infos = self.db_infos  # just use db_infos
         self.sample_classes = []
         self.sample_max_nums = []
@@ -119,11 +172,12 @@ class DataBaseSampler(object):
 
         sampled = []
         sampled_gt_boxes = []
-        avoid_coll_boxes = gt_boxes
+        coll_index = BEVCollisionIndex(cell_size=self.collision_cell_size)
+        coll_index.insert(box_utils.boxes3d_to_corners3d_lidar(gt_boxes)[:, 0:4, 0:2])
 
         for class_name, sampled_num in zip(self.sample_classes, sample_num_per_class):
             if sampled_num > 0:
-                sampled_cls = self.sample_class_v2(class_name, sampled_num, avoid_coll_boxes)
+                sampled_cls = self.sample_class_v2(class_name, sampled_num, coll_index)
 
                 sampled += sampled_cls
                 if len(sampled_cls) > 0:
@@ -133,7 +187,6 @@ class DataBaseSampler(object):
                         sampled_gt_box = np.stack([s['box3d_lidar'] for s in sampled_cls], axis=0)
 
                     sampled_gt_boxes += [sampled_gt_box]
-                    avoid_coll_boxes = np.concatenate([avoid_coll_boxes, sampled_gt_box], axis=0)
 
         ret = None
         if len(sampled) > 0:
@@ -178,29 +231,33 @@ class DataBaseSampler(object):
 
         return ret
 
-    def sample_class_v2(self, name, num, gt_boxes):
+    def sample_class_v2(self, name, num, coll_index):
+        """
+        :param name: class name to sample
+        :param num: number of boxes to sample
+        :param coll_index: BEVCollisionIndex of the boxes to avoid, the accepted samples are inserted into it
+        :return: list of the accepted db infos
+        """
         sampled = self.sampler_dict[name].sample(num)
         sampled = copy.deepcopy(sampled)
-        num_gt = gt_boxes.shape[0]
         num_sampled = len(sampled)
-        gt_boxes_bv = box_utils.boxes3d_to_corners3d_lidar(gt_boxes)[:, 0:4, 0:2]  # (N, 4, 2)
 
         sp_boxes = np.stack([i['box3d_lidar'] for i in sampled], axis=0)
-        boxes = np.concatenate([gt_boxes, sp_boxes], axis=0).copy()
+        sp_boxes_bv = box_utils.boxes3d_to_corners3d_lidar(sp_boxes)[:, 0:4, 0:2]  # (N, 4, 2)
 
-        sp_boxes_new = boxes[gt_boxes.shape[0]:]
-        sp_boxes_bv = box_utils.boxes3d_to_corners3d_lidar(sp_boxes_new)[:, 0:4, 0:2]  # (N, 4, 2)
-
-        total_bv = np.concatenate([gt_boxes_bv, sp_boxes_bv], axis=0)
-        coll_mat = augmentation_utils.box_collision_test(total_bv, total_bv)
-        diag = np.arange(total_bv.shape[0])
+        coll_with_index = coll_index.query(sp_boxes_bv)
+        coll_mat = augmentation_utils.box_collision_test(sp_boxes_bv, sp_boxes_bv)
+        diag = np.arange(num_sampled)
         coll_mat[diag, diag] = False
 
-        valid_samples = []
-        for i in range(num_gt, num_gt + num_sampled):
-            if coll_mat[i].any():
+        valid_mask = np.zeros(num_sampled, dtype=np.bool_)
+        for i in range(num_sampled):
+            if coll_with_index[i] or coll_mat[i].any():
                 coll_mat[i] = False
                 coll_mat[:, i] = False
             else:
-                valid_samples.append(sampled[i - num_gt])
+                valid_mask[i] = True
+
+        coll_index.insert(sp_boxes_bv[valid_mask])
+        valid_samples = [sampled[i] for i in range(num_sampled) if valid_mask[i]]
         return valid_samples
@@ -1,9 +1,12 @@
+import os
 import numpy as np
+from pathlib import Path
 from collections import defaultdict
 import torch.utils.data as torch_data
 from ..utils import box_utils, common_utils
 from ..config import cfg
 from .data_augmentation import augmentation_utils
+from .voxel_cache import VoxelCache, MemoryVoxelCache
 import pdb
 
 class DatasetTemplate(torch_data.Dataset):
@@ -58,7 +61,33 @@ class DatasetTemplate(torch_data.Dataset):
     def forward(self, index):
         raise NotImplementedError
 
-    def prepare_data(self, input_dict, has_label=True):
+    def augmentation_disabled(self):
+        """whether prepare_data always produces the same points and voxels for a sample"""
+        if cfg.DATA_CONFIG[self.mode].SHUFFLE_POINTS:
+            return False
+        if not self.training:
+            return True
+        aug_cfg = cfg.DATA_CONFIG.AUGMENTATION
+        return not (aug_cfg.DB_SAMPLER.ENABLED or aug_cfg.NOISE_PER_OBJECT.ENABLED
+                    or aug_cfg.NOISE_GLOBAL_SCENE.ENABLED)
+
+    def init_voxel_cache(self, logger=None, resident=False):
+        """
+        enabled by DATA_CONFIG.VOXEL_CACHE_DIR, and only used when augmentation is disabled
+        :param resident: keep the voxels of the samples in memory as well, e.g. for a dataset evaluated repeatedly
+        """
+        self.voxel_cache = None
+        cache_dir = cfg.DATA_CONFIG.get('VOXEL_CACHE_DIR', None)
+        if not self.augmentation_disabled():
+            return
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir) if os.path.isabs(cache_dir) else cfg.ROOT_DIR / cache_dir
+            data_key = {key: getattr(self, key, None) for key in ['split', 'root_split_path', 'root_path']}
+            self.voxel_cache = VoxelCache(cache_dir, self.mode, data_key=data_key, logger=logger)
+        if resident:
+            self.voxel_cache = MemoryVoxelCache(self.voxel_cache)
+
+    def prepare_data(self, input_dict, has_label=True, voxel_dict=None):
         """
         :param input_dict:
             sample_idx: string
@@ -76,10 +105,12 @@ class DatasetTemplate(torch_data.Dataset):
             calib: object
             gt_boxes: (N, 8), [x, y, z, w, l, h, rz, gt_classes] in LiDAR coordinate, z is the bottom center
             points: (M, 3 + C)
+        :param voxel_dict: optional, loaded from the voxel cache, then points and voxelization are taken from it
         """
         sample_idx = input_dict['sample_idx']
         points = input_dict['points']
         calib = input_dict['calib']
+        points_range_mask = None  # filled by the fused global augmentation
 
         if has_label:
             gt_boxes = input_dict['gt_boxes_lidar'].copy()
@@ -131,7 +162,15 @@ class DatasetTemplate(torch_data.Dataset):
             gt_classes = np.array([self.class_names.index(n) + 1 for n in gt_names], dtype=np.int32)
 
             noise_global_scene = cfg.DATA_CONFIG.AUGMENTATION.NOISE_GLOBAL_SCENE
-            if noise_global_scene.ENABLED:
+            if noise_global_scene.ENABLED and noise_global_scene.get('FUSED_TRANSFORM', False):
+                limit_range = cfg.DATA_CONFIG.POINT_CLOUD_RANGE if cfg.DATA_CONFIG.MASK_POINTS_BY_RANGE else None
+                gt_boxes, points, points_range_mask = augmentation_utils.global_augmentation_fused_(
+                    gt_boxes, points, rotation=noise_global_scene.GLOBAL_ROT_UNIFORM_NOISE,
+                    min_scale=noise_global_scene.GLOBAL_SCALING_UNIFORM_NOISE[0],
+                    max_scale=noise_global_scene.GLOBAL_SCALING_UNIFORM_NOISE[1],
+                    limit_range=limit_range
+                )
+            elif noise_global_scene.ENABLED:
                 gt_boxes, points = augmentation_utils.random_flip(gt_boxes, points)
                 gt_boxes, points = augmentation_utils.global_rotation(
                     gt_boxes, points, rotation=noise_global_scene.GLOBAL_ROT_UNIFORM_NOISE
@@ -150,25 +189,45 @@ class DatasetTemplate(torch_data.Dataset):
             # limit rad to [-pi, pi]
             gt_boxes[:, 6] = common_utils.limit_period(gt_boxes[:, 6], offset=0.5, period=2 * np.pi)
 
-        points = points[:, :cfg.DATA_CONFIG.NUM_POINT_FEATURES['use']]
-        if cfg.DATA_CONFIG[self.mode].SHUFFLE_POINTS:
-            np.random.shuffle(points)
-
-        voxel_grid = self.voxel_generator.generate(points)
-
-        # Support spconv 1.0 and 1.1
-        try:
-            voxels, coordinates, num_points = voxel_grid
-        except:
-            voxels = voxel_grid["voxels"]
-            coordinates = voxel_grid["coordinates"]
-            num_points = voxel_grid["num_points_per_voxel"]
-
-        voxel_centers = (coordinates[:, ::-1] + 0.5) * self.voxel_generator.voxel_size \
-                        + self.voxel_generator.point_cloud_range[0:3]
-
-        if cfg.DATA_CONFIG.MASK_POINTS_BY_RANGE:
-            points = common_utils.mask_points_by_range(points, cfg.DATA_CONFIG.POINT_CLOUD_RANGE)
+        if voxel_dict is not None:
+            voxels, coordinates = voxel_dict['voxels'], voxel_dict['coordinates']
+            num_points, voxel_centers = voxel_dict['num_points'], voxel_dict['voxel_centers']
+            points = voxel_dict['points']
+        else:
+            points = points[:, :cfg.DATA_CONFIG.NUM_POINT_FEATURES['use']]
+            if cfg.DATA_CONFIG[self.mode].SHUFFLE_POINTS:
+                if points_range_mask is not None:
+                    # draws the same permutation as np.random.shuffle
+                    shuffle_idx = np.random.permutation(points.shape[0])
+                    points = points[shuffle_idx]
+                    points_range_mask = points_range_mask[shuffle_idx]
+                else:
+                    np.random.shuffle(points)
+
+            voxel_grid = self.voxel_generator.generate(points)
+
+            # Support spconv 1.0 and 1.1
+            try:
+                voxels, coordinates, num_points = voxel_grid
+            except:
+                voxels = voxel_grid["voxels"]
+                coordinates = voxel_grid["coordinates"]
+                num_points = voxel_grid["num_points_per_voxel"]
+
+            voxel_centers = (coordinates[:, ::-1] + 0.5) * self.voxel_generator.voxel_size \
+                            + self.voxel_generator.point_cloud_range[0:3]
+
+            if cfg.DATA_CONFIG.MASK_POINTS_BY_RANGE:
+                if points_range_mask is not None:
+                    points = points[points_range_mask]
+                else:
+                    points = common_utils.mask_points_by_range(points, cfg.DATA_CONFIG.POINT_CLOUD_RANGE)
+
+            if getattr(self, 'voxel_cache', None) is not None:
+                self.voxel_cache.save(sample_idx, {
+                    'voxels': voxels, 'coordinates': coordinates, 'num_points': num_points,
+                    'voxel_centers': voxel_centers, 'points': points
+                })
 
         example = {}
         if has_label:
@@ -215,69 +274,116 @@ class DatasetTemplate(torch_data.Dataset):
 
         MEAN_SIZE = unet_target_cfg.MEAN_SIZE
         GT_EXTEND_WIDTH = unet_target_cfg.GT_EXTEND_WIDTH
-
-        extend_gt_boxes = common_utils.enlarge_box3d(gt_boxes, extra_width=GT_EXTEND_WIDTH)
-        gt_corners = box_utils.boxes3d_to_corners3d_lidar(gt_boxes)
-        extend_gt_corners = box_utils.boxes3d_to_corners3d_lidar(extend_gt_boxes)
-
-        cls_labels = np.zeros(voxel_centers.shape[0], dtype=np.int32)
-        reg_labels = np.zeros((voxel_centers.shape[0], 3), dtype=np.float32)
-        bbox_reg_labels = np.zeros((voxel_centers.shape[0], 7), dtype=np.float32) if generate_bbox_reg_labels else None
-
-        for k in range(gt_boxes.shape[0]):
-            box_corners = gt_corners[k]
-            fg_pt_flag = box_utils.in_hull(voxel_centers, box_corners)
-            fg_voxels = voxel_centers[fg_pt_flag]
-            cls_labels[fg_pt_flag] = gt_classes[k]
-
-            # enlarge the bbox3d, ignore nearby points
-            extend_box_corners = extend_gt_corners[k]
-            fg_enlarge_flag = box_utils.in_hull(voxel_centers, extend_box_corners)
-            ignore_flag = np.logical_xor(fg_pt_flag, fg_enlarge_flag)
-            cls_labels[ignore_flag] = -1
-
-            # part offset labels
-            transformed_voxels = fg_voxels - gt_boxes[k, 0:3]
-            transformed_voxels = common_utils.rotate_pc_along_z(transformed_voxels, -gt_boxes[k, 6])
-            reg_labels[fg_pt_flag] = (transformed_voxels / gt_boxes[k, 3:6]) + np.array([0.5, 0.5, 0], dtype=np.float32)
-
-            if generate_bbox_reg_labels:
-                # rpn bbox regression target
-                center3d = gt_boxes[k, 0:3].copy()
-                center3d[2] += gt_boxes[k][5] / 2  # shift to center of 3D boxes
-                bbox_reg_labels[fg_pt_flag, 0:3] = center3d - fg_voxels
-                bbox_reg_labels[fg_pt_flag, 6] = gt_boxes[k, 6]  # dy
-
-                cur_mean_size = MEAN_SIZE[cfg.CLASS_NAMES[gt_classes[k] - 1]]
-                bbox_reg_labels[fg_pt_flag, 3:6] = (gt_boxes[k, 3:6] - np.array(cur_mean_size)) / cur_mean_size
+        BOUNDARY_MARGIN = 1e-4  # larger than the float32 rounding of the box corners
+
+        num_voxels = voxel_centers.shape[0]
+        cls_labels = np.zeros(num_voxels, dtype=np.int32)
+        reg_labels = np.zeros((num_voxels, 3), dtype=np.float32)
+        bbox_reg_labels = np.zeros((num_voxels, 7), dtype=np.float32) if generate_bbox_reg_labels else None
+        if gt_boxes.shape[0] == 0:
+            return cls_labels, reg_labels, bbox_reg_labels
+
+        # one lookup of the voxels around all the (enlarged) boxes, in the box coordinates
+        pts_idx, box_idx, local_xyz = box_utils.points_in_boxes3d_lidar_candidates(
+            voxel_centers, gt_boxes, extra_width=GT_EXTEND_WIDTH
+        )
+        half_size = np.stack((gt_boxes[box_idx, 3] / 2, gt_boxes[box_idx, 4] / 2, gt_boxes[box_idx, 5] / 2), axis=-1)
+        z_center = local_xyz[:, 2] - half_size[:, 2]
+        dist_to_box = np.abs(np.stack((local_xyz[:, 0], local_xyz[:, 1], z_center), axis=-1)) - half_size  # (P, 3)
+        fg_flag = (dist_to_box <= 0).all(axis=-1)
+        fg_enlarge_flag = (dist_to_box <= GT_EXTEND_WIDTH).all(axis=-1)
+
+        # same decision as in_hull for the few voxels lying on a face of the box or the enlarged box
+        on_boundary = (np.abs(dist_to_box) < BOUNDARY_MARGIN).any(axis=-1) \
+            | (np.abs(dist_to_box - GT_EXTEND_WIDTH) < BOUNDARY_MARGIN).any(axis=-1)
+        if on_boundary.any():
+            extend_gt_boxes = common_utils.enlarge_box3d(gt_boxes, extra_width=GT_EXTEND_WIDTH)
+            gt_corners = box_utils.boxes3d_to_corners3d_lidar(gt_boxes)
+            extend_gt_corners = box_utils.boxes3d_to_corners3d_lidar(extend_gt_boxes)
+            for k in np.unique(box_idx[on_boundary]):
+                cur_pairs = np.nonzero(on_boundary & (box_idx == k))[0]
+                fg_flag[cur_pairs] = box_utils.in_hull(voxel_centers[pts_idx[cur_pairs]], gt_corners[k])
+                fg_enlarge_flag[cur_pairs] = box_utils.in_hull(voxel_centers[pts_idx[cur_pairs]], extend_gt_corners[k])
+        ignore_flag = np.logical_xor(fg_flag, fg_enlarge_flag)
+
+        # the boxes are handled in order and later boxes overwrite the labels of earlier ones,
+        # the pairs are sorted by box index so the largest pair index of a voxel is its last box
+        pair_idx = np.arange(pts_idx.shape[0])
+        last_label_pair = np.full(num_voxels, -1, dtype=np.int64)
+        np.maximum.at(last_label_pair, pts_idx[fg_flag | ignore_flag], pair_idx[fg_flag | ignore_flag])
+        labeled = last_label_pair >= 0
+        label_pairs = last_label_pair[labeled]
+        cls_labels[labeled] = np.where(fg_flag[label_pairs], gt_classes[box_idx[label_pairs]], -1)
+
+        last_fg_pair = np.full(num_voxels, -1, dtype=np.int64)
+        np.maximum.at(last_fg_pair, pts_idx[fg_flag], pair_idx[fg_flag])
+        fg_voxel_flag = last_fg_pair >= 0
+        fg_pairs = last_fg_pair[fg_voxel_flag]
+        fg_boxes = gt_boxes[box_idx[fg_pairs]]
+
+        # part offset labels
+        reg_labels[fg_voxel_flag] = (local_xyz[fg_pairs] / fg_boxes[:, 3:6]) + np.array([0.5, 0.5, 0], dtype=np.float32)
+
+        if generate_bbox_reg_labels:
+            # rpn bbox regression target
+            center3d = fg_boxes[:, 0:3].copy()
+            center3d[:, 2] += fg_boxes[:, 5] / 2  # shift to center of 3D boxes
+            bbox_reg_labels[fg_voxel_flag, 0:3] = center3d - voxel_centers[fg_voxel_flag]
+            bbox_reg_labels[fg_voxel_flag, 6] = fg_boxes[:, 6]  # dy
+
+            box_mean_size = np.array([MEAN_SIZE[cfg.CLASS_NAMES[cls - 1]] for cls in gt_classes])
+            cur_mean_size = box_mean_size[box_idx[fg_pairs]]
+            bbox_reg_labels[fg_voxel_flag, 3:6] = (fg_boxes[:, 3:6] - cur_mean_size) / cur_mean_size
 
         reg_labels = np.maximum(reg_labels, 0)
         return cls_labels, reg_labels, bbox_reg_labels
 
     @staticmethod
-    def collate_batch(batch_list, _unused=False):
+    def collate_batch(batch_list, _unused=False, buffers=None):
+        """
+        :param batch_list: list of the examples from prepare_data
+        :param _unused:
+        :param buffers: optional CollateBuffers, the batch arrays are written into its reusable (pinned) buffers
+        :return:
+        """
         example_merged = defaultdict(list)
         for example in batch_list:
             for k, v in example.items():
                 example_merged[k].append(v)
+
+        # size the batch once and write each example in place instead of padding and concatenating copies
+        if buffers is not None:
+            buffers.next_slot()
+            empty = buffers.empty
+        else:
+            empty = lambda key, shape, dtype: np.empty(shape, dtype=dtype)
+
         ret = {}
         for key, elems in example_merged.items():
             if key in ['voxels', 'num_points', 'voxel_centers', 'seg_labels', 'part_labels', 'bbox_reg_labels']:
-                ret[key] = np.concatenate(elems, axis=0)
+                num_total = sum([elem.shape[0] for elem in elems])
+                batch_elems = empty(key, (num_total,) + elems[0].shape[1:], np.result_type(*elems))
+                np.concatenate(elems, axis=0, out=batch_elems)
+                ret[key] = batch_elems
             elif key in ['coordinates', 'points']:
-                coors = []
+                num_total = sum([coor.shape[0] for coor in elems])
+                batch_coors = empty(key, (num_total, elems[0].shape[1] + 1), np.result_type(*elems))
+                start = 0
                 for i, coor in enumerate(elems):
-                    coor_pad = np.pad(coor, ((0, 0), (1, 0)), mode='constant', constant_values=i)
-                    coors.append(coor_pad)
-                ret[key] = np.concatenate(coors, axis=0)
+                    end = start + coor.shape[0]
+                    batch_coors[start:end, 0] = i
+                    batch_coors[start:end, 1:] = coor
+                    start = end
+                ret[key] = batch_coors
             elif key in ['gt_boxes']:
                 max_gt = 0
                 batch_size = elems.__len__()
                 for k in range(batch_size):
                     max_gt = max(max_gt, elems[k].__len__())
-                batch_gt_boxes3d = np.zeros((batch_size, max_gt, elems[0].shape[-1]), dtype=np.float32)
+                batch_gt_boxes3d = empty(key, (batch_size, max_gt, elems[0].shape[-1]), np.float32)
                 for k in range(batch_size):
                     batch_gt_boxes3d[k, :elems[k].__len__(), :] = elems[k]
+                    batch_gt_boxes3d[k, elems[k].__len__():, :] = 0
                 ret[key] = batch_gt_boxes3d
             else:
                 ret[key] = np.stack(elems, axis=0)
@@ -27,11 +27,19 @@ class BaseKittiDataset(DatasetTemplate):
             split_dir = os.path.join(self.root_path, 'ImageSets', split + '.txt')
 
         self.sample_id_list = [x.strip() for x in open(split_dir).readlines()] if os.path.exists(split_dir) else None
+        # optional SharedPointStore, the points are read from it instead of the velodyne files
+        self.point_store = None
+        # {sample_idx: KITTI label lines} read instead of the label files, e.g. the fused labels of the distill stage
+        self.label_overlay = {}
 
     def set_split(self, split):
         self.__init__(self.root_path, split)
 
     def get_lidar(self, idx):
+        if self.point_store is not None:
+            points = self.point_store.get(self.root_path, idx)
+            if points is not None:
+                return points
         lidar_file = os.path.join(self.root_split_path, 'velodyne', '%s.bin' % idx)
         assert os.path.exists(lidar_file)
         return np.fromfile(lidar_file, dtype=np.float32).reshape(-1, 4)
@@ -43,6 +51,8 @@ class BaseKittiDataset(DatasetTemplate):
         return np.array(io.imread(img_file).shape[:2], dtype=np.int32)
 
     def get_label(self, idx):
+        if idx in self.label_overlay:
+            return [object3d_utils.Object3d(line) for line in self.label_overlay[idx]]
         label_file = os.path.join(self.root_split_path, 'label_2', '%s.txt' % idx)
         assert os.path.exists(label_file)
         return object3d_utils.get_objects_from_label(label_file)
@@ -83,6 +93,52 @@ class BaseKittiDataset(DatasetTemplate):
 
         return pts_valid_flag
 
+    def get_annos(self, sample_idx, calib, image_shape, count_inside_pts=True):
+        """
+        :return: annos of the info of a sample from its labels
+        """
+        obj_list = self.get_label(sample_idx)
+        annotations = {}
+        annotations['name'] = np.array([obj.cls_type for obj in obj_list])
+        annotations['truncated'] = np.array([obj.truncation for obj in obj_list])
+        annotations['occluded'] = np.array([obj.occlusion for obj in obj_list])
+        annotations['alpha'] = np.array([obj.alpha for obj in obj_list])
+        annotations['bbox'] = np.concatenate([obj.box2d.reshape(1, 4) for obj in obj_list], axis=0)
+        annotations['dimensions'] = np.array([[obj.l, obj.h, obj.w] for obj in obj_list])  # lhw(camera) format
+        annotations['location'] = np.concatenate([obj.loc.reshape(1, 3) for obj in obj_list], axis=0)
+        annotations['rotation_y'] = np.array([obj.ry for obj in obj_list])
+        annotations['score'] = np.array([obj.score for obj in obj_list])
+        annotations['difficulty'] = np.array([obj.level for obj in obj_list], np.int32)
+
+        num_objects = len([obj.cls_type for obj in obj_list if obj.cls_type != 'DontCare'])
+        num_gt = len(annotations['name'])
+        index = list(range(num_objects)) + [-1] * (num_gt - num_objects)
+        annotations['index'] = np.array(index, dtype=np.int32)
+
+        loc = annotations['location'][:num_objects]
+        dims = annotations['dimensions'][:num_objects]
+        rots = annotations['rotation_y'][:num_objects]
+        loc_lidar = calib.rect_to_lidar(loc)
+        l, h, w = dims[:, 0:1], dims[:, 1:2], dims[:, 2:3]
+        gt_boxes_lidar = np.concatenate([loc_lidar, w, l, h, rots[..., np.newaxis]], axis=1)
+        annotations['gt_boxes_lidar'] = gt_boxes_lidar
+
+        if count_inside_pts:
+            points = self.get_lidar(sample_idx)
+            pts_rect = calib.lidar_to_rect(points[:, 0:3])
+
+            fov_flag = self.get_fov_flag(pts_rect, image_shape, calib)
+            pts_fov = points[fov_flag]
+            corners_lidar = box_utils.boxes3d_to_corners3d_lidar(gt_boxes_lidar)
+            num_points_in_gt = -np.ones(num_gt, dtype=np.int32)
+
+            for k in range(num_objects):
+                flag = box_utils.in_hull(pts_fov[:, 0:3], corners_lidar[k])
+                num_points_in_gt[k] = flag.sum()
+            annotations['num_points_in_gt'] = num_points_in_gt
+
+        return annotations
+
     def get_infos(self, num_workers=4, has_label=True, count_inside_pts=True, sample_id_list=None):
         import concurrent.futures as futures
 
@@ -106,48 +162,7 @@ class BaseKittiDataset(DatasetTemplate):
             info['calib'] = calib_info
 
             if has_label:
-                obj_list = self.get_label(sample_idx)
-                annotations = {}
-                annotations['name'] = np.array([obj.cls_type for obj in obj_list])
-                annotations['truncated'] = np.array([obj.truncation for obj in obj_list])
-                annotations['occluded'] = np.array([obj.occlusion for obj in obj_list])
-                annotations['alpha'] = np.array([obj.alpha for obj in obj_list])
-                annotations['bbox'] = np.concatenate([obj.box2d.reshape(1, 4) for obj in obj_list], axis=0)
-                annotations['dimensions'] = np.array([[obj.l, obj.h, obj.w] for obj in obj_list])  # lhw(camera) format
-                annotations['location'] = np.concatenate([obj.loc.reshape(1, 3) for obj in obj_list], axis=0)
-                annotations['rotation_y'] = np.array([obj.ry for obj in obj_list])
-                annotations['score'] = np.array([obj.score for obj in obj_list])
-                annotations['difficulty'] = np.array([obj.level for obj in obj_list], np.int32)
-
-                num_objects = len([obj.cls_type for obj in obj_list if obj.cls_type != 'DontCare'])
-                num_gt = len(annotations['name'])
-                index = list(range(num_objects)) + [-1] * (num_gt - num_objects)
-                annotations['index'] = np.array(index, dtype=np.int32)
-
-                loc = annotations['location'][:num_objects]
-                dims = annotations['dimensions'][:num_objects]
-                rots = annotations['rotation_y'][:num_objects]
-                loc_lidar = calib.rect_to_lidar(loc)
-                l, h, w = dims[:, 0:1], dims[:, 1:2], dims[:, 2:3]
-                gt_boxes_lidar = np.concatenate([loc_lidar, w, l, h, rots[..., np.newaxis]], axis=1)
-                annotations['gt_boxes_lidar'] = gt_boxes_lidar
-
-                info['annos'] = annotations
-
-                if count_inside_pts:
-                    points = self.get_lidar(sample_idx)
-                    calib = self.get_calib(sample_idx)
-                    pts_rect = calib.lidar_to_rect(points[:, 0:3])
-
-                    fov_flag = self.get_fov_flag(pts_rect, info['image']['image_shape'], calib)
-                    pts_fov = points[fov_flag]
-                    corners_lidar = box_utils.boxes3d_to_corners3d_lidar(gt_boxes_lidar)
-                    num_points_in_gt = -np.ones(num_gt, dtype=np.int32)
-
-                    for k in range(num_objects):
-                        flag = box_utils.in_hull(pts_fov[:, 0:3], corners_lidar[k])
-                        num_points_in_gt[k] = flag.sum()
-                    annotations['num_points_in_gt'] = num_points_in_gt
+                info['annos'] = self.get_annos(sample_idx, calib, image_info['image_shape'], count_inside_pts)
 
             return info
 
@@ -423,6 +438,26 @@ class KittiDataset(BaseKittiDataset):
             )
             voxel_grid = self.voxel_generator.generate(points)
 
+        self.init_voxel_cache(logger)
+
+    def update_labels(self, labels, count_inside_pts=True):
+        """
+        put labels in the label overlay and rebuild the annos of their infos in place, the next epoch trains on them
+        without new label files nor info files, the gt database of the DB_SAMPLER is not updated
+        :param labels: {sample_idx: KITTI label lines}, e.g. the fused labels of the distill stage
+        :return: number of infos updated, the samples not in the infos of the dataset are only put in the overlay
+        """
+        self.label_overlay.update(labels)
+        info_index = {info['point_cloud']['lidar_idx']: k for k, info in enumerate(self.kitti_infos)}
+        num_updated = 0
+        for sample_idx in labels:
+            if sample_idx not in info_index:
+                continue
+            info = self.kitti_infos[info_index[sample_idx]]
+            info['annos'] = self.get_annos(sample_idx, self.get_calib(sample_idx), info['image']['image_shape'],
+                                           count_inside_pts)
+            num_updated += 1
+        return num_updated
 
     def __len__(self):
         return len(self.kitti_infos)
@@ -433,14 +468,18 @@ class KittiDataset(BaseKittiDataset):
 
         sample_idx = info['point_cloud']['lidar_idx']
 
-        points = self.get_lidar(sample_idx)
+        voxel_dict = self.voxel_cache.load(sample_idx) if self.voxel_cache is not None else None
         calib = self.get_calib(sample_idx)
 
         img_shape = info['image']['image_shape']
-        if cfg.DATA_CONFIG.FOV_POINTS_ONLY:
-            pts_rect = calib.lidar_to_rect(points[:, 0:3])
-            fov_flag = self.get_fov_flag(pts_rect, img_shape, calib)
-            points = points[fov_flag]
+        if voxel_dict is not None:
+            points = voxel_dict['points']
+        else:
+            points = self.get_lidar(sample_idx)
+            if cfg.DATA_CONFIG.FOV_POINTS_ONLY:
+                pts_rect = calib.lidar_to_rect(points[:, 0:3])
+                fov_flag = self.get_fov_flag(pts_rect, img_shape, calib)
+                points = points[fov_flag]
 
         input_dict = {
             'points': points,
@@ -467,7 +506,7 @@ class KittiDataset(BaseKittiDataset):
                 'gt_boxes_lidar': gt_boxes_lidar
             })
 
-        example = self.prepare_data(input_dict=input_dict, has_label='annos' in info)
+        example = self.prepare_data(input_dict=input_dict, has_label='annos' in info, voxel_dict=voxel_dict)
 
         example['sample_idx'] = sample_idx
         example['image_shape'] = img_shape
@@ -1,7 +1,22 @@
 import numpy as np
 import numba
 import io as sysio
-from .rotate_iou import rotate_iou_gpu_eval
+from numba import cuda
+from .rotate_iou_cpu import rotate_iou_cpu_eval
+try:
+    from .rotate_iou import rotate_iou_gpu_eval
+except Exception:
+    # the numba.cuda kernels are compiled at import and fail without a CUDA driver
+    rotate_iou_gpu_eval = None
+
+# set to True to compute the rotated iou on cpu even if CUDA is available
+FORCE_CPU_ROTATE_IOU = False
+
+
+def rotate_iou_eval(boxes, query_boxes, criterion=-1):
+    if FORCE_CPU_ROTATE_IOU or rotate_iou_gpu_eval is None or not cuda.is_available():
+        return rotate_iou_cpu_eval(boxes, query_boxes, criterion)
+    return rotate_iou_gpu_eval(boxes, query_boxes, criterion)
 
 
 @numba.jit
@@ -118,7 +133,7 @@ def image_box_overlap(boxes, query_boxes, criterion=-1):
 
 
 def bev_box_overlap(boxes, qboxes, criterion=-1):
-    riou = rotate_iou_gpu_eval(boxes, qboxes, criterion)
+    riou = rotate_iou_eval(boxes, qboxes, criterion)
     return riou
 
 
@@ -152,8 +167,8 @@ def d3_box_overlap_kernel(boxes, qboxes, rinc, criterion=-1):
 
 
 def d3_box_overlap(boxes, qboxes, criterion=-1):
-    rinc = rotate_iou_gpu_eval(boxes[:, [0, 2, 3, 5, 6]],
-                               qboxes[:, [0, 2, 3, 5, 6]], 2)
+    rinc = rotate_iou_eval(boxes[:, [0, 2, 3, 5, 6]],
+                           qboxes[:, [0, 2, 3, 5, 6]], 2)
     d3_box_overlap_kernel(boxes, qboxes, rinc, criterion)
     return rinc
 
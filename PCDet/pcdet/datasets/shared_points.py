@@ -0,0 +1,87 @@
+import os
+import time
+import pickle
+import numpy as np
+from pathlib import Path
+from multiprocessing import shared_memory
+
+
+class SharedPointStore(object):
+    """
+    Read-only lidar points of the samples of several KITTI data dirs (e.g. the ego vehicles of a recording) decoded
+    once into a single shared memory block, the worker processes attach to it without a copy
+    It is pickled as the name of the block and the index of the samples
+    """
+    NUM_POINT_FEATURES = 4
+
+    def __init__(self, name, index, num_points, owner=False):
+        """
+        :param index: {(data dir, sample_idx): (first row, last row + 1)}
+        :param owner: the block is released by this instance
+        """
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.index = index
+        self.num_points = num_points
+        self.owner = owner
+        self.points = np.ndarray((num_points, self.NUM_POINT_FEATURES), dtype=np.float32, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return self.__class__, (self.shm.name, self.index, self.num_points)
+
+    @staticmethod
+    def get_key(root_path):
+        return Path(root_path).resolve().as_posix()
+
+    @classmethod
+    def create(cls, data_dirs, splits=('train', 'val'), logger=None):
+        """
+        read the velodyne files of the samples in the kitti_infos_<split>.pkl of each data dir into a new block
+        :param data_dirs: KITTI data dirs, the root_path of the datasets
+        """
+        start = time.perf_counter()
+        files, index, num_points = [], {}, 0
+        for data_dir in data_dirs:
+            key = cls.get_key(data_dir)
+            for split in splits:
+                info_path = Path(data_dir) / ('kitti_infos_%s.pkl' % split)
+                if not info_path.exists():
+                    continue
+                with open(str(info_path), 'rb') as f:
+                    infos = pickle.load(f)
+                for info in infos:
+                    sample_idx = info['point_cloud']['lidar_idx']
+                    if (key, sample_idx) in index:
+                        continue
+                    lidar_file = Path(data_dir) / 'training' / 'velodyne' / ('%s.bin' % sample_idx)
+                    cur_num = os.path.getsize(str(lidar_file)) // (4 * cls.NUM_POINT_FEATURES)
+                    index[(key, sample_idx)] = (num_points, num_points + cur_num)
+                    files.append(lidar_file)
+                    num_points += cur_num
+
+        shm = shared_memory.SharedMemory(create=True, size=max(num_points * 4 * cls.NUM_POINT_FEATURES, 1))
+        store = cls(shm.name, index, num_points, owner=True)
+        shm.close()
+        for lidar_file, rows in zip(files, index.values()):
+            with open(str(lidar_file), 'rb') as f:
+                f.readinto(store.points[rows[0]:rows[1]])
+        if logger is not None:
+            logger.info('Shared point store: %d samples of %d dirs, %.1f MB in %.1f s' % (
+                len(index), len(data_dirs), num_points * 4 * cls.NUM_POINT_FEATURES / 2 ** 20,
+                time.perf_counter() - start
+            ))
+        return store
+
+    def get(self, root_path, sample_idx):
+        """
+        :return: (N, 4) copy of the points of the sample as BaseKittiDataset.get_lidar, None if it is not in the store
+        """
+        rows = self.index.get((self.get_key(root_path), sample_idx))
+        if rows is None:
+            return None
+        return self.points[rows[0]:rows[1]].copy()
+
+    def release(self):
+        self.points = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from ..config import cfg
+
+
+class VoxelCache(object):
+    """
+    On-disk cache of the voxelization results of each sample, only valid when no augmentation changes the points
+    Files are stored as <cache_dir>/<config hash>/<sample_idx>.npz
+    """
+    CACHED_KEYS = ['voxels', 'coordinates', 'num_points', 'voxel_centers', 'points']
+
+    def __init__(self, cache_dir, mode, data_key=None, logger=None):
+        """
+        :param data_key: the data the sample ids refer to, e.g. split, root_split_path and root_path of the dataset,
+                         the training and testing ids of the same dir are the same
+        """
+        self.config_hash = self.get_config_hash(mode, data_key)
+        self.cache_dir = Path(cache_dir) / self.config_hash
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if logger is not None:
+            logger.info('Voxel cache of %s mode: %s' % (mode, self.cache_dir))
+
+    @staticmethod
+    def get_config_hash(mode, data_key=None):
+        data_cfg = cfg.DATA_CONFIG
+        key_cfg = {
+            'DATA_DIR': str(data_cfg.DATA_DIR),
+            'FOV_POINTS_ONLY': data_cfg.FOV_POINTS_ONLY,
+            'NUM_POINT_FEATURES': data_cfg.NUM_POINT_FEATURES['use'],
+            'POINT_CLOUD_RANGE': data_cfg.POINT_CLOUD_RANGE,
+            'MASK_POINTS_BY_RANGE': data_cfg.MASK_POINTS_BY_RANGE,
+            'VOXEL_GENERATOR': data_cfg.VOXEL_GENERATOR,
+            'MAX_NUMBER_OF_VOXELS': data_cfg[mode].MAX_NUMBER_OF_VOXELS,
+        }
+        if data_key is not None:
+            key_cfg.update({key: str(val) for key, val in data_key.items()})
+        key_str = json.dumps(key_cfg, sort_keys=True, default=str)
+        return hashlib.md5(key_str.encode('utf-8')).hexdigest()[:16]
+
+    def get_file(self, sample_idx):
+        return self.cache_dir / ('%s.npz' % sample_idx)
+
+    def load(self, sample_idx):
+        cache_file = self.get_file(sample_idx)
+        if not cache_file.exists():
+            return None
+        try:
+            with np.load(str(cache_file)) as data:
+                return {key: data[key] for key in self.CACHED_KEYS}
+        except (OSError, ValueError, KeyError):
+            # broken file, e.g. the writer was killed, will be rewritten
+            return None
+
+    def save(self, sample_idx, voxel_dict):
+        cache_file = self.get_file(sample_idx)
+        tmp_file = cache_file.with_name('%s.%d.tmp.npz' % (sample_idx, os.getpid()))
+        np.savez(str(tmp_file), **{key: voxel_dict[key] for key in self.CACHED_KEYS})
+        os.replace(str(tmp_file), str(cache_file))
+
+
+class MemoryVoxelCache(object):
+    """
+    Voxelization results of the samples kept in memory, e.g. by an evaluation process scoring a model per round on
+    the same samples, over an optional VoxelCache for the samples not in memory yet
+    The cached arrays are read-only, prepare_data and collate_batch copy them
+    """
+    def __init__(self, disk_cache=None):
+        self.disk_cache = disk_cache
+        self.voxel_dicts = {}
+
+    @property
+    def num_bytes(self):
+        return sum([val.nbytes for voxel_dict in self.voxel_dicts.values() for val in voxel_dict.values()])
+
+    def put(self, sample_idx, voxel_dict):
+        voxel_dict = {key: voxel_dict[key] for key in VoxelCache.CACHED_KEYS}
+        for val in voxel_dict.values():
+            val.setflags(write=False)
+        self.voxel_dicts[sample_idx] = voxel_dict
+
+    def load(self, sample_idx):
+        voxel_dict = self.voxel_dicts.get(sample_idx, None)
+        if voxel_dict is None and self.disk_cache is not None:
+            voxel_dict = self.disk_cache.load(sample_idx)
+            if voxel_dict is not None:
+                self.put(sample_idx, voxel_dict)
+        return voxel_dict
+
+    def save(self, sample_idx, voxel_dict):
+        if self.disk_cache is not None:
+            self.disk_cache.save(sample_idx, voxel_dict)
+        self.put(sample_idx, voxel_dict)
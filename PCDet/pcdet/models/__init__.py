@@ -1,4 +1,6 @@
+import contextlib
 import torch 
+import numpy as np
 from collections import namedtuple
 from .detectors import all_detectors
 from ..config import cfg
@@ -16,22 +18,59 @@ def build_network(dataset):
 
     return model
 
-def load_data_to_gpu(batch_dict):
+
+def get_default_device():
+    """
+    :return: the current cuda device, or the cpu if CUDA is not available
+    """
+    return torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+
+
+def to_channels_last(model):
+    """
+    channels_last memory format for the 2D convolutions, e.g. of the BEV backbone and the rpn_head, the 3D and sparse
+    convolutions keep their layout (no channels_last for their 5D weights)
+    :return: number of convolutions converted
+    """
+    num_convs = 0
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.ConvTranspose2d)):
+            module.to(memory_format=torch.channels_last)
+            num_convs += 1
+    return num_convs
+
+
+def load_data_to_gpu(batch_dict, device=None):
+    device = get_default_device() if device is None else device
     for key, val in batch_dict.items():
         if not isinstance(val, np.ndarray):
             continue
         if key in ['frame_id', 'metadata', 'calib', 'image_shape']:
             continue
-        batch_dict[key] = torch.from_numpy(val).float().cuda()
+        batch_dict[key] = torch.from_numpy(val).float().to(device)
+
+def get_autocast(device, amp_dtype=None):
+    """
+    :param device: device of the forward
+    :param amp_dtype: torch.float16 / torch.bfloat16 for mixed precision, None to run in fp32
+    """
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=amp_dtype)
+
 
-def model_fn_decorator():
+def model_fn_decorator(amp_dtype=None):
+    """
+    :param amp_dtype: run the forward and the losses under autocast with this dtype, None for fp32
+    """
     ModelReturn = namedtuple('ModelReturn', ['loss', 'tb_dict', 'disp_dict'])
 
     def model_func(model, data):
         input_dict = example_convert_to_torch(data)
-        ret_dict, tb_dict, disp_dict = model(input_dict)
+        with get_autocast(get_default_device(), amp_dtype):
+            ret_dict, tb_dict, disp_dict = model(input_dict)
 
-        loss = ret_dict['loss'].mean()
+        loss = ret_dict['loss'].float().mean()
         if hasattr(model, 'update_global_step'):
             model.update_global_step()
         else:
@@ -42,22 +81,33 @@ def model_fn_decorator():
     return model_func
 
 
-def example_convert_to_torch(example, dtype=torch.float32):
-    device = torch.cuda.current_device()
+def example_convert_to_torch(example, dtype=torch.float32, device=None):
+    """
+    :param example: batch dict from collate_batch
+    :param dtype: dtype of the float tensors
+    :param device: target device, default is the current cuda device or the cpu without CUDA
+    :return:
+    """
+    device = get_default_device() if device is None else device
     example_torch = {}
     float_names = [
         'voxels', 'anchors', 'box_reg_targets', 'reg_weights', 'part_labels',
         'gt_boxes', 'voxel_centers', 'reg_src_targets', 'points',
     ]
 
+    # torch.from_numpy shares the batch memory, arrays collated into pinned buffers are copied asynchronously
     for k, v in example.items():
         if k in float_names:
             try:
-                example_torch[k] = torch.tensor(v, dtype=torch.float32, device=device).to(dtype)
-            except RuntimeError:
+                example_torch[k] = torch.from_numpy(np.ascontiguousarray(v)).to(
+                    device=device, dtype=dtype, non_blocking=True
+                )
+            except (RuntimeError, TypeError):
                 example_torch[k] = torch.zeros((v.shape[0], 1, 7), dtype=torch.float32, device=device).to(dtype)
         elif k in ['coordinates', 'box_cls_labels', 'num_points', 'seg_labels']:
-            example_torch[k] = torch.tensor(v, dtype=torch.int32, device=device)
+            example_torch[k] = torch.from_numpy(np.ascontiguousarray(v)).to(
+                device=device, dtype=torch.int32, non_blocking=True
+            )
         else:
             example_torch[k] = v
     return example_torch
@@ -5,6 +5,10 @@ import numpy.random as npr
 import numba
 from ...utils import common_utils
 
+# anchors and target assignment tables of the heads built in this process, keyed by feature map size + anchor config
+ANCHOR_CACHE = {}
+GRID_MARGIN = 1e-3
+
 
 def unmap(data, count, inds, fill=0):
     '''Unmap a subset of item (data) back to the original set of items (of
@@ -46,8 +50,8 @@ def create_anchors_3d_range(feature_size,
         anchor_range[0], anchor_range[3], feature_size[2], dtype=dtype)
     sizes = np.reshape(np.array(sizes, dtype=dtype), [-1, 3])
     rotations = np.array(rotations, dtype=dtype)
-    rets = np.meshgrid(
-        x_centers, y_centers, z_centers, rotations, indexing='ij')
+    rets = list(np.meshgrid(
+        x_centers, y_centers, z_centers, rotations, indexing='ij'))
     tile_shape = [1] * 5
     tile_shape[-2] = int(sizes.shape[0])
     for i in range(len(rets)):
@@ -226,6 +230,11 @@ class AnchorGeneratorRange(object):
     def feature_map_size(self):
         return self._feature_map_size
 
+    @property
+    def config_key(self):
+        return repr((self._anchor_ranges, self._sizes, self._rotations, self._class_name, self._match_threshold,
+                     self._unmatch_threshold, self._custom_values, np.dtype(self._dtype).str, self._feature_map_size))
+
     @property
     def num_anchors_per_localization(self):
         num_rot = len(self._rotations)
@@ -253,7 +262,33 @@ class TargetAssigner(object):
         self.box_coder = box_coder
         self.logger = logger
 
+    def anchor_cache_key(self, name, feature_map_size, use_multi_head):
+        feature_map_size = None if feature_map_size is None else tuple([int(x) for x in feature_map_size])
+        return name, feature_map_size, use_multi_head, tuple([a.config_key for a in self.anchor_generators])
+
     def generate_anchors(self, feature_map_size=None, use_multi_head=False):
+        """
+        the anchors are generated once per (feature map size, anchor config) and shared, do not modify them in place
+        """
+        key = self.anchor_cache_key('anchors', feature_map_size, use_multi_head)
+        if key not in ANCHOR_CACHE:
+            ANCHOR_CACHE[key] = self._generate_anchors(feature_map_size, use_multi_head)
+        return ANCHOR_CACHE[key]
+
+    def generate_anchors_dict(self, feature_map_size, use_multi_head=False):
+        """
+        the anchors are generated once per (feature map size, anchor config) and shared, do not modify them in place
+        """
+        key = self.anchor_cache_key('anchors_dict', feature_map_size, use_multi_head)
+        if key not in ANCHOR_CACHE:
+            anchors_dict = self._generate_anchors_dict(feature_map_size, use_multi_head)
+            if not use_multi_head:
+                for anchor_dict in anchors_dict.values():
+                    anchor_dict['assign_table'] = self.build_assign_table(anchor_dict['anchors'])
+            ANCHOR_CACHE[key] = anchors_dict
+        return ANCHOR_CACHE[key]
+
+    def _generate_anchors(self, feature_map_size=None, use_multi_head=False):
         anchors_list = []
         matched_thresholds = [a.match_threshold for a in self.anchor_generators]
         unmatched_thresholds = [a.unmatch_threshold for a in self.anchor_generators]
@@ -283,7 +318,7 @@ class TargetAssigner(object):
             'unmatched_thresholds': unmatched_thresholds
         }
 
-    def generate_anchors_dict(self, feature_map_size, use_multi_head=False):
+    def _generate_anchors_dict(self, feature_map_size, use_multi_head=False):
         anchors_list = []
         matched_thresholds = [a.match_threshold for a in self.anchor_generators]
         unmatched_thresholds = [a.unmatch_threshold for a in self.anchor_generators]
@@ -317,6 +352,159 @@ class TargetAssigner(object):
         ret = iou_jit(boxes1_bv, boxes2_bv, eps=0.0)
         return ret
 
+    @staticmethod
+    def build_assign_table(anchors):
+        """
+        :param anchors: (1, H, W, num_anchors_per_loc, 7 + ?) anchors of one class
+        :return: BEV boxes of the anchors for nearest_iou_similarity, and the anchor centers of the BEV grid used to
+            select the anchors near the gt boxes, None if the anchors are not on a regular grid
+        """
+        anchors_bv = rbbox2d_to_near_bbox(anchors.reshape(-1, anchors.shape[-1])[:, [0, 1, 3, 4, 6]])
+        x_centers, y_centers = anchors[0, 0, :, 0, 0], anchors[0, :, 0, 0, 1]
+        if anchors.shape[0] != 1 or np.any(np.diff(x_centers) <= 0) or np.any(np.diff(y_centers) <= 0) or \
+                np.any(anchors[0, ..., 0] != x_centers[None, :, None]) or \
+                np.any(anchors[0, ..., 1] != y_centers[:, None, None]):
+            return None
+        centers = anchors.reshape(-1, anchors.shape[-1])[:, 0:2]
+        half_extent = np.maximum(anchors_bv[:, 2:4] - centers, centers - anchors_bv[:, 0:2]).max(axis=0)
+        return {
+            'anchors_bv': anchors_bv,
+            'x_centers': x_centers,
+            'y_centers': y_centers,
+            'half_extent': half_extent + GRID_MARGIN,
+            'num_anchors_per_loc': anchors.shape[3]
+        }
+
+    @staticmethod
+    def get_anchors_near_boxes(assign_table, boxes_bv):
+        """
+        :param assign_table: from build_assign_table
+        :param boxes_bv: (N, 4) [x1, y1, x2, y2] BEV boxes
+        :return: sorted indices of the anchors whose BEV box may overlap with one of the boxes, the others have 0 iou
+        """
+        x_centers, y_centers = assign_table['x_centers'], assign_table['y_centers']
+        half_x, half_y = assign_table['half_extent']
+        x_start = np.searchsorted(x_centers, boxes_bv[:, 0] - half_x, side='left')
+        x_end = np.searchsorted(x_centers, boxes_bv[:, 2] + half_x, side='right')
+        y_start = np.searchsorted(y_centers, boxes_bv[:, 1] - half_y, side='left')
+        y_end = np.searchsorted(y_centers, boxes_bv[:, 3] + half_y, side='right')
+        near_mask = np.zeros((y_centers.shape[0], x_centers.shape[0], 1), dtype=np.bool_)
+        for k in range(boxes_bv.shape[0]):
+            near_mask[y_start[k]:y_end[k], x_start[k]:x_end[k]] = True
+        near_mask = np.broadcast_to(near_mask, (*near_mask.shape[:2], assign_table['num_anchors_per_loc']))
+        return np.flatnonzero(near_mask)
+
+    def assign_batch(self, anchors_dict, gt_boxes_list, gt_classes_list, gt_names_list):
+        """
+        same targets as assign_v2 sample by sample, without sampling (pos_fraction < 0) and with
+        nearest_iou_similarity: only the anchors near the gt boxes take part in the iou, and the labels of the whole
+        batch are assigned at once
+        :param anchors_dict: from generate_anchors_dict
+        :param gt_boxes_list: [(N1, 7), (N2, 7), ...]
+        :param gt_classes_list: [(N1), (N2), ...]
+        :param gt_names_list: [(N1), (N2), ...]
+        :return:
+            labels: (B, num_anchors)
+            bbox_targets, bbox_src_targets: (B, num_anchors, code_size)
+            bbox_outside_weights: (B, num_anchors)
+        """
+        assert self.pos_fraction is None and self.region_similarity_calculator == self.nearest_iou_similarity
+        batch_size = len(gt_boxes_list)
+        code_size = self.box_coder.code_size
+        gt_boxes_bv_list = [rbbox2d_to_near_bbox(gt_boxes[:, [0, 1, 3, 4, 6]]) for gt_boxes in gt_boxes_list]
+        max_num_gt = max([gt_boxes.shape[0] for gt_boxes in gt_boxes_list])
+
+        # the anchors of the classes are interleaved at each location: (H, W, num_anchors_per_loc of all classes)
+        num_anchors_per_loc = [anchor_dict['anchors'].shape[3] for anchor_dict in anchors_dict.values()]
+        num_locations = int(np.prod(list(anchors_dict.values())[0]['anchors'].shape[:3]))
+        num_anchors = num_locations * sum(num_anchors_per_loc)
+        dtype = list(anchors_dict.values())[0]['anchors'].dtype
+        labels = np.zeros((batch_size, num_anchors), dtype=np.int32)
+        bbox_targets = np.zeros((batch_size, num_anchors, code_size), dtype=dtype)
+        bbox_src_targets = np.zeros((batch_size, num_anchors, code_size), dtype=dtype)
+
+        # no gt box in the batch (e.g. frames with DontCare labels only): all the anchors are negatives
+        class_items = enumerate(anchors_dict.items()) if max_num_gt > 0 else []
+        for class_idx, (class_name, anchor_dict) in class_items:
+            anchors = anchor_dict['anchors'].reshape(-1, anchor_dict['anchors'].shape[-1])
+            anchor_offset = sum(num_anchors_per_loc[:class_idx])
+            assign_table = anchor_dict.get('assign_table', None)
+            anchors_bv = rbbox2d_to_near_bbox(anchors[:, [0, 1, 3, 4, 6]]) if assign_table is None \
+                else assign_table['anchors_bv']
+            matched_threshold = anchor_dict['matched_thresholds']
+            unmatched_threshold = anchor_dict['unmatched_thresholds']
+            # anchors far from the gt boxes have 0 iou, they are negatives unless the thresholds are not positive
+            use_near_anchors = assign_table is not None and np.all(matched_threshold > 0)
+
+            # overlaps of the selected anchors, (B, K, max_num_gt), -1 for the gt boxes of the other classes
+            gt_masks, anchor_inds_list, overlaps_list = [], [], []
+            for gt_names, gt_boxes_bv in zip(gt_names_list, gt_boxes_bv_list):
+                mask = np.array([c == class_name for c in gt_names], dtype=np.bool_)
+                if not mask.any():
+                    anchor_inds = np.zeros((0, ), dtype=np.int64)
+                elif use_near_anchors:
+                    anchor_inds = self.get_anchors_near_boxes(assign_table, gt_boxes_bv[mask])
+                else:
+                    anchor_inds = np.arange(anchors.shape[0])
+                overlaps = np.full((anchor_inds.shape[0], max_num_gt), -1, dtype=anchors_bv.dtype)
+                overlaps[:, np.flatnonzero(mask)] = iou_jit(anchors_bv[anchor_inds], gt_boxes_bv[mask], eps=0.0)
+                gt_masks.append(mask)
+                anchor_inds_list.append(anchor_inds)
+                overlaps_list.append(overlaps)
+            max_num_anchors = max([x.shape[0] for x in anchor_inds_list])
+            gt_masks = np.stack([np.pad(x, (0, max_num_gt - x.shape[0])) for x in gt_masks], axis=0)
+            valid_mask = np.stack([np.arange(max_num_anchors) < x.shape[0] for x in anchor_inds_list], axis=0)
+            anchor_inds = np.stack([np.pad(x, (0, max_num_anchors - x.shape[0])) for x in anchor_inds_list], axis=0)
+            overlaps = np.stack([np.pad(x, ((0, max_num_anchors - x.shape[0]), (0, 0)), constant_values=-1)
+                                 for x in overlaps_list], axis=0)
+
+            anchor_to_gt_argmax = overlaps.argmax(axis=2)
+            anchor_to_gt_max = np.take_along_axis(overlaps, anchor_to_gt_argmax[:, :, None], axis=2)[:, :, 0]
+            # for each gt use the anchors with highest overlap (including ties), gt boxes without overlap are skipped
+            gt_to_anchor_max = overlaps.max(axis=1, initial=-1)
+            force_mask = ((overlaps == gt_to_anchor_max[:, None, :]) & (gt_to_anchor_max[:, None, :] > 0)).any(axis=2)
+            pos_mask = anchor_to_gt_max >= matched_threshold[anchor_inds]
+            bg_mask = anchor_to_gt_max < unmatched_threshold[anchor_inds]
+
+            # same priority as create_target_np: forced positives, then negatives, then positives above threshold
+            gt_classes = np.stack([np.pad(x, (0, max_num_gt - x.shape[0])) for x in gt_classes_list])
+            assigned_classes = np.take_along_axis(gt_classes, anchor_to_gt_argmax, axis=1)
+            selected_labels = np.where(pos_mask, assigned_classes, -1)
+            selected_labels = np.where(bg_mask, 0, selected_labels)
+            selected_labels = np.where(force_mask, assigned_classes, selected_labels).astype(np.int32)
+
+            # indices of the anchors of this class among the anchors of all classes
+            global_inds = np.arange(anchors.shape[0]).reshape(num_locations, -1)
+            global_inds = global_inds + np.arange(num_locations)[:, None] * (sum(num_anchors_per_loc) - \
+                num_anchors_per_loc[class_idx]) + anchor_offset
+            global_inds = global_inds.reshape(-1)
+
+            if np.any(unmatched_threshold <= 0):
+                has_gt = gt_masks.any(axis=1)
+                labels[np.ix_(has_gt, global_inds[unmatched_threshold <= 0])] = -1
+            bs_idx = np.nonzero(valid_mask)[0]
+            labels[bs_idx, global_inds[anchor_inds[valid_mask]]] = selected_labels[valid_mask]
+
+            # the regression targets are set before the negatives are labeled, as in create_target_np
+            fg_mask = valid_mask & (pos_mask | force_mask) & (assigned_classes > 0)
+            fg_bs_idx, fg_anchor_inds = np.nonzero(fg_mask)[0], anchor_inds[fg_mask]
+            if fg_anchor_inds.shape[0] > 0:
+                fg_gt_boxes = np.concatenate([gt_boxes[inds] for gt_boxes, inds in zip(
+                    gt_boxes_list, np.split(anchor_to_gt_argmax[fg_mask], np.cumsum(fg_mask.sum(axis=1))[:-1]))])
+                fg_anchors = anchors[fg_anchor_inds]
+                bbox_targets[fg_bs_idx, global_inds[fg_anchor_inds]] = self.box_coder.encode_np(fg_gt_boxes, fg_anchors)
+                temp_src_gt_boxes = fg_gt_boxes.copy()
+                temp_src_gt_boxes[:, 0:3] = fg_gt_boxes[:, 0:3] - fg_anchors[:, 0:3]
+                bbox_src_targets[fg_bs_idx, global_inds[fg_anchor_inds]] = temp_src_gt_boxes
+
+        targets_dict = {
+            'labels': labels,
+            'bbox_targets': bbox_targets,
+            'bbox_src_targets': bbox_src_targets,
+            'bbox_outside_weights': (labels > 0).astype(dtype),
+        }
+        return targets_dict
+
     def assign_v2(self, anchors_dict, gt_boxes, anchors_mask=None, gt_classes=None, gt_names=None):
         prune_anchor_fn = None if anchors_mask is None else lambda _: np.where(anchors_mask)[0]
 
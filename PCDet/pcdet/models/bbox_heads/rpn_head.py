@@ -58,6 +58,15 @@ class AnchorHead(nn.Module):
         self.forward_ret_dict = None
         self.build_losses(cfg.MODEL.LOSSES)
 
+    def get_anchors(self, device):
+        """
+        :return: (num_anchors, 7) anchors on device, copied once per device and shared by the forward passes
+        """
+        anchors_torch = self.anchor_cache.setdefault('anchors_torch', {})
+        if device not in anchors_torch:
+            anchors_torch[device] = torch.from_numpy(self.anchor_cache['anchors']).to(device)
+        return anchors_torch[device]
+
     def build_losses(self, losses_cfg):
         # loss function definition
         self.cls_loss_func = loss_utils.SigmoidFocalClassificationLoss(alpha=0.25, gamma=2.0)
@@ -76,16 +85,27 @@ class AnchorHead(nn.Module):
         batch_size = gt_boxes.shape[0]
         gt_classes = gt_boxes[:, :, 7]
         gt_boxes = gt_boxes[:, :, :7]
-        targets_dict_list = []
+        gt_boxes_list, gt_classes_list, gt_names_list = [], [], []
         for k in range(batch_size):
             cur_gt = gt_boxes[k]
             cnt = cur_gt.__len__() - 1
             while cnt > 0 and cur_gt[cnt].sum() == 0:
                 cnt -= 1
-            cur_gt = cur_gt[:cnt + 1]
+            gt_boxes_list.append(cur_gt[:cnt + 1])
+            gt_classes_list.append(gt_classes[k][:cnt + 1])
+            gt_names_list.append(np.array(cfg.CLASS_NAMES)[gt_classes_list[-1].astype(np.int32) - 1])
+
+        if self.target_assigner.pos_fraction is None and \
+                self.target_assigner.region_similarity_calculator == self.target_assigner.nearest_iou_similarity:
+            return self.target_assigner.assign_batch(
+                anchors_dict=self.anchor_cache['anchors_dict'],
+                gt_boxes_list=gt_boxes_list,
+                gt_classes_list=gt_classes_list,
+                gt_names_list=gt_names_list
+            )
 
-            cur_gt_classes = gt_classes[k][:cnt + 1]
-            cur_gt_names = np.array(cfg.CLASS_NAMES)[cur_gt_classes.astype(np.int32) - 1]
+        targets_dict_list = []
+        for cur_gt, cur_gt_classes, cur_gt_names in zip(gt_boxes_list, gt_classes_list, gt_names_list):
             cur_target_dict = self.target_assigner.assign_v2(
                 anchors_dict=self.anchor_cache['anchors_dict'],
                 gt_boxes=cur_gt,
@@ -284,7 +304,12 @@ class RPNV2(AnchorHead):
         pi = 0.01
         nn.init.constant_(self.conv_cls.bias, -np.log((1 - pi) / pi))
 
-    def forward(self, x_in, bev=None, **kwargs):
+    def forward_dense(self, x_in):
+        """
+        the convolutions of the head, traced by export_utils to run the head with TorchScript or onnxruntime
+        :param x_in: (B, C, H, W) spatial features
+        :return: ret_dict with the multi-scale features and the box_preds, cls_preds, dir_cls_preds
+        """
         ups = []
         x = x_in
         ret_dict = {}
@@ -320,18 +345,27 @@ class RPNV2(AnchorHead):
             dir_cls_preds = self.conv_dir_cls(x)
             dir_cls_preds = dir_cls_preds.permute(0, 2, 3, 1).contiguous()
             ret_dict['dir_cls_preds'] = dir_cls_preds
+        return ret_dict
 
-        ret_dict['anchors'] = torch.from_numpy(self.anchor_cache['anchors']).cuda()
+    def forward(self, x_in, bev=None, **kwargs):
+        ret_dict = self.forward_dense(x_in)
+        # the decoding, the losses and the NMS run in fp32 under autocast
+        for key in ['box_preds', 'cls_preds', 'dir_cls_preds']:
+            if key in ret_dict:
+                ret_dict[key] = ret_dict[key].float()
+        box_preds = ret_dict['box_preds']
+
+        ret_dict['anchors'] = self.get_anchors(box_preds.device)
         if self.training:
             targets_dict = self.assign_targets(
                 gt_boxes=kwargs['gt_boxes'],
             )
 
             ret_dict.update({
-                'box_cls_labels': torch.from_numpy(targets_dict['labels']).cuda(),
-                'box_reg_targets': torch.from_numpy(targets_dict['bbox_targets']).cuda(),
-                'reg_src_targets': torch.from_numpy(targets_dict['bbox_src_targets']).cuda(),
-                'reg_weights': torch.from_numpy(targets_dict['bbox_outside_weights']).cuda(),
+                'box_cls_labels': torch.from_numpy(targets_dict['labels']).to(box_preds.device),
+                'box_reg_targets': torch.from_numpy(targets_dict['bbox_targets']).to(box_preds.device),
+                'reg_src_targets': torch.from_numpy(targets_dict['bbox_src_targets']).to(box_preds.device),
+                'reg_weights': torch.from_numpy(targets_dict['bbox_outside_weights']).to(box_preds.device),
             })
 
         self.forward_ret_dict = ret_dict
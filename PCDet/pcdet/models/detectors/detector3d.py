@@ -8,6 +8,7 @@ from ..rpn import rpn_modules
 from ..rcnn import rcnn_modules
 from ..bbox_heads import bbox_head_modules
 from ...utils import common_utils, box_utils
+from ...utils.checkpoint_store import load_checkpoint
 from ...ops.iou3d_nms import iou3d_nms_utils
 
 from ...config import cfg
@@ -125,64 +126,67 @@ class Detector3D(nn.Module):
         pred_dicts = []
 
         batch_size = batch_cls_preds.shape[0]
-        batch_index = np.arange(batch_size)
         batch_gt_boxes = input_dict.get('gt_boxes', None)
 
-        for index, cls_preds, box_preds in zip(batch_index, batch_cls_preds, batch_box_preds):
-            if not cfg.MODEL.RPN.RPN_HEAD.ARGS['encode_background_as_zeros'] and rcnn_ret_dict is None:
-                cls_preds = cls_preds[..., 1:]
-            normalized_scores = torch.sigmoid(cls_preds)
+        if not cfg.MODEL.RPN.RPN_HEAD.ARGS['encode_background_as_zeros'] and rcnn_ret_dict is None:
+            batch_cls_preds = batch_cls_preds[..., 1:]
+        batch_normalized_scores = torch.sigmoid(batch_cls_preds)
 
-            if rcnn_ret_dict is not None and batch_gt_boxes is not None:
+        if rcnn_ret_dict is not None and batch_gt_boxes is not None:
+            for index in range(batch_size):
                 self.generate_recall_record(
-                    box_preds,
+                    batch_box_preds[index],
                     rcnn_ret_dict['rois'][index],
                     batch_gt_boxes[index],
                     recall_dict,
                     thresh_list=cfg.MODEL.TEST.RECALL_THRESH_LIST
                 )
 
-            if cfg.MODEL.TEST.MULTI_CLASSES_NMS:
-                selected, final_labels = self.multi_classes_nms(
-                    rank_scores=cls_preds,
-                    normalized_scores=normalized_scores,
-                    box_preds=box_preds,
-                    score_thresh=cfg.MODEL.TEST.SCORE_THRESH,
-                    nms_thresh=cfg.MODEL.TEST.NMS_THRESH,
-                    nms_type=cfg.MODEL.TEST.NMS_TYPE
-                )
-                final_boxes = box_preds[selected]
-                final_scores = cls_preds[selected] if cfg.MODEL.TEST.USE_RAW_SCORE else normalized_scores[selected]
+        # the NMS of the whole batch is done at once, the results are then split by sample
+        if cfg.MODEL.TEST.MULTI_CLASSES_NMS:
+            selected_list, labels_list = self.multi_classes_nms(
+                rank_scores=batch_cls_preds,
+                normalized_scores=batch_normalized_scores,
+                box_preds=batch_box_preds,
+                score_thresh=cfg.MODEL.TEST.SCORE_THRESH,
+                nms_thresh=cfg.MODEL.TEST.NMS_THRESH,
+                nms_type=cfg.MODEL.TEST.NMS_TYPE
+            )
+            batch_final_scores = batch_cls_preds if cfg.MODEL.TEST.USE_RAW_SCORE else batch_normalized_scores
+            scores_list = [
+                batch_final_scores[index][selected_list[index], labels_list[index] - 1] for index in range(batch_size)
+            ]
+        else:
+            if len(batch_cls_preds.shape) > 2 and batch_cls_preds.shape[2] > 1:
+                batch_rank_scores, batch_class_labels = torch.max(batch_cls_preds, dim=-1)
+                batch_normalized_scores = torch.sigmoid(batch_rank_scores)
+                batch_class_labels = batch_class_labels + 1  # shift to [1, num_classes]
             else:
-                if len(cls_preds.shape) > 1 and cls_preds.shape[1] > 1:
-                    rank_scores, class_labels = torch.max(cls_preds, dim=-1)
-                    normalized_scores = torch.sigmoid(rank_scores)
-                    class_labels = class_labels + 1  # shift to [1, num_classes]
+                if rcnn_ret_dict is not None:
+                    batch_class_labels = rcnn_ret_dict['roi_labels']
                 else:
-                    if rcnn_ret_dict is not None:
-                        class_labels = rcnn_ret_dict['roi_labels'][index]
-                    else:
-                        class_labels = cls_preds.new_ones(cls_preds.shape[0])
-                    rank_scores = cls_preds.view(-1)
-                    normalized_scores = normalized_scores.view(-1)
-
-                selected = self.class_agnostic_nms(
-                    rank_scores=rank_scores,
-                    normalized_scores=normalized_scores,
-                    box_preds=box_preds,
-                    score_thresh=cfg.MODEL.TEST.SCORE_THRESH,
-                    nms_thresh=cfg.MODEL.TEST.NMS_THRESH,
-                    nms_type=cfg.MODEL.TEST.NMS_TYPE
-                )
-
-                final_labels = class_labels[selected]
-                final_scores = rank_scores[selected] if cfg.MODEL.TEST.USE_RAW_SCORE else normalized_scores[selected]
-                final_boxes = box_preds[selected]
+                    batch_class_labels = batch_cls_preds.new_ones(batch_cls_preds.shape[0:2])
+                batch_rank_scores = batch_cls_preds.view(batch_size, -1)
+                batch_normalized_scores = batch_normalized_scores.view(batch_size, -1)
+
+            selected_list = self.class_agnostic_nms(
+                rank_scores=batch_rank_scores,
+                normalized_scores=batch_normalized_scores,
+                box_preds=batch_box_preds,
+                score_thresh=cfg.MODEL.TEST.SCORE_THRESH,
+                nms_thresh=cfg.MODEL.TEST.NMS_THRESH,
+                nms_type=cfg.MODEL.TEST.NMS_TYPE
+            )
+            batch_final_scores = batch_rank_scores if cfg.MODEL.TEST.USE_RAW_SCORE else batch_normalized_scores
+            labels_list = [batch_class_labels[index][selected_list[index]] for index in range(batch_size)]
+            scores_list = [batch_final_scores[index][selected_list[index]] for index in range(batch_size)]
 
+        for index in range(batch_size):
+            selected = selected_list[index]
             record_dict = {
-                'boxes': final_boxes,
-                'scores': final_scores,
-                'labels': final_labels
+                'boxes': batch_box_preds[index][selected],
+                'scores': scores_list[index],
+                'labels': labels_list[index]
             }
 
             if rcnn_ret_dict is not None:
@@ -202,65 +206,86 @@ class Detector3D(nn.Module):
     @staticmethod
     def multi_classes_nms(rank_scores, normalized_scores, box_preds, score_thresh, nms_thresh, nms_type='nms_gpu'):
         """
-        :param rank_scores: (N, num_classes)
-        :param box_preds: (N, 7) [x, y, z, w, l, h, ry] in LiDAR coords
-        :param score_thresh: (N) or float
-        :param nms_thresh: (N) or float
+        :param rank_scores: (B, N, num_classes)
+        :param normalized_scores: (B, N, num_classes)
+        :param box_preds: (B, N, 7) [x, y, z, w, l, h, ry] in LiDAR coords
+        :param score_thresh: (num_classes) or float
+        :param nms_thresh: (num_classes) or float
         :param nms_type:
         :return:
+            selected_list: list of (K) indices of the selected boxes of each sample, sorted by class and score
+            labels_list: list of (K) labels of the selected boxes of each sample, in [1, num_classes]
         """
-        assert rank_scores.shape[1] == len(cfg.CLASS_NAMES), 'Rank_score shape: %s' % (str(rank_scores.shape))
-        selected_list = []
-        selected_labels = []
-        num_classes = rank_scores.shape[1]
-        boxes_for_nms = box_utils.boxes3d_to_bevboxes_lidar_torch(box_preds)
+        assert rank_scores.shape[2] == len(cfg.CLASS_NAMES), 'Rank_score shape: %s' % (str(rank_scores.shape))
+        batch_size, num_classes = rank_scores.shape[0], rank_scores.shape[2]
 
         score_thresh = score_thresh if isinstance(score_thresh, list) else [score_thresh for x in range(num_classes)]
         nms_thresh = nms_thresh if isinstance(nms_thresh, list) else [nms_thresh for x in range(num_classes)]
-        for k in range(0, num_classes):
-            class_scores_keep = normalized_scores[:, k] >= score_thresh[k]
-
-            if class_scores_keep.int().sum() > 0:
-                original_idxs = class_scores_keep.nonzero().view(-1)
-                cur_boxes_for_nms = boxes_for_nms[class_scores_keep]
-                cur_rank_scores = rank_scores[class_scores_keep, k]
-
-                cur_selected = getattr(iou3d_nms_utils, nms_type)(
-                    cur_boxes_for_nms, cur_rank_scores, nms_thresh[k]
-                )
-
-                if cur_selected.shape[0] == 0:
-                    continue
-                selected_list.append(original_idxs[cur_selected])
-                selected_labels.append(
-                    torch.full([cur_selected.shape[0]], k + 1, dtype=torch.int64, device=box_preds.device)
-                )
+        class_score_thresh = rank_scores.new_tensor(score_thresh).view(1, 1, -1)
+        batch_idx, box_idx, class_idx = (normalized_scores >= class_score_thresh).nonzero().unbind(dim=1)
+
+        # each (sample, class) is a separate NMS group
+        group_ids = batch_idx * num_classes + class_idx
+        boxes_for_nms = box_utils.boxes3d_to_bevboxes_lidar_torch(box_preds[batch_idx, box_idx])
+        scores_for_nms = rank_scores[batch_idx, box_idx, class_idx]
+
+        keep_list = []
+        for cur_nms_thresh in sorted(set(nms_thresh)):  # one NMS for each distinct threshold, usually a single one
+            cur_classes = class_idx.new_tensor([k for k in range(num_classes) if nms_thresh[k] == cur_nms_thresh])
+            cur_idxs = (class_idx.view(-1, 1) == cur_classes.view(1, -1)).any(dim=1).nonzero().view(-1)
+            cur_keep = iou3d_nms_utils.batched_nms(
+                boxes_for_nms[cur_idxs], scores_for_nms[cur_idxs], group_ids[cur_idxs],
+                batch_size * num_classes, cur_nms_thresh, nms_type
+            )
+            keep_list.append(cur_idxs[cur_keep])
+        keep = torch.cat(keep_list, dim=0)
+        if len(keep_list) > 1:
+            keep_groups = group_ids[keep]
+            keep = keep[torch.argsort(keep_groups * keep.shape[0] + torch.arange(keep.shape[0], device=keep.device))]
 
-        selected = torch.cat(selected_list, dim=0) if selected_list.__len__() > 0 else []
-        return selected, selected_labels
+        num_selected = torch.bincount(batch_idx[keep], minlength=batch_size).tolist()
+        selected_list = box_idx[keep].split(num_selected)
+        labels_list = (class_idx[keep] + 1).split(num_selected)
+        return selected_list, labels_list
 
     @staticmethod
     def class_agnostic_nms(rank_scores, normalized_scores, box_preds, score_thresh, nms_thresh, nms_type='nms_gpu'):
+        """
+        :param rank_scores: (B, N)
+        :param normalized_scores: (B, N)
+        :param box_preds: (B, N, 7) [x, y, z, w, l, h, ry] in LiDAR coords
+        :param score_thresh: float
+        :param nms_thresh: float
+        :param nms_type:
+        :return:
+            selected_list: list of (K) indices of the selected boxes of each sample, sorted by score
+        """
+        batch_size, num_boxes = rank_scores.shape
         scores_mask = (normalized_scores >= score_thresh)
-        rank_scores_masked = rank_scores[scores_mask]
-        cur_selected = []
-        if rank_scores_masked.shape[0] > 0:
-            box_preds = box_preds[scores_mask]
 
-            rank_scores_nms, indices = torch.topk(
-                rank_scores_masked, k=min(cfg.MODEL.TEST.NMS_PRE_MAXSIZE_LAST, rank_scores_masked.shape[0])
-            )
-            box_preds_nms = box_preds[indices]
-            boxes_for_nms = box_utils.boxes3d_to_bevboxes_lidar_torch(box_preds_nms)  #
+        # the top NMS_PRE_MAXSIZE_LAST boxes above the score threshold of each sample
+        rank_scores_masked = rank_scores.masked_fill(scores_mask == 0, float('-inf'))
+        rank_scores_nms, indices = torch.topk(
+            rank_scores_masked, k=min(cfg.MODEL.TEST.NMS_PRE_MAXSIZE_LAST, num_boxes), dim=1
+        )
+        batch_idx = torch.arange(batch_size, device=rank_scores.device).view(-1, 1).expand_as(indices)
+        valid_mask = scores_mask.gather(1, indices)
+        batch_idx, box_idx, rank_scores_nms = batch_idx[valid_mask], indices[valid_mask], rank_scores_nms[valid_mask]
 
-            keep_idx = getattr(iou3d_nms_utils, nms_type)(
-                boxes_for_nms, rank_scores_nms, nms_thresh
-            )
-            cur_selected = indices[keep_idx[:cfg.MODEL.TEST.NMS_POST_MAXSIZE_LAST]]
+        boxes_for_nms = box_utils.boxes3d_to_bevboxes_lidar_torch(box_preds[batch_idx, box_idx])
+        keep = iou3d_nms_utils.batched_nms(
+            boxes_for_nms, rank_scores_nms, batch_idx, batch_size, nms_thresh, nms_type
+        )
+
+        # at most NMS_POST_MAXSIZE_LAST boxes of each sample
+        keep_batch_idx = batch_idx[keep]
+        num_keep = torch.bincount(keep_batch_idx, minlength=batch_size)
+        first_keep = torch.cumsum(num_keep, dim=0) - num_keep
+        rank_in_sample = torch.arange(keep.shape[0], device=keep.device) - first_keep[keep_batch_idx]
+        keep = keep[rank_in_sample < cfg.MODEL.TEST.NMS_POST_MAXSIZE_LAST]
 
-        original_idxs = scores_mask.nonzero().view(-1)
-        selected = original_idxs[cur_selected]
-        return selected
+        num_selected = torch.bincount(batch_idx[keep], minlength=batch_size).tolist()
+        return box_idx[keep].split(num_selected)
 
     def generate_recall_record(self, box_preds, rois, gt_boxes, recall_dict, thresh_list=(0.5, 0.7)):
         cur_gt = gt_boxes
@@ -270,8 +295,9 @@ class Detector3D(nn.Module):
         cur_gt = cur_gt[:k + 1]
 
         if cur_gt.sum() > 0:
-            iou3d_roi = iou3d_nms_utils.boxes_iou3d_gpu(rois, cur_gt)
-            iou3d_rcnn = iou3d_nms_utils.boxes_iou3d_gpu(box_preds, cur_gt)
+            boxes_iou3d = iou3d_nms_utils.boxes_iou3d_gpu if box_preds.is_cuda else iou3d_nms_utils.boxes_iou3d_cpu
+            iou3d_roi = boxes_iou3d(rois, cur_gt)
+            iou3d_rcnn = boxes_iou3d(box_preds, cur_gt)
 
             for cur_thresh in thresh_list:
                 roi_recalled = (iou3d_roi.max(dim=0)[0] > cur_thresh).sum().item()
@@ -292,7 +318,7 @@ class Detector3D(nn.Module):
 
         logger.info('==> Loading parameters from checkpoint %s to %s' % (filename, 'CPU' if to_cpu else 'GPU'))
         loc_type = torch.device('cpu') if to_cpu else None
-        checkpoint = torch.load(filename, map_location=loc_type)
+        checkpoint = load_checkpoint(filename, map_location=loc_type)
         model_state_disk = checkpoint['model_state']
 
         if 'version' in checkpoint:
@@ -320,7 +346,7 @@ class Detector3D(nn.Module):
 
         logger.info('==> Loading parameters from checkpoint %s to %s' % (filename, 'CPU' if to_cpu else 'GPU'))
         loc_type = torch.device('cpu') if to_cpu else None
-        checkpoint = torch.load(filename, map_location=loc_type)
+        checkpoint = load_checkpoint(filename, map_location=loc_type)
         epoch = checkpoint.get('epoch', -1)
         it = checkpoint.get('it', 0.0)
 
@@ -0,0 +1,113 @@
+"""
+Export of the dense part of the detectors (the convolutions of RPNV2) to TorchScript and ONNX
+The voxelization, the sparse backbone / pillar scatter, the anchors and the NMS stay in Python, the exported graph
+replaces RPNV2.forward_dense and takes the spatial features of the backbone
+"""
+import inspect
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+DENSE_INPUT_NAME = 'spatial_features'
+
+
+def get_dense_output_names(rpn_head):
+    output_names = ['box_preds', 'cls_preds']
+    if rpn_head._use_direction_classifier:
+        output_names.append('dir_cls_preds')
+    return output_names
+
+
+class DenseHead(nn.Module):
+    """
+    RPNV2.forward_dense returning a tuple, as needed by torch.jit.trace and torch.onnx.export
+    """
+    def __init__(self, rpn_head):
+        super().__init__()
+        self.rpn_head = rpn_head
+        self.output_names = get_dense_output_names(rpn_head)
+
+    def forward(self, spatial_features):
+        ret_dict = self.rpn_head.forward_dense(spatial_features)
+        return tuple([ret_dict[key] for key in self.output_names])
+
+
+def get_dense_input(model, input_dict):
+    """
+    run the model once and catch the input of the dense head
+    :param model: eval mode detector
+    :param input_dict: batch from example_convert_to_torch
+    :return: (B, C, H, W) spatial features
+    """
+    captured = []
+    handle = model.rpn_head.register_forward_pre_hook(lambda module, inputs: captured.append(inputs[0]))
+    try:
+        with torch.no_grad():
+            model(input_dict)
+    finally:
+        handle.remove()
+    return captured[0]
+
+
+def export_torchscript(model, spatial_features, filename):
+    dense_head = DenseHead(model.rpn_head).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(dense_head, spatial_features, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(filename)
+    return filename
+
+
+def export_onnx(model, spatial_features, filename, opset_version=11):
+    """
+    the batch size is a dynamic axis, the spatial size is fixed by the grid of the config
+    """
+    dense_head = DenseHead(model.rpn_head).eval()
+    dynamic_axes = {key: {0: 'batch_size'} for key in [DENSE_INPUT_NAME] + dense_head.output_names}
+    # the TorchScript based exporter, recent torch versions default to the dynamo one
+    extra_args = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            dense_head, (spatial_features,), filename, input_names=[DENSE_INPUT_NAME],
+            output_names=dense_head.output_names, dynamic_axes=dynamic_axes, opset_version=opset_version,
+            **extra_args
+        )
+    return filename
+
+
+class TorchScriptDenseRunner(object):
+    def __init__(self, filename, rpn_head, device):
+        self.module = torch.jit.load(filename, map_location=device)
+        self.output_names = get_dense_output_names(rpn_head)
+
+    def __call__(self, spatial_features):
+        outputs = self.module(spatial_features)
+        return dict(zip(self.output_names, outputs))
+
+
+class OnnxDenseRunner(object):
+    def __init__(self, filename, rpn_head, num_threads=0):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required to run the exported ONNX model: pip install onnxruntime')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.output_names = get_dense_output_names(rpn_head)
+
+    def __call__(self, spatial_features):
+        outputs = self.session.run(self.output_names, {DENSE_INPUT_NAME: spatial_features.cpu().numpy()})
+        return {key: torch.from_numpy(val).to(spatial_features.device) for key, val in zip(self.output_names, outputs)}
+
+
+def set_dense_runner(model, runner):
+    """
+    :param runner: TorchScriptDenseRunner / OnnxDenseRunner, or None to go back to the eager head
+    """
+    if runner is not None:
+        model.rpn_head.forward_dense = runner
+    elif 'forward_dense' in model.rpn_head.__dict__:
+        del model.rpn_head.forward_dense
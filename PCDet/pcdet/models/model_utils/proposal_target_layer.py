@@ -44,175 +44,131 @@ def proposal_target_layer(input_dict, roi_sampler_cfg):
 
 def sample_rois_for_rcnn(roi_boxes3d, gt_boxes3d, roi_raw_scores, roi_labels, roi_sampler_cfg):
     """
+    the whole batch is sampled at once on the device of the rois, the random numbers come from the torch generator
+    of this device and nothing is copied back to the host
     :param roi_boxes3d: (B, M, 7 + ?) [x, y, z, w, l, h, ry] in LiDAR coords
     :param gt_boxes3d: (B, N, 7 + ? + 1) [x, y, z, w, l, h, ry, class]
-    :param roi_raw_scores: (B, N)
-    :param roi_labels: (B, N)
+    :param roi_raw_scores: (B, M)
+    :param roi_labels: (B, M)
     :return
-        batch_rois: (B, N, 7)
-        batch_gt_of_rois: (B, N, 7 + 1)
-        batch_roi_iou: (B, N)
+        batch_rois: (B, R, 7 + ?)
+        batch_gt_of_rois: (B, R, 7 + ? + 1)
+        batch_roi_iou: (B, R)
+        batch_roi_raw_scores: (B, R)
+        batch_roi_labels: (B, R)
     """
-    batch_size = roi_boxes3d.size(0)
-
-    fg_rois_per_image = int(np.round(roi_sampler_cfg.FG_RATIO * roi_sampler_cfg.ROI_PER_IMAGE))
-
-    code_size = roi_boxes3d.shape[-1]
-    batch_rois = gt_boxes3d.new(batch_size, roi_sampler_cfg.ROI_PER_IMAGE, code_size).zero_()
-    batch_gt_of_rois = gt_boxes3d.new(batch_size, roi_sampler_cfg.ROI_PER_IMAGE, code_size + 1).zero_()
-    batch_roi_iou = gt_boxes3d.new(batch_size, roi_sampler_cfg.ROI_PER_IMAGE).zero_()
-    batch_roi_raw_scores = gt_boxes3d.new(batch_size, roi_sampler_cfg.ROI_PER_IMAGE).zero_()
-    batch_roi_labels = gt_boxes3d.new(batch_size, roi_sampler_cfg.ROI_PER_IMAGE).zero_().long()
-
-    for idx in range(batch_size):
-        cur_roi, cur_gt, cur_roi_raw_scores, cur_roi_labels = \
-            roi_boxes3d[idx], gt_boxes3d[idx], roi_raw_scores[idx], roi_labels[idx]
-
-        k = cur_gt.__len__() - 1
-        while k > 0 and cur_gt[k].sum() == 0:
-            k -= 1
-        cur_gt = cur_gt[:k + 1]
-
-        if len(cfg.CLASS_NAMES) == 1:
-            iou3d = iou3d_nms_utils.boxes_iou3d_gpu(cur_roi, cur_gt[:, 0:7])  # (M, N)
-            max_overlaps, gt_assignment = torch.max(iou3d, dim=1)
-        else:
-            cur_gt_labels = cur_gt[:, -1].long()
-            max_overlaps, gt_assignment = get_maxiou3d_with_same_class(cur_roi, cur_roi_labels,
-                                                                       cur_gt[:, 0:7], cur_gt_labels)
-
-        # sample fg, easy_bg, hard_bg
-        fg_thresh = min(roi_sampler_cfg.REG_FG_THRESH, roi_sampler_cfg.CLS_FG_THRESH)
-        fg_inds = torch.nonzero((max_overlaps >= fg_thresh)).view(-1)
-
-        # TODO: this will mix the fg and bg when CLS_BG_THRESH_LO < iou < CLS_BG_THRESH
-        # fg_inds = torch.cat((fg_inds, roi_assignment), dim=0)  # consider the roi which has max_iou3d with gt as fg
-
-        easy_bg_inds = torch.nonzero((max_overlaps < roi_sampler_cfg.CLS_BG_THRESH_LO)).view(-1)
-        hard_bg_inds = torch.nonzero((max_overlaps < roi_sampler_cfg.REG_FG_THRESH) &
-                                     (max_overlaps >= roi_sampler_cfg.CLS_BG_THRESH_LO)).view(-1)
-
-        fg_num_rois = fg_inds.numel()
-        bg_num_rois = hard_bg_inds.numel() + easy_bg_inds.numel()
-
-        if fg_num_rois > 0 and bg_num_rois > 0:
-            # sampling fg
-            fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
-
-            rand_num = torch.from_numpy(np.random.permutation(fg_num_rois)).type_as(gt_boxes3d).long()
-            fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
-
-            # sampling bg
-            bg_rois_per_this_image = roi_sampler_cfg.ROI_PER_IMAGE - fg_rois_per_this_image
-            bg_inds = sample_bg_inds(hard_bg_inds, easy_bg_inds, bg_rois_per_this_image, roi_sampler_cfg)
-
-        elif fg_num_rois > 0 and bg_num_rois == 0:
-            # sampling fg
-            rand_num = np.floor(np.random.rand(roi_sampler_cfg.ROI_PER_IMAGE) * fg_num_rois)
-            rand_num = torch.from_numpy(rand_num).type_as(gt_boxes3d).long()
-            fg_inds = fg_inds[rand_num]
-            fg_rois_per_this_image = roi_sampler_cfg.ROI_PER_IMAGE
-            bg_rois_per_this_image = 0
-        elif bg_num_rois > 0 and fg_num_rois == 0:
-            # sampling bg
-            bg_rois_per_this_image = roi_sampler_cfg.ROI_PER_IMAGE
-            bg_inds = sample_bg_inds(hard_bg_inds, easy_bg_inds, bg_rois_per_this_image, roi_sampler_cfg)
-
-            fg_rois_per_this_image = 0
-        else:
-            print('maxoverlaps:(min=%f, max=%f)' % (max_overlaps.min().item(), max_overlaps.max().item()))
-            print('ERROR: FG=%d, BG=%d' % (fg_num_rois, bg_num_rois))
-            raise NotImplementedError
-
-        roi_list, roi_iou_list, roi_gt_list, roi_score_list, roi_labels_list = [], [], [], [], []
-        if fg_rois_per_this_image > 0:
-            fg_rois = cur_roi[fg_inds]
-            gt_of_fg_rois = cur_gt[gt_assignment[fg_inds]]
-            fg_iou3d = max_overlaps[fg_inds]
-
-            roi_list.append(fg_rois)
-            roi_iou_list.append(fg_iou3d)
-            roi_gt_list.append(gt_of_fg_rois)
-            roi_score_list.append(cur_roi_raw_scores[fg_inds])
-            roi_labels_list.append(cur_roi_labels[fg_inds])
-
-        if bg_rois_per_this_image > 0:
-            bg_rois = cur_roi[bg_inds]
-            gt_of_bg_rois = cur_gt[gt_assignment[bg_inds]]
-            bg_iou3d = max_overlaps[bg_inds]
-
-            roi_list.append(bg_rois)
-            roi_iou_list.append(bg_iou3d)
-            roi_gt_list.append(gt_of_bg_rois)
-            roi_score_list.append(cur_roi_raw_scores[bg_inds])
-            roi_labels_list.append(cur_roi_labels[bg_inds])
-
-        rois = torch.cat(roi_list, dim=0)
-        iou_of_rois = torch.cat(roi_iou_list, dim=0)
-        gt_of_rois = torch.cat(roi_gt_list, dim=0)
-        cur_roi_raw_scores = torch.cat(roi_score_list, dim=0)
-        cur_roi_labels = torch.cat(roi_labels_list, dim=0)
-
-        batch_rois[idx] = rois
-        batch_gt_of_rois[idx] = gt_of_rois
-        batch_roi_iou[idx] = iou_of_rois
-        batch_roi_raw_scores[idx] = cur_roi_raw_scores
-        batch_roi_labels[idx] = cur_roi_labels
+    max_overlaps, gt_assignment = get_max_iou3d_of_rois(roi_boxes3d, roi_labels, gt_boxes3d)
+    sampled_inds = sample_roi_inds(max_overlaps, roi_sampler_cfg)  # (B, R)
+
+    batch_rois = torch.gather(roi_boxes3d, 1, sampled_inds.unsqueeze(-1).repeat(1, 1, roi_boxes3d.shape[-1]))
+    batch_roi_iou = torch.gather(max_overlaps, 1, sampled_inds)
+    batch_roi_raw_scores = torch.gather(roi_raw_scores, 1, sampled_inds)
+    batch_roi_labels = torch.gather(roi_labels, 1, sampled_inds).long()
+    gt_inds = torch.gather(gt_assignment, 1, sampled_inds)
+    batch_gt_of_rois = torch.gather(gt_boxes3d, 1, gt_inds.unsqueeze(-1).repeat(1, 1, gt_boxes3d.shape[-1]))
 
     return batch_rois, batch_gt_of_rois, batch_roi_iou, batch_roi_raw_scores, batch_roi_labels
 
 
-def get_maxiou3d_with_same_class(rois, roi_labels, gt_boxes, gt_labels):
+def get_max_iou3d_of_rois(roi_boxes3d, roi_labels, gt_boxes3d):
     """
-    :param rois: (N, 7)
-    :param roi_labels: (N)
-    :param gt_boxes: (N, 8)
+    the zero padded gt boxes at the end of each sample are ignored (the first one is always kept), with several
+    classes a roi only matches the gt boxes of its class and has an iou of 0 if there is none
+    :param roi_boxes3d: (B, M, 7 + ?)
+    :param roi_labels: (B, M)
+    :param gt_boxes3d: (B, N, 7 + ? + 1)
     :return:
+        max_overlaps: (B, M)
+        gt_assignment: (B, M)
     """
-    max_overlaps = rois.new_zeros(rois.shape[0])
-    gt_assignment = roi_labels.new_zeros(roi_labels.shape[0])
-
-    for k in range(gt_labels.min().item(), gt_labels.max().item() + 1):
-        roi_mask = (roi_labels == k)
-        gt_mask = (gt_labels == k)
-        if roi_mask.sum() > 0 and gt_mask.sum() > 0:
-            cur_roi = rois[roi_mask]
-            cur_gt = gt_boxes[gt_mask]
-            original_gt_assignment = gt_mask.nonzero().view(-1)
-
-            iou3d = iou3d_nms_utils.boxes_iou3d_gpu(cur_roi, cur_gt)  # (M, N)
-            cur_max_overlaps, cur_gt_assignment = torch.max(iou3d, dim=1)
-            max_overlaps[roi_mask] = cur_max_overlaps
-            gt_assignment[roi_mask] = original_gt_assignment[cur_gt_assignment]
-
+    num_gt = gt_boxes3d.shape[1]
+    gt_range = torch.arange(num_gt, device=gt_boxes3d.device)
+    last_valid_gt = ((gt_boxes3d.sum(dim=-1) != 0).long() * gt_range).max(dim=1)[0]
+    gt_mask = (gt_range.unsqueeze(0) <= last_valid_gt.unsqueeze(1)).unsqueeze(1)  # (B, 1, N)
+
+    iou3d = iou3d_nms_utils.boxes_iou3d_batch(roi_boxes3d[:, :, 0:7].contiguous(),
+                                              gt_boxes3d[:, :, 0:7].contiguous())  # (B, M, N)
+    if len(cfg.CLASS_NAMES) > 1:
+        gt_mask = gt_mask & (roi_labels.long().unsqueeze(2) == gt_boxes3d[:, :, -1].long().unsqueeze(1))
+    iou3d = iou3d.masked_fill(~gt_mask, -1)
+
+    max_overlaps, gt_assignment = torch.max(iou3d, dim=2)
+    no_gt_mask = max_overlaps < 0
+    max_overlaps = max_overlaps.masked_fill(no_gt_mask, 0)
+    gt_assignment = gt_assignment.masked_fill(no_gt_mask, 0)
     return max_overlaps, gt_assignment
 
 
-def sample_bg_inds(hard_bg_inds, easy_bg_inds, bg_rois_per_this_image, roi_sampler_cfg):
-    if hard_bg_inds.numel() > 0 and easy_bg_inds.numel() > 0:
-        hard_bg_rois_num = int(bg_rois_per_this_image * roi_sampler_cfg.HARD_BG_RATIO)
-        easy_bg_rois_num = bg_rois_per_this_image - hard_bg_rois_num
-
-        # sampling hard bg
-        rand_idx = torch.randint(low=0, high=hard_bg_inds.numel(), size=(hard_bg_rois_num,)).long()
-        hard_bg_inds = hard_bg_inds[rand_idx]
-
-        # sampling easy bg
-        rand_idx = torch.randint(low=0, high=easy_bg_inds.numel(), size=(easy_bg_rois_num,)).long()
-        easy_bg_inds = easy_bg_inds[rand_idx]
-
-        bg_inds = torch.cat([hard_bg_inds, easy_bg_inds], dim=0)
-    elif hard_bg_inds.numel() > 0 and easy_bg_inds.numel() == 0:
-        hard_bg_rois_num = bg_rois_per_this_image
-        # sampling hard bg
-        rand_idx = torch.randint(low=0, high=hard_bg_inds.numel(), size=(hard_bg_rois_num,)).long()
-        bg_inds = hard_bg_inds[rand_idx]
-    elif hard_bg_inds.numel() == 0 and easy_bg_inds.numel() > 0:
-        easy_bg_rois_num = bg_rois_per_this_image
-        # sampling easy bg
-        rand_idx = torch.randint(low=0, high=easy_bg_inds.numel(), size=(easy_bg_rois_num,)).long()
-        bg_inds = easy_bg_inds[rand_idx]
+def get_sorted_inds(mask, rand_keys=None):
+    """
+    :param mask: (B, M)
+    :param rand_keys: (B, M) to shuffle the selected indices, None to keep them in order
+    :return:
+        sorted_inds: (B, M) the indices selected by mask come first
+        num_inds: (B)
+    """
+    if rand_keys is None:
+        keys = (~mask).float()
     else:
-        raise NotImplementedError
+        keys = torch.where(mask, rand_keys, torch.full_like(rand_keys, 2))
+    sorted_inds = torch.sort(keys, dim=1, stable=True)[1]
+    return sorted_inds, mask.sum(dim=1)
 
-    return bg_inds
+
+def sample_with_replacement(sorted_inds, num_inds, num_samples):
+    """
+    :param sorted_inds: (B, M) from get_sorted_inds
+    :param num_inds: (B)
+    :return:
+        (B, num_samples) uniformly drawn from the first num_inds indices of each sample
+    """
+    rand_pos = (torch.rand((sorted_inds.shape[0], num_samples), device=sorted_inds.device) *
+                num_inds.unsqueeze(1)).long()
+    rand_pos = torch.min(rand_pos, (num_inds.unsqueeze(1) - 1).clamp(min=0))
+    return torch.gather(sorted_inds, 1, rand_pos)
+
+
+def sample_roi_inds(max_overlaps, roi_sampler_cfg):
+    """
+    fg rois are drawn without replacement (with replacement if there is no bg), then the hard and easy bg rois with
+    replacement, as HARD_BG_RATIO of the bg or all of them from the one which is not empty
+    :param max_overlaps: (B, M)
+    :return:
+        sampled_inds: (B, R) the fg rois first and then the hard and easy bg rois
+    """
+    batch_size, num_rois = max_overlaps.shape
+    roi_per_image = roi_sampler_cfg.ROI_PER_IMAGE
+    fg_rois_per_image = int(np.round(roi_sampler_cfg.FG_RATIO * roi_per_image))
+
+    # sample fg, easy_bg, hard_bg
+    fg_thresh = min(roi_sampler_cfg.REG_FG_THRESH, roi_sampler_cfg.CLS_FG_THRESH)
+    fg_mask = max_overlaps >= fg_thresh
+    easy_bg_mask = max_overlaps < roi_sampler_cfg.CLS_BG_THRESH_LO
+    hard_bg_mask = (max_overlaps < roi_sampler_cfg.REG_FG_THRESH) & \
+                   (max_overlaps >= roi_sampler_cfg.CLS_BG_THRESH_LO)
+
+    # every roi is fg or bg, so a sample has no roi to draw from only if M is 0
+    fg_inds, fg_num_rois = get_sorted_inds(fg_mask, torch.rand_like(max_overlaps))
+    hard_bg_inds, hard_bg_num_rois = get_sorted_inds(hard_bg_mask)
+    easy_bg_inds, easy_bg_num_rois = get_sorted_inds(easy_bg_mask)
+    bg_num_rois = hard_bg_num_rois + easy_bg_num_rois
+
+    fg_rois_per_this_image = torch.where(bg_num_rois > 0, fg_num_rois.clamp(max=fg_rois_per_image),
+                                         (fg_num_rois > 0).long() * roi_per_image)
+    bg_rois_per_this_image = roi_per_image - fg_rois_per_this_image
+    hard_bg_rois_num = torch.where(
+        easy_bg_num_rois > 0, (bg_rois_per_this_image.double() * roi_sampler_cfg.HARD_BG_RATIO).long(),
+        bg_rois_per_this_image
+    ) * (hard_bg_num_rois > 0).long()
+
+    slots = torch.arange(roi_per_image, device=max_overlaps.device).unsqueeze(0)  # (1, R)
+    fg_without_replacement = torch.gather(fg_inds, 1, slots.clamp(max=num_rois - 1).repeat(batch_size, 1))
+    fg_with_replacement = sample_with_replacement(fg_inds, fg_num_rois, roi_per_image)
+    fg_sampled = torch.where((bg_num_rois > 0).unsqueeze(1), fg_without_replacement, fg_with_replacement)
+    hard_bg_sampled = sample_with_replacement(hard_bg_inds, hard_bg_num_rois, roi_per_image)
+    easy_bg_sampled = sample_with_replacement(easy_bg_inds, easy_bg_num_rois, roi_per_image)
+
+    is_fg = slots < fg_rois_per_this_image.unsqueeze(1)
+    is_hard_bg = slots < (fg_rois_per_this_image + hard_bg_rois_num).unsqueeze(1)
+    sampled_inds = torch.where(is_fg, fg_sampled, torch.where(is_hard_bg, hard_bg_sampled, easy_bg_sampled))
+    return sampled_inds
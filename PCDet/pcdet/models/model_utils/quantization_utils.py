@@ -0,0 +1,143 @@
+"""
+Post-training INT8 quantization for the inference on cpu
+RPNV2: static quantization of the 2D convolutions of the blocks / deblocks, calibrated on a few samples
+RCNN: dynamic quantization of the point-wise Conv1d MLPs, rewritten as nn.Linear
+The 1x1 output convolutions of RPNV2 stay in fp32 as the scores and the box residuals are sensitive to the rounding
+"""
+import torch
+import torch.nn as nn
+from . import pytorch_utils as pt_utils
+
+try:
+    from torch.ao import quantization
+except ImportError:
+    from torch import quantization
+
+
+def get_quantized_engine():
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError('this build of torch has no quantized engine')
+
+
+def fuse_conv_bn_relu(sequential):
+    """
+    fold the ZeroPad2d into the padding of the next convolution and fuse conv + bn + relu, the model must be in eval
+    :param sequential: a block or deblock of RPNV2
+    """
+    names = list(sequential._modules.keys())
+    modules = list(sequential._modules.values())
+    fuse_list = []
+    for k, module in enumerate(modules):
+        next_module = modules[k + 1] if k + 1 < len(modules) else None
+        if isinstance(module, nn.ZeroPad2d) and isinstance(next_module, nn.Conv2d) and \
+                len(set(module.padding)) == 1 and next_module.padding == (0, 0):
+            # quantized tensors are not padded, the convolution pads with the zero point
+            next_module.padding = (module.padding[0], module.padding[0])
+            setattr(sequential, names[k], nn.Identity())
+        elif isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)):
+            group = [names[k]]
+            if isinstance(next_module, nn.BatchNorm2d):
+                group.append(names[k + 1])
+            # conv transpose + bn + relu is not a fusion pattern, the relu runs on the quantized tensor
+            if isinstance(module, nn.Conv2d) and k + len(group) < len(modules) and \
+                    isinstance(modules[k + len(group)], nn.ReLU):
+                group.append(names[k + len(group)])
+            if len(group) > 1:
+                fuse_list.append(group)
+    if len(fuse_list) > 0:
+        quantization.fuse_modules(sequential, fuse_list, inplace=True)
+
+
+def prepare_rpn_head(rpn_head, engine):
+    """
+    wrap each block and deblock in quant / dequant stubs with observers, the concatenation and the output
+    convolutions run in fp32 between them
+    """
+    rpn_head.eval()
+    qconfig = quantization.get_default_qconfig(engine)
+    # per channel weights are not supported by the quantized ConvTranspose2d
+    deblock_qconfig = quantization.QConfig(activation=qconfig.activation, weight=quantization.default_weight_observer)
+    for module_list, cur_qconfig in [(rpn_head.blocks, qconfig), (rpn_head.deblocks, deblock_qconfig)]:
+        for k in range(len(module_list)):
+            fuse_conv_bn_relu(module_list[k])
+            wrapper = quantization.QuantWrapper(module_list[k])
+            wrapper.qconfig = cur_qconfig
+            quantization.prepare(wrapper, inplace=True)
+            module_list[k] = wrapper
+
+
+def convert_rpn_head(rpn_head):
+    for module_list in [rpn_head.blocks, rpn_head.deblocks]:
+        for wrapper in module_list:
+            quantization.convert(wrapper, inplace=True)
+
+
+class PointwiseLinear(nn.Module):
+    """
+    a Conv1d with kernel size 1 (and its BatchNorm1d) as a nn.Linear over the channels
+    """
+    def __init__(self, conv, bn=None):
+        super().__init__()
+        weight = conv.weight.detach()[:, :, 0]
+        bias = conv.bias.detach() if conv.bias is not None else weight.new_zeros(weight.shape[0])
+        if bn is not None:
+            scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+            weight = weight * scale.view(-1, 1)
+            bias = (bias - bn.running_mean) * scale + bn.bias.detach()
+        self.linear = nn.Linear(weight.shape[1], weight.shape[0])
+        self.linear.weight.data.copy_(weight)
+        self.linear.bias.data.copy_(bias)
+
+    def forward(self, x):
+        """
+        :param x: (B, C, N)
+        :return: (B, C_out, N)
+        """
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def quantize_rcnn_net(rcnn_net):
+    """
+    dynamic quantization of the shared / cls / reg MLPs, the sparse convolutions are not changed
+    """
+    rcnn_net.eval()
+    for module in rcnn_net.modules():
+        if not isinstance(module, pt_utils.Conv1d):
+            continue
+        conv = module.conv
+        if conv.kernel_size != (1,) or conv.stride != (1,) or conv.padding != (0,) or conv.groups != 1:
+            continue
+        bn = module.bn[0] if 'bn' in module._modules else None
+        module.conv = PointwiseLinear(conv, bn)
+        if bn is not None:
+            module.bn = nn.Identity()
+    quantization.quantize_dynamic(rcnn_net, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def quantize_model(model, calib_batches, engine=None):
+    """
+    quantize the detector in place, it then runs on cpu only
+    :param model: detector with loaded weights, on cpu
+    :param calib_batches: iterable of input dicts from example_convert_to_torch to calibrate the RPN activations
+    :param engine: quantized engine, the best one of this torch build by default
+    :return: number of calibration batches
+    """
+    engine = get_quantized_engine() if engine is None else engine
+    torch.backends.quantized.engine = engine
+    model.eval()
+
+    if model.rcnn_net is not None:
+        quantize_rcnn_net(model.rcnn_net)
+
+    num_calib = 0
+    if hasattr(model.rpn_head, 'blocks'):
+        prepare_rpn_head(model.rpn_head, engine)
+        with torch.no_grad():
+            for input_dict in calib_batches:
+                model(input_dict)
+                num_calib += 1
+        assert num_calib > 0, 'the static quantization of the RPN needs calibration samples'
+        convert_rpn_head(model.rpn_head)
+    return num_calib
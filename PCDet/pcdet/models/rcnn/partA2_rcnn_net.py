@@ -71,7 +71,7 @@ class RCNNHead(nn.Module):
         rcnn_loss = 0
         if loss_cfgs.RCNN_CLS_LOSS == 'BinaryCrossEntropy':
             rcnn_cls_flat = rcnn_cls.view(-1)
-            batch_loss_cls = F.binary_cross_entropy(torch.sigmoid(rcnn_cls_flat), rcnn_cls_labels, reduction='none')
+            batch_loss_cls = F.binary_cross_entropy_with_logits(rcnn_cls_flat, rcnn_cls_labels, reduction='none')
             cls_valid_mask = (rcnn_cls_labels >= 0).float()
             rcnn_loss_cls = (batch_loss_cls * cls_valid_mask).sum() / torch.clamp(cls_valid_mask.sum(), min=1.0)
             rcnn_loss_cls = rcnn_loss_cls * LOSS_WEIGHTS['rcnn_cls_weight']
@@ -15,34 +15,29 @@ class PointPillarsScatter(nn.Module):
         self.nchannels = input_channels
 
     def forward(self, voxel_features, coords, batch_size, **kwargs):
+        """
+        :param voxel_features: (N, C) features of the non-empty pillars
+        :param coords: (N, 4) [batch_idx, z_idx, y_idx, x_idx]
+        :param batch_size:
+        :return:
+            batch_canvas: (B, C * nz, ny, nx) pseudo image
+        """
         output_shape = kwargs['output_shape']
         nz, ny, nx = output_shape
-        # batch_canvas will be the final output.
-        batch_canvas = []
-        for batch_itt in range(batch_size):
-            # Create the canvas for this sample
-            canvas = torch.zeros(
-                self.nchannels,
-                nz * nx * ny,
-                dtype=voxel_features.dtype,
-                device=voxel_features.device)
-
-            # Only include non-empty pillars
-            batch_mask = coords[:, 0] == batch_itt
-            this_coords = coords[batch_mask, :]
-            indices = this_coords[:, 1] * nz + this_coords[:, 2] * nx + this_coords[:, 3]
-            indices = indices.type(torch.long)
-            voxels = voxel_features[batch_mask, :]
-            voxels = voxels.t()
-
-            # Now scatter the blob back to the canvas.
-            canvas[:, indices] = voxels
-
-            # Append to a list for later stacking.
-            batch_canvas.append(canvas)
-
-        # Stack to 3-dim tensor (batch-size, nchannels, nrows*ncols)
-        batch_canvas = torch.stack(batch_canvas, 0)
+        # batch_canvas will be the final output, the pillars of all the samples are scattered at once
+        batch_canvas = torch.zeros(
+            batch_size,
+            self.nchannels,
+            nz * nx * ny,
+            dtype=voxel_features.dtype,
+            device=voxel_features.device)
+
+        batch_indices = coords[:, 0].type(torch.long)
+        indices = coords[:, 1] * nz + coords[:, 2] * nx + coords[:, 3]
+        indices = indices.type(torch.long)
+
+        # the indexed shape of batch_canvas[batch_indices, :, indices] is (N, C)
+        batch_canvas[batch_indices, :, indices] = voxel_features
 
         # Undo the column stacking to final 4-dim tensor
         batch_canvas = batch_canvas.view(batch_size, self.nchannels * nz, ny, nx)
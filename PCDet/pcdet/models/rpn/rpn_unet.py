@@ -77,32 +77,47 @@ class UNetHead(nn.Module):
 
         point_indices = roiaware_pool3d_utils.points_in_boxes_cpu(points, gt_boxes).long()
         extend_point_indices = roiaware_pool3d_utils.points_in_boxes_cpu(points, extend_gt_boxes).long()
-        for k in range(gt_boxes.shape[0]):
-            fg_pt_flag = point_indices[k] > 0
-            fg_points = points[fg_pt_flag]
-            cls_labels[fg_pt_flag] = gt_classes[k]
-
-            # enlarge the bbox3d, ignore nearby points
-            fg_enlarge_flag = extend_point_indices[k] > 0
-            ignore_flag = fg_pt_flag ^ fg_enlarge_flag
-            cls_labels[ignore_flag] = -1
-
-            # part offset labels
-            transformed_points = fg_points - gt_boxes[k, 0:3]
-            transformed_points = common_utils.rotate_pc_along_z_torch(
-                transformed_points.view(1, -1, 3), -gt_boxes[k, 6]
-            )
-            part_reg_labels[fg_pt_flag] = (transformed_points / gt_boxes[k, 3:6]) + torch.tensor([0.5, 0.5, 0]).float()
 
-            if generate_bbox_reg_labels:
-                # rpn bbox regression target
-                center3d = gt_boxes[k, 0:3].clone()
-                center3d[2] += gt_boxes[k][5] / 2  # shift to center of 3D boxes
-                bbox_reg_labels[fg_pt_flag, 0:3] = center3d - fg_points
-                bbox_reg_labels[fg_pt_flag, 6] = gt_boxes[k, 6]  # dy
+        # later boxes overwrite the labels of earlier ones, so only the last box of each point matters
+        fg_flag = point_indices > 0  # (M, N)
+        ignore_flag = fg_flag ^ (extend_point_indices > 0)
+        box_rank = torch.arange(1, gt_boxes.shape[0] + 1).view(-1, 1)
+        if gt_boxes.shape[0] > 0:
+            last_box = ((fg_flag | ignore_flag).long() * box_rank).max(dim=0)[0] - 1
+            last_fg_box = (fg_flag.long() * box_rank).max(dim=0)[0] - 1
+        else:
+            last_box = last_fg_box = points.new_zeros(points.shape[0], dtype=torch.long) - 1
+
+        labeled_idx = torch.nonzero(last_box >= 0).view(-1)
+        labeled_box = last_box[labeled_idx]
+        cls_labels[labeled_idx] = torch.where(
+            fg_flag[labeled_box, labeled_idx], gt_classes[labeled_box].int(), torch.full_like(labeled_box, -1).int()
+        )
 
-                cur_mean_size = torch.tensor(self.mean_size[cfg.CLASS_NAMES[gt_classes[k] - 1]])
-                bbox_reg_labels[fg_pt_flag, 3:6] = (gt_boxes[k, 3:6] - cur_mean_size) / cur_mean_size
+        fg_pt_flag = last_fg_box >= 0
+        fg_points = points[fg_pt_flag]
+        fg_boxes = gt_boxes[last_fg_box[fg_pt_flag]]
+
+        # part offset labels, each point rotated by the heading of its own box
+        transformed_points = fg_points - fg_boxes[:, 0:3]
+        cosa, sina = torch.cos(-fg_boxes[:, 6]), torch.sin(-fg_boxes[:, 6])
+        transformed_points = torch.stack((
+            transformed_points[:, 0] * cosa + transformed_points[:, 1] * sina,
+            -transformed_points[:, 0] * sina + transformed_points[:, 1] * cosa,
+            transformed_points[:, 2]
+        ), dim=-1)
+        part_reg_labels[fg_pt_flag] = (transformed_points / fg_boxes[:, 3:6]) + torch.tensor([0.5, 0.5, 0]).float()
+
+        if generate_bbox_reg_labels:
+            # rpn bbox regression target
+            center3d = fg_boxes[:, 0:3].clone()
+            center3d[:, 2] += fg_boxes[:, 5] / 2  # shift to center of 3D boxes
+            bbox_reg_labels[fg_pt_flag, 0:3] = center3d - fg_points
+            bbox_reg_labels[fg_pt_flag, 6] = fg_boxes[:, 6]  # dy
+
+            box_mean_size = torch.tensor([self.mean_size[cfg.CLASS_NAMES[int(k) - 1]] for k in gt_classes]).float()
+            cur_mean_size = box_mean_size[last_fg_box[fg_pt_flag]]
+            bbox_reg_labels[fg_pt_flag, 3:6] = (fg_boxes[:, 3:6] - cur_mean_size) / cur_mean_size
 
         return cls_labels, part_reg_labels, bbox_reg_labels
 
@@ -132,7 +147,7 @@ class UNetHead(nn.Module):
         # if pos_normalizer > 0 & np.isnan(u_reg_preds[0][0].item()) is False:
         if pos_normalizer > 0:
             _a, _b = torch.sigmoid(u_reg_preds[pos_mask]), u_reg_labels[pos_mask]
-            u_loss_reg = F.binary_cross_entropy(torch.sigmoid(u_reg_preds[pos_mask]), u_reg_labels[pos_mask])
+            u_loss_reg = F.binary_cross_entropy_with_logits(u_reg_preds[pos_mask], u_reg_labels[pos_mask])
             loss_unet += u_loss_reg
             tb_dict['rpn_u_loss_reg'] = u_loss_reg.item()
 
@@ -86,20 +86,26 @@ class PFNLayer(nn.Module):
             self.norm = Empty(self.units)
 
     def forward(self, inputs):
-        x = self.linear(inputs)
-        # x = self.norm(x.permute(0, 2, 1).contiguous()).permute(0, 2, 1).contiguous()
-        total_points, voxel_points, channels = x.shape
-        x = self.norm(x.view(-1, channels)).view(total_points, voxel_points, channels)
-        x = F.relu(x)
-
-        x_max = torch.max(x, dim=1, keepdim=True)[0]
+        if not self.training and isinstance(self.norm, nn.BatchNorm1d):
+            # in eval mode the BatchNorm is a per channel affine transform, fold it into the linear layer
+            scale = self.norm.weight / torch.sqrt(self.norm.running_var + self.norm.eps)
+            x = F.linear(inputs, self.linear.weight * scale.view(-1, 1),
+                         self.norm.bias - self.norm.running_mean * scale)
+        else:
+            x = self.linear(inputs)
+            # x = self.norm(x.permute(0, 2, 1).contiguous()).permute(0, 2, 1).contiguous()
+            total_points, voxel_points, channels = x.shape
+            x = self.norm(x.view(-1, channels)).view(total_points, voxel_points, channels)
 
         if self.last_vfe:
-            return x_max
-        else:
-            x_repeat = x_max.repeat(1, inputs.shape[1], 1)
-            x_concatenated = torch.cat([x, x_repeat], dim=2)
-            return x_concatenated
+            # relu and max commute, only the max of each pillar goes through the relu
+            return F.relu(torch.max(x, dim=1, keepdim=True)[0])
+
+        x = F.relu(x)
+        x_max = torch.max(x, dim=1, keepdim=True)[0]
+        x_repeat = x_max.repeat(1, inputs.shape[1], 1)
+        x_concatenated = torch.cat([x, x_repeat], dim=2)
+        return x_concatenated
 
 
 class PillarFeatureNetOld2(VoxelFeatureExtractor):
@@ -166,12 +172,11 @@ class PillarFeatureNetOld2(VoxelFeatureExtractor):
         points_mean = features[:, :, :3].sum(dim=1, keepdim=True) / num_voxels.type_as(features).view(-1, 1, 1)
         f_cluster = features[:, :, :3] - points_mean
 
-        # Find distance of x, y, and z from pillar center
-        # f_center = features[:, :, :3]
-        f_center = torch.zeros_like(features[:, :, :3])
-        f_center[:, :, 0] = features[:, :, 0] - (coords[:, 3].to(dtype).unsqueeze(1) * self.vx + self.x_offset)
-        f_center[:, :, 1] = features[:, :, 1] - (coords[:, 2].to(dtype).unsqueeze(1) * self.vy + self.y_offset)
-        f_center[:, :, 2] = features[:, :, 2] - (coords[:, 1].to(dtype).unsqueeze(1) * self.vz + self.z_offset)
+        # Find distance of x, y, and z from pillar center, coords are [batch_idx, z_idx, y_idx, x_idx]
+        voxel_size = features.new_tensor([self.vx, self.vy, self.vz])
+        offset = features.new_tensor([self.x_offset, self.y_offset, self.z_offset])
+        pillar_center = coords[:, [3, 2, 1]].to(dtype) * voxel_size + offset
+        f_center = features[:, :, :3] - pillar_center.unsqueeze(dim=1)
 
         # Combine together feature decorations
         features_ls = [features, f_cluster, f_center]
@@ -184,8 +189,7 @@ class PillarFeatureNetOld2(VoxelFeatureExtractor):
         # empty pillars remain set to zeros.
         voxel_count = features.shape[1]
         mask = get_paddings_indicator(num_voxels, voxel_count, axis=0)
-        mask = torch.unsqueeze(mask, -1).type_as(features)
-        features *= mask
+        features *= mask.unsqueeze(dim=-1)
 
         # Forward pass through PFNLayers
         for pfn in self.pfn_layers:
@@ -0,0 +1,219 @@
+"""
+CPU version of the rotated BEV IoU and NMS in iou3d_nms_kernel.cu
+The overlap of two boxes follows the CUDA kernel step by step, boxes with disjoint enclosing rectangles are skipped
+"""
+import numba
+import numpy as np
+
+EPS = 1e-8
+CHECK_IN_BOX_MARGIN = 1e-5
+
+
+@numba.njit
+def _cross(p1x, p1y, p2x, p2y, p0x, p0y):
+    return (p1x - p0x) * (p2y - p0y) - (p2x - p0x) * (p1y - p0y)
+
+
+@numba.njit
+def _check_in_box2d(box, px, py):
+    center_x = (box[0] + box[2]) / 2
+    center_y = (box[1] + box[3]) / 2
+    angle_cos, angle_sin = np.cos(-box[4]), np.sin(-box[4])  # rotate the point in the opposite direction of box
+    rot_x = (px - center_x) * angle_cos + (py - center_y) * angle_sin + center_x
+    rot_y = -(px - center_x) * angle_sin + (py - center_y) * angle_cos + center_y
+    return box[0] - CHECK_IN_BOX_MARGIN < rot_x < box[2] + CHECK_IN_BOX_MARGIN and \
+        box[1] - CHECK_IN_BOX_MARGIN < rot_y < box[3] + CHECK_IN_BOX_MARGIN
+
+
+@numba.njit
+def _intersection(p1, p0, q1, q0, ans):
+    # fast exclusion
+    if not (min(p0[0], p1[0]) <= max(q0[0], q1[0]) and min(q0[0], q1[0]) <= max(p0[0], p1[0]) and
+            min(p0[1], p1[1]) <= max(q0[1], q1[1]) and min(q0[1], q1[1]) <= max(p0[1], p1[1])):
+        return False
+
+    # check cross standing
+    s1 = _cross(q0[0], q0[1], p1[0], p1[1], p0[0], p0[1])
+    s2 = _cross(p1[0], p1[1], q1[0], q1[1], p0[0], p0[1])
+    s3 = _cross(p0[0], p0[1], q1[0], q1[1], q0[0], q0[1])
+    s4 = _cross(q1[0], q1[1], p1[0], p1[1], q0[0], q0[1])
+    if not (s1 * s2 > 0 and s3 * s4 > 0):
+        return False
+
+    # calculate intersection of two lines
+    s5 = _cross(q1[0], q1[1], p1[0], p1[1], p0[0], p0[1])
+    if abs(s5 - s1) > EPS:
+        ans[0] = (s5 * q0[0] - s1 * q1[0]) / (s5 - s1)
+        ans[1] = (s5 * q0[1] - s1 * q1[1]) / (s5 - s1)
+    else:
+        a0, b0, c0 = p0[1] - p1[1], p1[0] - p0[0], p0[0] * p1[1] - p1[0] * p0[1]
+        a1, b1, c1 = q0[1] - q1[1], q1[0] - q0[0], q0[0] * q1[1] - q1[0] * q0[1]
+        d = a0 * b1 - a1 * b0
+        ans[0] = (b0 * c1 - b1 * c0) / d
+        ans[1] = (a1 * c0 - a0 * c1) / d
+    return True
+
+
+@numba.njit
+def _box_corners(box, corners):
+    """
+    :param box: (5) [x1, y1, x2, y2, ry]
+    :param corners: (5, 2) output, the first corner is repeated at the end
+    """
+    center_x = (box[0] + box[2]) / 2
+    center_y = (box[1] + box[3]) / 2
+    angle_cos, angle_sin = np.cos(box[4]), np.sin(box[4])
+    corners[0, 0], corners[0, 1] = box[0], box[1]
+    corners[1, 0], corners[1, 1] = box[2], box[1]
+    corners[2, 0], corners[2, 1] = box[2], box[3]
+    corners[3, 0], corners[3, 1] = box[0], box[3]
+    for k in range(4):
+        x, y = corners[k, 0], corners[k, 1]
+        corners[k, 0] = (x - center_x) * angle_cos + (y - center_y) * angle_sin + center_x
+        corners[k, 1] = -(x - center_x) * angle_sin + (y - center_y) * angle_cos + center_y
+    corners[4, 0], corners[4, 1] = corners[0, 0], corners[0, 1]
+
+
+@numba.njit
+def box_overlap(box_a, box_b):
+    """
+    :param box_a: (5) [x1, y1, x2, y2, ry]
+    :param box_b: (5) [x1, y1, x2, y2, ry]
+    :return: overlap area in BEV
+    """
+    box_a_corners = np.empty((5, 2), dtype=np.float32)
+    box_b_corners = np.empty((5, 2), dtype=np.float32)
+    _box_corners(box_a, box_a_corners)
+    _box_corners(box_b, box_b_corners)
+
+    # get intersection of lines
+    cross_points = np.zeros((16, 2), dtype=np.float32)
+    poly_center_x, poly_center_y = np.float32(0), np.float32(0)
+    cnt = 0
+    for i in range(4):
+        for j in range(4):
+            if _intersection(box_a_corners[i + 1], box_a_corners[i], box_b_corners[j + 1], box_b_corners[j],
+                             cross_points[cnt]):
+                poly_center_x += cross_points[cnt, 0]
+                poly_center_y += cross_points[cnt, 1]
+                cnt += 1
+
+    # check corners
+    for k in range(4):
+        if _check_in_box2d(box_a, box_b_corners[k, 0], box_b_corners[k, 1]):
+            cross_points[cnt] = box_b_corners[k]
+            poly_center_x += cross_points[cnt, 0]
+            poly_center_y += cross_points[cnt, 1]
+            cnt += 1
+        if _check_in_box2d(box_b, box_a_corners[k, 0], box_a_corners[k, 1]):
+            cross_points[cnt] = box_a_corners[k]
+            poly_center_x += cross_points[cnt, 0]
+            poly_center_y += cross_points[cnt, 1]
+            cnt += 1
+    if cnt == 0:
+        return np.float32(0)
+
+    poly_center_x /= cnt
+    poly_center_y /= cnt
+
+    # sort the points of polygon by the angle around the center
+    angles = np.empty(cnt, dtype=np.float32)
+    for k in range(cnt):
+        angles[k] = np.arctan2(cross_points[k, 1] - poly_center_y, cross_points[k, 0] - poly_center_x)
+    order = np.argsort(angles, kind='mergesort')
+
+    # get the overlap areas
+    area = np.float32(0)
+    x0, y0 = cross_points[order[0], 0], cross_points[order[0], 1]
+    for k in range(cnt - 1):
+        p, q = order[k], order[k + 1]
+        area += (cross_points[p, 0] - x0) * (cross_points[q, 1] - y0) - \
+            (cross_points[q, 0] - x0) * (cross_points[p, 1] - y0)
+    return abs(area) / 2
+
+
+@numba.njit
+def iou_bev(box_a, box_b):
+    sa = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    sb = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    s_overlap = box_overlap(box_a, box_b)
+    return s_overlap / max(sa + sb - s_overlap, EPS)
+
+
+@numba.njit
+def iou_normal(box_a, box_b):
+    left, right = max(box_a[0], box_b[0]), min(box_a[2], box_b[2])
+    top, bottom = max(box_a[1], box_b[1]), min(box_a[3], box_b[3])
+    inter_s = max(right - left, 0) * max(bottom - top, 0)
+    sa = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    sb = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    return inter_s / max(sa + sb - inter_s, EPS)
+
+
+def boxes_standup(boxes):
+    """
+    :param boxes: (N, 5) [x1, y1, x2, y2, ry]
+    :return: (N, 4) axis-aligned boxes enclosing the rotated boxes
+    """
+    half_w = (boxes[:, 2] - boxes[:, 0]) / 2
+    half_l = (boxes[:, 3] - boxes[:, 1]) / 2
+    center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    abs_cos, abs_sin = np.abs(np.cos(boxes[:, 4])), np.abs(np.sin(boxes[:, 4]))
+    extent_x = half_w * abs_cos + half_l * abs_sin + CHECK_IN_BOX_MARGIN
+    extent_y = half_w * abs_sin + half_l * abs_cos + CHECK_IN_BOX_MARGIN
+    return np.stack([center_x - extent_x, center_y - extent_y, center_x + extent_x, center_y + extent_y], axis=1)
+
+
+@numba.njit
+def boxes_overlap_bev_kernel(boxes_a, boxes_b, standup_a, standup_b, ans, return_iou):
+    """
+    :param ans: (M, N) zero initialized output, BEV iou if return_iou else the BEV overlap area
+    """
+    for i in range(boxes_a.shape[0]):
+        for j in range(boxes_b.shape[0]):
+            # boxes with disjoint enclosing rectangles do not overlap
+            if standup_a[i, 0] > standup_b[j, 2] or standup_b[j, 0] > standup_a[i, 2] or \
+                    standup_a[i, 1] > standup_b[j, 3] or standup_b[j, 1] > standup_a[i, 3]:
+                continue
+            if return_iou:
+                ans[i, j] = iou_bev(boxes_a[i], boxes_b[j])
+            else:
+                ans[i, j] = box_overlap(boxes_a[i], boxes_b[j])
+
+
+@numba.njit
+def nms_kernel(boxes, standup, group_ids, thresh, max_keep, normal):
+    """
+    greedy NMS over boxes sorted by score
+    :param boxes: (N, 5) [x1, y1, x2, y2, ry]
+    :param standup: (N, 4) enclosing axis-aligned boxes
+    :param group_ids: (N) boxes of different groups never suppress each other, the groups must be contiguous
+    :param thresh: iou threshold
+    :param max_keep: stop after keeping max_keep boxes, -1 to keep all
+    :param normal: use axis-aligned iou
+    :return: indices of the kept boxes
+    """
+    num_boxes = boxes.shape[0]
+    suppressed = np.zeros(num_boxes, dtype=np.bool_)
+    keep = np.empty(num_boxes, dtype=np.int64)
+    num_keep = 0
+    for i in range(num_boxes):
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        if num_keep == max_keep:
+            break
+        for j in range(i + 1, num_boxes):
+            if group_ids[j] != group_ids[i]:
+                break
+            if suppressed[j]:
+                continue
+            if standup[i, 0] > standup[j, 2] or standup[j, 0] > standup[i, 2] or \
+                    standup[i, 1] > standup[j, 3] or standup[j, 1] > standup[i, 3]:
+                continue
+            iou = iou_normal(boxes[i], boxes[j]) if normal else iou_bev(boxes[i], boxes[j])
+            if iou > thresh:
+                suppressed[j] = True
+    return keep[:num_keep]
@@ -3,9 +3,15 @@
 Written by Shaoshuai Shi
 All Rights Reserved 2019.
 """
+import math
+import numpy as np
 import torch
 from ...utils import box_utils
-from . import iou3d_nms_cuda
+from . import iou3d_nms_cpu
+try:
+    from . import iou3d_nms_cuda
+except ImportError:
+    iou3d_nms_cuda = None  # CPU only build, use the *_cpu functions
 
 
 def boxes_iou_bev(boxes_a, boxes_b):
@@ -57,11 +63,82 @@ def boxes_iou3d_gpu(boxes_a, boxes_b):
     return iou3d
 
 
-def nms_gpu(boxes, scores, thresh, pre_maxsize=None):
+def boxes_iou3d_batch(boxes_a, boxes_b):
+    """
+    :param boxes_a: (B, M, 7) [x, y, z, w, l, h, ry] in LiDAR
+    :param boxes_b: (B, N, 7) [x, y, z, w, l, h, ry] in LiDAR
+    :return:
+        ans_iou: (B, M, N) iou between the boxes of the same sample
+    """
+    batch_size, num_a, num_b = boxes_a.shape[0], boxes_a.shape[1], boxes_b.shape[1]
+    if boxes_a.is_cuda and iou3d_nms_cuda is not None:
+        # one kernel launch for all the pairs of the batch, the pairs across samples are dropped
+        iou3d = boxes_iou3d_gpu(boxes_a.reshape(-1, 7), boxes_b.reshape(-1, 7))
+        iou3d = iou3d.view(batch_size, num_a, batch_size, num_b).diagonal(dim1=0, dim2=2)  # (M, N, B)
+        return iou3d.permute(2, 0, 1).contiguous()
+    return torch.stack([boxes_iou3d_cpu(boxes_a[k], boxes_b[k]) for k in range(batch_size)], dim=0)
+
+
+def boxes_overlap_bev_cpu(boxes_a, boxes_b, return_iou=False):
+    """
+    :param boxes_a: (M, 5) [x1, y1, x2, y2, ry]
+    :param boxes_b: (N, 5) [x1, y1, x2, y2, ry]
+    :param return_iou: return the BEV iou instead of the overlap area
+    :return:
+        ans: (M, N)
+    """
+    boxes_a_np = boxes_a.detach().cpu().float().numpy()
+    boxes_b_np = boxes_b.detach().cpu().float().numpy()
+    ans = np.zeros((boxes_a_np.shape[0], boxes_b_np.shape[0]), dtype=np.float32)
+    iou3d_nms_cpu.boxes_overlap_bev_kernel(
+        boxes_a_np, boxes_b_np, iou3d_nms_cpu.boxes_standup(boxes_a_np), iou3d_nms_cpu.boxes_standup(boxes_b_np),
+        ans, return_iou
+    )
+    return torch.from_numpy(ans).to(boxes_a.device)
+
+
+def boxes_iou_bev_cpu(boxes_a, boxes_b):
+    """
+    :param boxes_a: (M, 5)
+    :param boxes_b: (N, 5)
+    :return:
+        ans_iou: (M, N)
+    """
+    return boxes_overlap_bev_cpu(boxes_a, boxes_b, return_iou=True)
+
+
+def boxes_iou3d_cpu(boxes_a, boxes_b):
+    """
+    :param boxes_a: (N, 7) [x, y, z, w, l, h, ry]  in LiDAR
+    :param boxes_b: (M, 7) [x, y, z, h, w, l, ry]
+    :return:
+        ans_iou: (M, N)
+    """
+    boxes_a_bev = box_utils.boxes3d_to_bevboxes_lidar_torch(boxes_a)
+    boxes_b_bev = box_utils.boxes3d_to_bevboxes_lidar_torch(boxes_b)
+    overlaps_bev = boxes_overlap_bev_cpu(boxes_a_bev, boxes_b_bev)
+
+    # height overlap
+    max_of_min = torch.max(boxes_a[:, 2].view(-1, 1), boxes_b[:, 2].view(1, -1))
+    min_of_max = torch.min((boxes_a[:, 2] + boxes_a[:, 5]).view(-1, 1), (boxes_b[:, 2] + boxes_b[:, 5]).view(1, -1))
+    overlaps_h = torch.clamp(min_of_max - max_of_min, min=0)
+
+    # 3d iou
+    overlaps_3d = overlaps_bev * overlaps_h
+    vol_a = (boxes_a[:, 3] * boxes_a[:, 4] * boxes_a[:, 5]).view(-1, 1)
+    vol_b = (boxes_b[:, 3] * boxes_b[:, 4] * boxes_b[:, 5]).view(1, -1)
+    iou3d = overlaps_3d / torch.clamp(vol_a + vol_b - overlaps_3d, min=1e-6)
+
+    return iou3d
+
+
+def nms_gpu(boxes, scores, thresh, pre_maxsize=None, post_maxsize=None):
     """
     :param boxes: (N, 5) [x1, y1, x2, y2, ry]
     :param scores: (N)
     :param thresh:
+    :param pre_maxsize: only the top pre_maxsize boxes by score are considered
+    :param post_maxsize: at most post_maxsize boxes are returned
     :return:
     """
     # areas = (x2 - x1) * (y2 - y1)
@@ -73,10 +150,12 @@ def nms_gpu(boxes, scores, thresh, pre_maxsize=None):
 
     keep = torch.LongTensor(boxes.size(0))
     num_out = iou3d_nms_cuda.nms_gpu(boxes, keep, thresh)
+    if post_maxsize is not None:
+        num_out = min(num_out, post_maxsize)
     return order[keep[:num_out].cuda()].contiguous()
 
 
-def nms_normal_gpu(boxes, scores, thresh):
+def nms_normal_gpu(boxes, scores, thresh, pre_maxsize=None, post_maxsize=None):
     """
     :param boxes: (N, 5) [x1, y1, x2, y2, ry]
     :param scores: (N)
@@ -85,14 +164,105 @@ def nms_normal_gpu(boxes, scores, thresh):
     """
     # areas = (x2 - x1) * (y2 - y1)
     order = scores.sort(0, descending=True)[1]
+    if pre_maxsize is not None:
+        order = order[:pre_maxsize]
 
     boxes = boxes[order].contiguous()
 
     keep = torch.LongTensor(boxes.size(0))
     num_out = iou3d_nms_cuda.nms_normal_gpu(boxes, keep, thresh)
+    if post_maxsize is not None:
+        num_out = min(num_out, post_maxsize)
     return order[keep[:num_out].cuda()].contiguous()
 
 
+def nms_cpu(boxes, scores, thresh, pre_maxsize=None, post_maxsize=None, normal=False, group_ids=None):
+    """
+    greedy rotated NMS on CPU, same interface and kept boxes as nms_gpu
+    :param boxes: (N, 5) [x1, y1, x2, y2, ry]
+    :param scores: (N)
+    :param thresh:
+    :param pre_maxsize: only the top pre_maxsize boxes by score are considered
+    :param post_maxsize: stop as soon as post_maxsize boxes are kept
+    :param normal: ignore the rotation, as nms_normal_gpu
+    :param group_ids: (N) optional, boxes of different groups never suppress each other
+    :return:
+        keep: (K) indices of the kept boxes on the device of boxes, sorted by score (by group and then by score
+            if group_ids is given)
+    """
+    order = scores.sort(0, descending=True)[1]
+    if pre_maxsize is not None:
+        order = order[:pre_maxsize]
+    if group_ids is not None:
+        # make each group contiguous, so the suppression of a box only scans its own group
+        order_groups = group_ids[order].long()
+        order = order[torch.argsort(order_groups * order.shape[0] + torch.arange(order.shape[0], device=order.device))]
+
+    boxes_np = boxes[order].detach().cpu().float().numpy()
+    standup = boxes_np[:, 0:4] if normal else iou3d_nms_cpu.boxes_standup(boxes_np)
+    if group_ids is None:
+        group_ids_np = np.zeros(boxes_np.shape[0], dtype=np.int64)
+    else:
+        group_ids_np = group_ids[order].cpu().long().numpy()
+    keep = iou3d_nms_cpu.nms_kernel(
+        boxes_np, np.ascontiguousarray(standup), group_ids_np, thresh,
+        -1 if post_maxsize is None else post_maxsize, normal
+    )
+    return order[torch.from_numpy(keep).to(order.device)].contiguous()
+
+
+def nms_normal_cpu(boxes, scores, thresh, pre_maxsize=None, post_maxsize=None, group_ids=None):
+    """
+    :param boxes: (N, 5) [x1, y1, x2, y2, ry]
+    :param scores: (N)
+    :param thresh:
+    :return:
+    """
+    return nms_cpu(
+        boxes, scores, thresh, pre_maxsize=pre_maxsize, post_maxsize=post_maxsize, normal=True, group_ids=group_ids
+    )
+
+
+def batched_nms(boxes, scores, group_ids, num_groups, thresh, nms_type='nms_gpu'):
+    """
+    NMS inside each group with a single call of nms_type
+    The CPU backends skip the pairs of different groups, for the CUDA ones the groups are moved apart on a grid so
+    their boxes cannot overlap (the offsets round the coordinates to the float32 precision of the grid, ~1e-4 m)
+    :param boxes: (N, 5) [x1, y1, x2, y2, ry]
+    :param scores: (N)
+    :param group_ids: (N) in [0, num_groups), e.g. sample_idx * num_classes + class_idx
+    :param num_groups:
+    :param thresh:
+    :param nms_type: name of the NMS function, nms_gpu, nms_cpu, ..., the CPU version is used for CPU tensors
+    :return:
+        keep: (K) indices of the kept boxes, sorted by group and then by score
+    """
+    if boxes.shape[0] == 0:
+        return group_ids.new_zeros(0, dtype=torch.long)
+
+    if not boxes.is_cuda:
+        nms_type = {'nms_gpu': 'nms_cpu', 'nms_normal_gpu': 'nms_normal_cpu'}.get(nms_type, nms_type)
+    if nms_type in ['nms_cpu', 'nms_normal_cpu']:
+        keep = globals()[nms_type](boxes, scores, thresh, group_ids=group_ids)
+    else:
+        # place the groups on a grid with cells larger than the extent of all the rotated boxes
+        half_diag = torch.sqrt((boxes[:, 2] - boxes[:, 0]) ** 2 + (boxes[:, 3] - boxes[:, 1]) ** 2) / 2
+        centers = (boxes[:, 0:2] + boxes[:, 2:4]) / 2
+        cell_size = (centers + half_diag.view(-1, 1)).max(dim=0)[0] - \
+            (centers - half_diag.view(-1, 1)).min(dim=0)[0] + 1
+        num_cols = int(math.ceil(math.sqrt(num_groups)))
+        grid = torch.stack([group_ids % num_cols, group_ids // num_cols], dim=1).to(boxes.dtype)
+        offsets = grid * cell_size.view(1, 2)
+        boxes_for_nms = boxes.clone()
+        boxes_for_nms[:, 0:2] += offsets
+        boxes_for_nms[:, 2:4] += offsets
+        keep = globals()[nms_type](boxes_for_nms, scores, thresh)
+
+    # keep is sorted by score, reorder it by group without breaking the score order inside a group
+    keep_groups = group_ids[keep].long()
+    order = torch.argsort(keep_groups * keep.shape[0] + torch.arange(keep.shape[0], device=keep.device))
+    return keep[order]
+
 if __name__ == '__main__':
     pass
 
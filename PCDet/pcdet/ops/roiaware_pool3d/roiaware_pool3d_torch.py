@@ -0,0 +1,185 @@
+"""
+Pure PyTorch version of roiaware_pool3d_cuda, used when the extension is not built or the tensors are on CPU
+The computations follow roiaware_pool3d_kernel.cu, the boxes are processed in chunks to bound the memory
+"""
+import numpy as np
+import torch
+
+MAX_CHUNK_PAIRS = 1 << 24  # (boxes x points) pairs tested at once
+
+
+def get_chunk_size(num_points):
+    return max(MAX_CHUNK_PAIRS // max(num_points, 1), 1)
+
+
+def check_pts_in_boxes3d(pts, boxes3d):
+    """
+    :param pts: (M, 3) [x, y, z] in LiDAR coordinate
+    :param boxes3d: (N, 7) [x, y, z, w, l, h, rz] in LiDAR coordinate, z is the bottom center
+    :return:
+        in_flag: (N, M) bool
+        local_x, local_y: (N, M) coordinates of the points in the frame of each box
+    """
+    x, y, z = pts[:, 0].view(1, -1), pts[:, 1].view(1, -1), pts[:, 2].view(1, -1)
+    cx, cy = boxes3d[:, 0:1], boxes3d[:, 1:2]
+    w, l, h = boxes3d[:, 3:4], boxes3d[:, 4:5], boxes3d[:, 5:6]
+    cz = boxes3d[:, 2:3] + h / 2  # shift to the center since cz in box3d is the bottom center
+
+    # should rotate pi/2 + alpha to translate LiDAR to local, the angle is summed in double as the kernel does
+    rot_angle = (boxes3d[:, 6:7].double() + np.pi / 2).float()
+    cosa, sina = torch.cos(rot_angle), torch.sin(rot_angle)
+    shift_x, shift_y = x - cx, y - cy
+    local_x = shift_x * cosa + shift_y * (-sina)
+    local_y = shift_x * sina + shift_y * cosa
+
+    in_flag = ((z - cz).abs() <= h / 2) & (local_x > -l / 2) & (local_x < l / 2) & \
+        (local_y > -w / 2) & (local_y < w / 2)
+    return in_flag, local_x, local_y
+
+
+def points_in_boxes_cpu(points, boxes):
+    """
+    :param points: (npoints, 3)
+    :param boxes: (N, 7) [x, y, z, w, l, h, rz] in LiDAR coordinate, z is the bottom center
+    :return point_indices: (N, npoints) int, 1 for the points inside the box
+    """
+    points, boxes = points.float(), boxes.float()
+    point_indices = points.new_zeros((boxes.shape[0], points.shape[0]), dtype=torch.int)
+    chunk_size = get_chunk_size(points.shape[0])
+    for start in range(0, boxes.shape[0], chunk_size):
+        in_flag = check_pts_in_boxes3d(points, boxes[start:start + chunk_size])[0]
+        point_indices[start:start + chunk_size] = in_flag.int()
+    return point_indices
+
+
+def points_in_boxes_batch(points, boxes):
+    """
+    :param points: (B, M, 3)
+    :param boxes: (B, T, 7)
+    :return box_idxs_of_pts: (B, M) int, index of the first box containing the point, default background = -1
+    """
+    points, boxes = points.float(), boxes.float()
+    batch_size, num_points, _ = points.shape
+    box_idxs_of_pts = points.new_full((batch_size, num_points), -1, dtype=torch.int)
+    chunk_size = get_chunk_size(num_points)
+    for bs_idx in range(batch_size):
+        cur_box_idxs = box_idxs_of_pts[bs_idx]
+        for start in range(0, boxes.shape[1], chunk_size):
+            in_flag = check_pts_in_boxes3d(points[bs_idx], boxes[bs_idx, start:start + chunk_size])[0]
+            first_box = in_flag.int().argmax(dim=0).int() + start
+            update_mask = in_flag.any(dim=0) & (cur_box_idxs == -1)
+            cur_box_idxs[update_mask] = first_box[update_mask]
+    return box_idxs_of_pts
+
+
+def collect_inside_pts(rois, pts, out_size, max_pts_each_voxel):
+    """
+    :param rois: (N, 7) [x, y, z, w, l, h, ry] in LiDAR coordinate, (x, y, z) is the bottom center of rois
+    :param pts: (npoints, 3)
+    :param out_size: (out_x, out_y, out_z)
+    :param max_pts_each_voxel: at most max_pts_each_voxel - 1 points (with the smallest indices) are kept per voxel
+    :return:
+        pair_pts: (P) index of the point of each kept (point, voxel) pair
+        pair_voxels: (P) flattened index of the voxel, in [0, N * out_x * out_y * out_z)
+    """
+    out_x, out_y, out_z = out_size
+    num_voxels = out_x * out_y * out_z
+    pair_pts_list, pair_voxels_list = [], []
+    chunk_size = get_chunk_size(pts.shape[0])
+    for start in range(0, rois.shape[0], chunk_size):
+        cur_rois = rois[start:start + chunk_size]
+        in_flag, local_x, local_y = check_pts_in_boxes3d(pts, cur_rois)
+        roi_idx, pt_idx = in_flag.nonzero().unbind(dim=1)
+        local_x, local_y = local_x[roi_idx, pt_idx], local_y[roi_idx, pt_idx]
+        local_z = pts[pt_idx, 2] - cur_rois[roi_idx, 2]
+        w, l, h = cur_rois[roi_idx, 3], cur_rois[roi_idx, 4], cur_rois[roi_idx, 5]
+
+        voxel_idxs = []
+        for local_coord, res, offset, cur_out in [(local_x, l / out_x, l / 2, out_x), (local_y, w / out_y, w / 2, out_y),
+                                                  (local_z, h / out_z, 0, out_z)]:
+            idx = ((local_coord + offset) / res).long()  # truncation as int() in the kernel
+            idx[idx < 0] = cur_out - 1  # negative values wrap around as unsigned int and are clipped to the max
+            voxel_idxs.append(idx.clamp(max=cur_out - 1))
+        x_idx, y_idx, z_idx = voxel_idxs
+
+        pair_pts_list.append(pt_idx)
+        pair_voxels_list.append((roi_idx + start) * num_voxels + x_idx * out_y * out_z + y_idx * out_z + z_idx)
+
+    pair_pts = torch.cat(pair_pts_list, dim=0)
+    pair_voxels = torch.cat(pair_voxels_list, dim=0)
+
+    # group the pairs by voxel, the points of a voxel stay in increasing order
+    pair_voxels, order = torch.sort(pair_voxels, stable=True)
+    pair_pts = pair_pts[order]
+    _, counts = torch.unique_consecutive(pair_voxels, return_counts=True)
+    first_pair = torch.cumsum(counts, dim=0) - counts
+    rank_in_voxel = torch.arange(pair_voxels.shape[0], device=pair_voxels.device) - \
+        torch.repeat_interleave(first_pair, counts)
+    keep = rank_in_voxel < max_pts_each_voxel - 1  # index 0 is the counter in the kernel
+    return pair_pts[keep], pair_voxels[keep]
+
+
+def roiaware_pool3d_forward(rois, pts, pts_feature, out_size, max_pts_each_voxel, pool_method):
+    """
+    :param rois: (N, 7) [x, y, z, w, l, h, ry] in LiDAR coordinate, (x, y, z) is the bottom center of rois
+    :param pts: (npoints, 3)
+    :param pts_feature: (npoints, C)
+    :param out_size: (out_x, out_y, out_z)
+    :param max_pts_each_voxel:
+    :param pool_method: 'max' or 'avg'
+    :return:
+        pooled_features: (N, out_x, out_y, out_z, C)
+        backward_info: tensors needed by roiaware_pool3d_backward
+    """
+    num_rois, num_channels = rois.shape[0], pts_feature.shape[-1]
+    num_voxels = num_rois * out_size[0] * out_size[1] * out_size[2]
+    pair_pts, pair_voxels = collect_inside_pts(rois.float(), pts.float(), out_size, max_pts_each_voxel)
+    pair_features = pts_feature[pair_pts]
+
+    pooled_features = pts_feature.new_zeros((num_voxels, num_channels))
+    if pool_method == 'max':
+        # reduce over the non-empty voxels only, the pairs are sorted by voxel
+        nonempty_voxels, pair_slots = torch.unique_consecutive(pair_voxels, return_inverse=True)
+        index = pair_slots.view(-1, 1).expand(-1, num_channels)
+        max_features = pts_feature.new_zeros((nonempty_voxels.shape[0], num_channels))
+        max_features.scatter_reduce_(0, index, pair_features, reduce='amax', include_self=False)
+
+        # the first point reaching the max, as the strict comparison of the kernel
+        is_max = pair_features == max_features[pair_slots]
+        candidates = torch.where(is_max, pair_pts.view(-1, 1), pts.shape[0])
+        argmax = torch.full_like(max_features, pts.shape[0], dtype=torch.long)
+        argmax.scatter_reduce_(0, index, candidates, reduce='amin', include_self=True)
+        pooled_features[nonempty_voxels] = max_features
+        backward_info = (nonempty_voxels, argmax)
+    else:
+        num_pts_of_voxels = torch.bincount(pair_voxels, minlength=num_voxels)
+        pooled_features.index_add_(0, pair_voxels, pair_features)
+        pooled_features /= num_pts_of_voxels.clamp(min=1).view(-1, 1).to(pooled_features.dtype)
+        backward_info = (pair_pts, pair_voxels, num_pts_of_voxels)
+
+    pooled_features = pooled_features.view(num_rois, out_size[0], out_size[1], out_size[2], num_channels)
+    return pooled_features, backward_info
+
+
+def roiaware_pool3d_backward(grad_out, backward_info, num_pts, pool_method):
+    """
+    :param grad_out: (N, out_x, out_y, out_z, C)
+    :param backward_info: from roiaware_pool3d_forward
+    :param num_pts:
+    :param pool_method: 'max' or 'avg'
+    :return:
+        grad_in: (npoints, C)
+    """
+    num_channels = grad_out.shape[-1]
+    grad_out = grad_out.reshape(-1, num_channels)
+    grad_in = grad_out.new_zeros((num_pts, num_channels))
+    if pool_method == 'max':
+        nonempty_voxels, argmax = backward_info
+        channel_idx = torch.arange(num_channels, device=argmax.device).view(1, -1)
+        grad_in.view(-1).index_add_(0, (argmax * num_channels + channel_idx).view(-1),
+                                    grad_out[nonempty_voxels].view(-1))
+    else:
+        pair_pts, pair_voxels, num_pts_of_voxels = backward_info
+        cur_grad = 1 / num_pts_of_voxels.clamp(min=1).to(grad_out.dtype)
+        grad_in.index_add_(0, pair_pts, grad_out[pair_voxels] * cur_grad[pair_voxels].view(-1, 1))
+    return grad_in
@@ -1,7 +1,15 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Function
-from . import roiaware_pool3d_cuda
+from . import roiaware_pool3d_torch
+try:
+    from . import roiaware_pool3d_cuda
+except ImportError:
+    roiaware_pool3d_cuda = None  # the extension is not built, fall back to roiaware_pool3d_torch
+
+
+def use_cuda_extension(*tensors):
+    return roiaware_pool3d_cuda is not None and all([x.is_cuda for x in tensors])
 
 
 class RoIAwarePool3d(nn.Module):
@@ -12,7 +20,8 @@ class RoIAwarePool3d(nn.Module):
 
     def forward(self, rois, pts, pts_feature, pool_method='max'):
         assert pool_method in ['max', 'avg']
-        return RoIAwarePool3dFunction.apply(rois, pts, pts_feature,
+        # the kernels take fp32 only, the features may be half under autocast
+        return RoIAwarePool3dFunction.apply(rois.float(), pts.float(), pts_feature.float(),
             self.out_size, self.max_pts_each_voxel, pool_method)
 
 
@@ -41,6 +50,14 @@ class RoIAwarePool3dFunction(Function):
         num_channels = pts_feature.shape[-1]
         num_pts = pts.shape[0]
 
+        ctx.use_cuda_extension = use_cuda_extension(rois, pts, pts_feature)
+        if not ctx.use_cuda_extension:
+            pooled_features, backward_info = roiaware_pool3d_torch.roiaware_pool3d_forward(
+                rois, pts, pts_feature, (out_x, out_y, out_z), max_pts_each_voxel, pool_method
+            )
+            ctx.roiaware_pool3d_for_backward = (backward_info, pool_method, num_pts, num_channels)
+            return pooled_features
+
         pooled_features = pts_feature.new_zeros((num_rois, out_x, out_y, out_z, num_channels))
         argmax = pts_feature.new_zeros((num_rois, out_x, out_y, out_z, num_channels), dtype=torch.int)
         pts_idx_of_voxels = pts_feature.new_zeros((num_rois, out_x, out_y, out_z, max_pts_each_voxel), dtype=torch.int)
@@ -59,6 +76,11 @@ class RoIAwarePool3dFunction(Function):
         :return:
             grad_in: (npoints, C)
         """
+        if not ctx.use_cuda_extension:
+            backward_info, pool_method, num_pts, num_channels = ctx.roiaware_pool3d_for_backward
+            grad_in = roiaware_pool3d_torch.roiaware_pool3d_backward(grad_out, backward_info, num_pts, pool_method)
+            return None, None, grad_in, None, None, None
+
         pts_idx_of_voxels, argmax, pool_method, num_pts, num_channels = ctx.roiaware_pool3d_for_backward
 
         grad_in = grad_out.new_zeros((num_pts, num_channels))
@@ -77,6 +99,9 @@ def points_in_boxes_gpu(points, boxes):
     assert boxes.shape[2] == 7
     batch_size, num_points, _ = points.shape
 
+    if not use_cuda_extension(points, boxes):
+        return roiaware_pool3d_torch.points_in_boxes_batch(points, boxes)
+
     box_idxs_of_pts = points.new_zeros((batch_size, num_points), dtype=torch.int).fill_(-1)
     roiaware_pool3d_cuda.points_in_boxes_gpu(boxes.contiguous(), points.contiguous(), box_idxs_of_pts)
 
@@ -92,6 +117,9 @@ def points_in_boxes_cpu(points, boxes):
     assert boxes.shape[1] == 7
     assert points.shape[1] == 3
 
+    if roiaware_pool3d_cuda is None:
+        return roiaware_pool3d_torch.points_in_boxes_cpu(points, boxes)
+
     point_indices = points.new_zeros((boxes.shape[0], points.shape[0]), dtype=torch.int)
     roiaware_pool3d_cuda.points_in_boxes_cpu(boxes.float().contiguous(), points.float().contiguous(), point_indices)
 
@@ -22,6 +22,42 @@ def in_hull(p, hull):
     return flag
 
 
+def points_in_boxes3d_lidar_candidates(points, boxes3d, extra_width=0.0):
+    """
+    Find the points around all boxes with one lookup over the x-sorted points, and get their box coordinates
+    :param points: (N, 3 + C)
+    :param boxes3d: (M, 7) [x, y, z, w, l, h, ry] in LiDAR coords, z is the bottom center
+    :param extra_width: the candidates also cover the boxes enlarged by extra_width
+    :return:
+        pts_idx: (P) point index of each (point, box) candidate pair, the pairs are sorted by box index
+        box_idx: (P) box index of each candidate pair
+        local_xyz: (P, 3) point coordinates relative to the bottom center, rotated by -ry as rotate_pc_along_z,
+            the box is [-w/2, w/2] x [-l/2, l/2] x [0, h] in this coordinate
+    """
+    radius = np.sqrt((boxes3d[:, 3].astype(np.float64) + 2 * extra_width) ** 2
+                     + (boxes3d[:, 4].astype(np.float64) + 2 * extra_width) ** 2) / 2 + 1e-3
+    x_order = np.argsort(points[:, 0], kind='stable')
+    sorted_x = points[x_order, 0]
+    start = np.searchsorted(sorted_x, boxes3d[:, 0] - radius, side='left')
+    end = np.searchsorted(sorted_x, boxes3d[:, 0] + radius, side='right')
+
+    counts = end - start
+    box_idx = np.repeat(np.arange(boxes3d.shape[0]), counts)
+    offsets = np.arange(box_idx.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    pts_idx = x_order[np.repeat(start, counts) + offsets]
+
+    near_y = np.abs(points[pts_idx, 1] - boxes3d[box_idx, 1]) <= radius[box_idx]
+    pts_idx, box_idx = pts_idx[near_y], box_idx[near_y]
+
+    shift_xyz = points[pts_idx, 0:3] - boxes3d[box_idx, 0:3]
+    cosa, sina = np.cos(-boxes3d[:, 6]), np.sin(-boxes3d[:, 6])
+    cosa, sina = cosa[box_idx], sina[box_idx]
+    local_xyz = np.stack((shift_xyz[:, 0] * cosa + shift_xyz[:, 1] * sina,
+                          -shift_xyz[:, 0] * sina + shift_xyz[:, 1] * cosa,
+                          shift_xyz[:, 2]), axis=-1)
+    return pts_idx, box_idx, local_xyz
+
+
 def boxes3d_to_corners3d_lidar_torch(boxes3d, bottom_center=True):
     """
     :param boxes3d: (N, 7) [x, y, z, w, l, h, ry] in LiDAR coords, see the definition of ry in KITTI dataset
@@ -39,8 +75,8 @@ def boxes3d_to_corners3d_lidar_torch(boxes3d, bottom_center=True):
     w, l, h = boxes3d[:, 3:4], boxes3d[:, 4:5], boxes3d[:, 5:6]
     ry = boxes3d[:, 6:7]
 
-    zeros = torch.cuda.FloatTensor(boxes_num, 1).fill_(0)
-    ones = torch.cuda.FloatTensor(boxes_num, 1).fill_(1)
+    zeros = boxes3d.new_zeros((boxes_num, 1))
+    ones = boxes3d.new_ones((boxes_num, 1))
     x_corners = torch.cat([w / 2., -w / 2., -w / 2., w / 2., w / 2., -w / 2., -w / 2., w / 2.], dim=1)  # (N, 8)
     y_corners = torch.cat([-l / 2., -l / 2., l / 2., l / 2., -l / 2., -l / 2., l / 2., l / 2.], dim=1)  # (N, 8)
     if bottom_center:
@@ -0,0 +1,221 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+from concurrent import futures
+import numpy as np
+import torch
+
+MANIFEST_SUFFIX = '.ckpt'
+
+
+class CheckpointStore(object):
+    """
+    Checkpoints as small manifests over a shared directory of content addressed tensors
+    <store_dir>/blobs/<hash[:2]>/<hash>: raw bytes of a tensor, written once whatever the number of checkpoints
+    holding it (e.g. the frozen or untouched BatchNorm buffers of the rounds)
+    <store_dir>/<name>.ckpt: pickled checkpoint with each tensor replaced by the hash, dtype and shape of its blob,
+    name can have sub dirs, e.g. global/round_0003 or client/tesla713/round_0003
+    The blobs and the manifest are written to a temporary file and renamed, a manifest exists only once all its blobs
+    do. There is a single writer, gc deletes the blobs of no manifest
+    """
+    def __init__(self, store_dir, fsync=False, logger=None):
+        """
+        :param fsync: flush the files to the disk before the rename
+        """
+        self.store_dir = Path(store_dir)
+        self.blob_dir = self.store_dir / 'blobs'
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def get_manifest_file(self, name):
+        return self.store_dir / (name + MANIFEST_SUFFIX)
+
+    def get_blob_file(self, blob_hash):
+        return self.blob_dir / blob_hash[:2] / blob_hash
+
+    def atomic_write(self, filename, write_fn):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = filename.with_name('%s.%d.tmp' % (filename.name, os.getpid()))
+        with open(str(tmp_file), 'wb') as f:
+            write_fn(f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(str(tmp_file), str(filename))
+
+    def put_tensor(self, val, stats):
+        """
+        :return: reference of the blob of the tensor, the blob is written if no other tensor has the same content
+        """
+        array = tensor_to_numpy(val).reshape(-1)
+        blob_hash = hashlib.blake2b(array.data, digest_size=20).hexdigest()
+        blob_file = self.get_blob_file(blob_hash)
+        if not blob_file.exists():
+            self.atomic_write(blob_file, array.tofile)
+            stats['new_blobs'] += 1
+            stats['new_bytes'] += array.nbytes
+        stats['num_tensors'] += 1
+        stats['num_bytes'] += array.nbytes
+        return {'__blob__': blob_hash, 'dtype': str(val.dtype).replace('torch.', ''), 'shape': list(val.shape)}
+
+    def pack(self, obj, stats):
+        if isinstance(obj, torch.Tensor):
+            return self.put_tensor(obj, stats)
+        if isinstance(obj, dict):
+            return type(obj)((key, self.pack(val, stats)) for key, val in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.pack(val, stats) for val in obj)
+        return obj
+
+    def save(self, name, checkpoint, step=None, meta=None):
+        """
+        :param checkpoint: e.g. {'model_state': ..., 'optimizer_state': ..., 'accumulated_iter': ...}, nested dicts,
+                           lists and tuples of tensors and picklable values
+        :param step: round or epoch of the checkpoint, for the keep_every retention
+        :return: stats: num_tensors, num_bytes, new_blobs, new_bytes (written) and time
+        """
+        start = time.perf_counter()
+        stats = {'num_tensors': 0, 'num_bytes': 0, 'new_blobs': 0, 'new_bytes': 0}
+        manifest_file = self.get_manifest_file(name)
+        manifest = {
+            'name': name, 'step': step, 'meta': meta if meta is not None else {}, 'time': time.time(),
+            'blob_dir': os.path.relpath(str(self.blob_dir), str(manifest_file.parent)),
+            'checkpoint': self.pack(checkpoint, stats)
+        }
+        self.atomic_write(manifest_file, lambda f: pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL))
+        stats['time'] = time.perf_counter() - start
+        return stats
+
+    def load(self, name, map_location=None, num_threads=4):
+        return load_checkpoint(self.get_manifest_file(name), map_location=map_location, num_threads=num_threads)
+
+    def load_manifest(self, name):
+        return read_manifest(self.get_manifest_file(name))
+
+    def exists(self, name):
+        return self.get_manifest_file(name).exists()
+
+    def list(self, prefix=''):
+        """
+        :return: names of the checkpoints under prefix from the oldest to the latest
+        """
+        manifest_files = [x for x in (self.store_dir / prefix).rglob('*' + MANIFEST_SUFFIX) if x.is_file()]
+        manifest_files.sort(key=os.path.getmtime)
+        return [x.relative_to(self.store_dir).as_posix()[:-len(MANIFEST_SUFFIX)] for x in manifest_files]
+
+    def latest(self, prefix=''):
+        names = self.list(prefix)
+        return names[-1] if len(names) > 0 else None
+
+    def delete(self, name):
+        self.get_manifest_file(name).unlink()
+
+    def apply_retention(self, prefix='', keep_last=None, keep_every=None):
+        """
+        in each dir under prefix (e.g. global and client/tesla713), delete the checkpoints but the keep_last latest
+        ones and those with a step multiple of keep_every, then the blobs used by no other checkpoint
+        :return: names of the deleted checkpoints
+        """
+        if keep_last is None:
+            return []
+        series = {}
+        for name in self.list(prefix):
+            series.setdefault(os.path.dirname(name), []).append(name)
+        deleted = []
+        for names in series.values():
+            for name in names[:max(len(names) - keep_last, 0)]:
+                step = self.load_manifest(name)['step']
+                if keep_every is not None and step is not None and step % keep_every == 0:
+                    continue
+                self.delete(name)
+                deleted.append(name)
+        if len(deleted) > 0:
+            self.gc()
+        return deleted
+
+    def gc(self):
+        """
+        :return: number of bytes of the deleted blobs
+        """
+        refs = []
+        for name in self.list():
+            collect_refs(self.load_manifest(name)['checkpoint'], refs)
+        used = set([ref['__blob__'] for ref in refs])
+        num_bytes = 0
+        for blob_file in self.blob_dir.glob('*/*'):
+            if blob_file.name not in used and not blob_file.name.endswith('.tmp'):
+                num_bytes += blob_file.stat().st_size
+                blob_file.unlink()
+        return num_bytes
+
+
+def tensor_to_numpy(val):
+    val = val.detach().cpu().contiguous()
+    if val.dtype == torch.bfloat16:
+        # no numpy bfloat16, same bytes
+        val = val.view(torch.int16)
+    return val.numpy()
+
+
+def read_manifest(manifest_file):
+    with open(str(manifest_file), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_blob(blob_file, ref):
+    dtype = getattr(torch, ref['dtype'])
+    storage_dtype = torch.int16 if dtype == torch.bfloat16 else dtype
+    array = np.fromfile(str(blob_file), dtype=torch.empty(0, dtype=storage_dtype).numpy().dtype)
+    val = torch.from_numpy(array).view(ref['shape'])
+    return val.view(dtype) if dtype != storage_dtype else val
+
+
+def load_checkpoint(filename, map_location=None, num_threads=4):
+    """
+    load a manifest of a CheckpointStore (.ckpt) with its blobs read by num_threads threads, or a torch.save file
+    :param map_location: as torch.load, the tensors of a manifest are on cpu for None
+    """
+    if not str(filename).endswith(MANIFEST_SUFFIX):
+        return torch.load(filename, map_location=map_location)
+    manifest_file = Path(filename)
+    manifest = read_manifest(manifest_file)
+    blob_dir = manifest_file.parent / manifest['blob_dir']
+
+    refs = []
+    collect_refs(manifest['checkpoint'], refs)
+    with futures.ThreadPoolExecutor(max(num_threads, 1)) as executor:
+        tensors = list(executor.map(lambda ref: load_blob(blob_dir / ref['__blob__'][:2] / ref['__blob__'], ref), refs))
+    if map_location is not None:
+        tensors = [val.to(map_location) for val in tensors]
+    return unpack(manifest['checkpoint'], iter(tensors))
+
+
+def collect_refs(obj, refs):
+    """
+    :param refs: the blob references of the packed checkpoint are appended, depth first
+    """
+    if isinstance(obj, dict) and '__blob__' in obj:
+        refs.append(obj)
+    elif isinstance(obj, dict):
+        for val in obj.values():
+            collect_refs(val, refs)
+    elif isinstance(obj, (list, tuple)):
+        for val in obj:
+            collect_refs(val, refs)
+
+
+def unpack(obj, tensors):
+    """
+    :param tensors: iterator of the tensors in the order of collect_refs
+    """
+    if isinstance(obj, dict):
+        if '__blob__' in obj:
+            return next(tensors)
+        return type(obj)((key, unpack(val, tensors)) for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(unpack(val, tensors) for val in obj)
+    return obj
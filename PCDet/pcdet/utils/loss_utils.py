@@ -138,7 +138,9 @@ class WeightedSmoothL1LocalizationLoss(Loss):
         self._sigma = sigma
         if code_weights is not None:
             self._code_weights = np.array(code_weights, dtype=np.float32)
-            self._code_weights = torch.from_numpy(self._code_weights).cuda()
+            self._code_weights = torch.from_numpy(self._code_weights)
+            if torch.cuda.is_available():
+                self._code_weights = self._code_weights.cuda()  # type_as in _compute_loss moves it to the cpu if needed
         else:
             self._code_weights = None
         self._codewise = codewise
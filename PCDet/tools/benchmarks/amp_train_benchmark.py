@@ -0,0 +1,121 @@
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from torch.nn.utils import clip_grad_norm_
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.models import build_network, model_fn_decorator, to_channels_last
+from pointpillar_cpu_benchmark import RandomSceneDataset, set_pointpillar_cfg
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # tools
+from train_utils.optimization import build_optimizer
+from train_utils.train_utils import LossScaler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PointPillars training iteration time, fp32 vs mixed precision')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml',
+                        help='the data, anchor and optimization configs are taken from it')
+    parser.add_argument('--modes', type=str, default='fp32,amp,amp_channels_last',
+                        help='comma separated, amp is fp16 with CUDA and bf16 on cpu, or fp16 / bf16 explicitly')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_points', type=int, default=20000)
+    parser.add_argument('--num_iters', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def random_gt_boxes(num_boxes):
+    """
+    :return: (N, 8) [x, y, z, w, l, h, rz, class] cars in the field of view
+    """
+    return np.concatenate([
+        np.random.uniform([5, -20, -1.7], [60, 20, -1.0], size=(num_boxes, 3)),
+        np.random.uniform([1.5, 3.5, 1.4], [1.8, 4.5, 1.7], size=(num_boxes, 3)),
+        np.random.uniform(-np.pi, np.pi, size=(num_boxes, 1)),
+        np.ones((num_boxes, 1))
+    ], axis=1).astype(np.float32)
+
+
+def get_amp_dtype(mode):
+    if mode.startswith('fp32'):
+        return None
+    if mode.startswith('amp'):
+        return torch.float16 if torch.cuda.is_available() else torch.bfloat16
+    return {'fp16': torch.float16, 'bf16': torch.bfloat16}[mode.split('_')[0]]
+
+
+def train_iters(model, batches, amp_dtype, optim_cfg):
+    """
+    the steps of train_one_epoch
+    :return: ms per iteration without the first one, the losses, the number of skipped steps
+    """
+    optimizer = build_optimizer(model, optim_cfg)
+    optimizer.lr = optim_cfg.LR
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    loss_scaler = LossScaler(device_type) if amp_dtype == torch.float16 else None
+    model_func = model_fn_decorator(amp_dtype=amp_dtype)
+    model.train()
+
+    losses = []
+    elapsed = 0
+    for idx, batch in enumerate([batches[0]] + batches):
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        loss, tb_dict, disp_dict = model_func(model, batch)
+        if loss_scaler is None:
+            loss.backward()
+            clip_grad_norm_(model.parameters(), optim_cfg.GRAD_NORM_CLIP)
+            optimizer.step()
+        else:
+            loss_scaler.backward_and_step(loss, optimizer, model.parameters(), optim_cfg.GRAD_NORM_CLIP)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if idx == 0:
+            continue  # warm up
+        elapsed += time.perf_counter() - start
+        losses.append(loss.item())
+    num_skips = loss_scaler.num_overflow_skips if loss_scaler is not None else 0
+    return elapsed / len(batches) * 1000, losses, num_skips
+
+
+def main():
+    args = parse_args()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    set_pointpillar_cfg()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    dataset = RandomSceneDataset(args.num_points)
+    init_model = build_network(dataset)
+    batches = []
+    for _ in range(args.num_iters):
+        data_list = []
+        for _ in range(args.batch_size):
+            data_dict = dataset.voxelize(dataset.random_points())
+            data_dict['gt_boxes'] = random_gt_boxes(np.random.randint(5, 20))
+            data_list.append(data_dict)
+        batches.append(dataset.collate_batch(data_list))
+    print('PointPillars training, batch size %d, %d threads, cuda: %s'
+          % (args.batch_size, torch.get_num_threads(), torch.cuda.is_available()))
+
+    fp32_ms = None
+    for mode in args.modes.split(','):
+        model = copy.deepcopy(init_model)
+        if mode.endswith('channels_last'):
+            to_channels_last(model)
+        amp_dtype = get_amp_dtype(mode)
+        cur_ms, losses, num_skips = train_iters(model, batches, amp_dtype, cfg.MODEL.TRAIN.OPTIMIZATION)
+        fp32_ms = cur_ms if fp32_ms is None and amp_dtype is None else fp32_ms
+        msg = '%-20s (%s): %.1f ms/iter' % (mode, str(amp_dtype).replace('torch.', '') if amp_dtype else 'fp32', cur_ms)
+        if fp32_ms is not None and amp_dtype is not None:
+            msg += ' (%.2fx vs fp32)' % (fp32_ms / cur_ms)
+        msg += ', losses %s, %d overflow skips' % (' '.join(['%.3f' % x for x in losses]), num_skips)
+        print(msg)
+
+
+if __name__ == '__main__':
+    main()
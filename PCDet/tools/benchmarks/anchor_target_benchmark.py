@@ -0,0 +1,97 @@
+import argparse
+import time
+import numpy as np
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.models.bbox_heads.anchor_target_assigner import AnchorGeneratorRange, TargetAssigner
+from pcdet.utils import box_coder_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='anchor target assignment, per sample vs batched')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--max_num_gt', type=int, default=40, help='gt boxes per sample')
+    parser.add_argument('--repeat', type=int, default=10, help='number of batches to time')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def build_target_assigner(target_cfg):
+    # same as AnchorHead, for all the classes of ANCHOR_GENERATOR
+    anchor_generators = [AnchorGeneratorRange(
+        anchor_ranges=a_cfg['anchor_range'],
+        sizes=a_cfg['sizes'],
+        rotations=a_cfg['rotations'],
+        class_name=a_cfg['class_name'],
+        match_threshold=a_cfg['matched_threshold'],
+        unmatch_threshold=a_cfg['unmatched_threshold']
+    ) for a_cfg in target_cfg.ANCHOR_GENERATOR]
+    return TargetAssigner(
+        anchor_generators=anchor_generators,
+        pos_fraction=target_cfg.SAMPLE_POS_FRACTION,
+        sample_size=target_cfg.SAMPLE_SIZE,
+        region_similarity_fn_name=target_cfg.REGION_SIMILARITY_FN,
+        box_coder=getattr(box_coder_utils, target_cfg.BOX_CODER)()
+    )
+
+
+def random_gt_boxes(max_num_gt, class_names, anchor_cfgs):
+    num_gt = np.random.randint(1, max_num_gt + 1)
+    gt_classes = np.random.randint(1, len(class_names) + 1, size=num_gt)
+    point_cloud_range = cfg.DATA_CONFIG.POINT_CLOUD_RANGE
+    sizes = np.array([np.array(anchor_cfgs[k - 1]['sizes']).reshape(-1, 3)[0] for k in gt_classes])
+    gt_boxes = np.concatenate([
+        np.random.uniform(point_cloud_range[0:2], point_cloud_range[3:5], size=(num_gt, 2)),
+        np.random.uniform(-1.8, -0.6, size=(num_gt, 1)),
+        sizes * np.random.uniform(0.8, 1.2, size=(num_gt, 3)),
+        np.random.uniform(-np.pi, np.pi, size=(num_gt, 1))
+    ], axis=1).astype(np.float32)
+    return gt_boxes, gt_classes.astype(np.float32), np.array(class_names)[gt_classes - 1]
+
+
+def main():
+    args = parse_args()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    target_cfg = cfg.MODEL.RPN.RPN_HEAD.TARGET_CONFIG
+    class_names = [a_cfg['class_name'] for a_cfg in target_cfg.ANCHOR_GENERATOR]
+
+    grid_size = (np.array(cfg.DATA_CONFIG.POINT_CLOUD_RANGE[3:6]) - np.array(cfg.DATA_CONFIG.POINT_CLOUD_RANGE[0:3])) \
+        / np.array(cfg.DATA_CONFIG.VOXEL_GENERATOR.VOXEL_SIZE)
+    feature_map_size = np.round(grid_size).astype(np.int64)[:2] // target_cfg.DOWNSAMPLED_FACTOR
+    feature_map_size = [*[int(x) for x in feature_map_size], 1][::-1]
+
+    target_assigner = build_target_assigner(target_cfg)
+    start = time.perf_counter()
+    anchors_dict = target_assigner.generate_anchors_dict(feature_map_size)
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    build_target_assigner(target_cfg).generate_anchors_dict(feature_map_size)
+    cached_time = time.perf_counter() - start
+    print('%s: classes %s, feature map %s' % (args.cfg_file, class_names, feature_map_size))
+    print('generate_anchors_dict: %.3f ms, %.3f ms from the cache' % (first_time * 1000, cached_time * 1000))
+
+    np.random.seed(args.seed)
+    batches = [list(zip(*[random_gt_boxes(args.max_num_gt, class_names, target_cfg.ANCHOR_GENERATOR)
+                          for _ in range(args.batch_size)])) for _ in range(args.repeat)]
+
+    def assign_per_sample(gt_boxes_list, gt_classes_list, gt_names_list):
+        targets_dict_list = [target_assigner.assign_v2(anchors_dict, gt_boxes, gt_classes=gt_classes, gt_names=gt_names)
+                             for gt_boxes, gt_classes, gt_names in zip(gt_boxes_list, gt_classes_list, gt_names_list)]
+        return {key: np.stack([x[key] for x in targets_dict_list], axis=0) for key in targets_dict_list[0]}
+
+    for name, func in [('assign_v2 per sample', assign_per_sample),
+                       ('assign_batch', lambda *batch: target_assigner.assign_batch(anchors_dict, *batch))]:
+        func(*batches[0])
+        start = time.perf_counter()
+        outputs = [func(*batch) for batch in batches]
+        print('%s: %.3f ms/batch of %d' % (name, (time.perf_counter() - start) / args.repeat * 1000, args.batch_size))
+        if name == 'assign_v2 per sample':
+            ref_outputs = outputs
+
+    num_same = sum([all([np.array_equal(ref[key], out[key]) for key in out])
+                    for ref, out in zip(ref_outputs, outputs)])
+    print('same targets in %d / %d batches' % (num_same, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
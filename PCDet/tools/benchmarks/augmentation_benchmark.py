@@ -0,0 +1,172 @@
+import argparse
+import time
+import numpy as np
+from easydict import EasyDict
+from pcdet.datasets.data_augmentation import augmentation_utils
+from pcdet.datasets.data_augmentation.dbsampler import DataBaseSampler, BatchSampler, BEVCollisionIndex
+from pcdet.utils import common_utils, box_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='per-sample cost of the global scene augmentation and of the gt sampling collision test')
+    parser.add_argument('--num_points', type=int, default=120000, help='points per sample')
+    parser.add_argument('--num_boxes', type=int, default=20, help='gt boxes per sample')
+    parser.add_argument('--repeat', type=int, default=200, help='number of samples to time')
+    parser.add_argument('--seed', type=int, default=666)
+    parser.add_argument('--num_sampled', type=int, default=15, help='gt sampling: candidates per class and sample')
+    return parser.parse_args()
+
+
+def random_scene(num_points, num_boxes):
+    points = np.random.uniform(-80, 80, size=(num_points, 4)).astype(np.float32)
+    points[:, 2] = np.random.uniform(-3, 1, size=num_points)
+    gt_boxes = np.random.uniform(-40, 40, size=(num_boxes, 7)).astype(np.float32)
+    gt_boxes[:, 3:6] = [1.6, 3.9, 1.56]
+    return gt_boxes, points
+
+
+def sequential_augmentation(gt_boxes, points, rotation, scaling, limit_range):
+    gt_boxes, points = augmentation_utils.random_flip(gt_boxes, points)
+    gt_boxes, points = augmentation_utils.global_rotation(gt_boxes, points, rotation=rotation)
+    gt_boxes, points = augmentation_utils.global_scaling(gt_boxes, points, *scaling)
+    return gt_boxes, common_utils.mask_points_by_range(points, limit_range), None
+
+
+def fused_augmentation(gt_boxes, points, rotation, scaling, limit_range):
+    gt_boxes, points, mask = augmentation_utils.global_augmentation_fused_(
+        gt_boxes, points, rotation=rotation, min_scale=scaling[0], max_scale=scaling[1], limit_range=limit_range
+    )
+    return gt_boxes, points[mask], mask
+
+
+def time_augmentation(func, scenes, rotation, scaling, limit_range, seed):
+    np.random.seed(seed)
+    inputs = [(b.copy(), p.copy()) for b, p in scenes]
+    outputs = []
+    start = time.perf_counter()
+    for gt_boxes, points in inputs:
+        outputs.append(func(gt_boxes, points, rotation, scaling, limit_range))
+    return (time.perf_counter() - start) / len(scenes), outputs
+
+
+SAMPLE_CLASSES = {'Car': [1.6, 3.9, 1.56], 'Pedestrian': [0.6, 0.8, 1.73], 'Cyclist': [0.6, 1.76, 1.73]}
+
+
+def random_db_boxes(num_boxes, size):
+    boxes = np.random.uniform(-40, 40, size=(num_boxes, 7)).astype(np.float32)
+    boxes[:, 2] = -1
+    boxes[:, 3:6] = size
+    boxes[:, 6] = np.random.uniform(-np.pi, np.pi, size=num_boxes)
+    return boxes
+
+
+def dense_collision_sampling(gt_boxes, class_boxes):
+    """
+    greedy gt sampling of each class with the dense collision matrix over all the boxes to avoid
+    :return: accepted box list of each class
+    """
+    avoid_coll_boxes = gt_boxes
+    accepted = []
+    for sp_boxes in class_boxes:
+        num_gt = avoid_coll_boxes.shape[0]
+        total_bv = box_utils.boxes3d_to_corners3d_lidar(
+            np.concatenate([avoid_coll_boxes, sp_boxes], axis=0))[:, 0:4, 0:2]
+        coll_mat = augmentation_utils.box_collision_test(total_bv, total_bv)
+        diag = np.arange(total_bv.shape[0])
+        coll_mat[diag, diag] = False
+        valid = []
+        for i in range(num_gt, total_bv.shape[0]):
+            if coll_mat[i].any():
+                coll_mat[i] = False
+                coll_mat[:, i] = False
+            else:
+                valid.append(i - num_gt)
+        accepted.append(valid)
+        avoid_coll_boxes = np.concatenate([avoid_coll_boxes, sp_boxes[valid]], axis=0)
+    return accepted
+
+
+def build_db_sampler(class_boxes):
+    """
+    DataBaseSampler over the candidate boxes, sampled in order
+    """
+    db_infos = {name: [{'box3d_lidar': box, 'id': k} for k, box in enumerate(boxes)]
+                for name, boxes in zip(SAMPLE_CLASSES, class_boxes)}
+    sampler = DataBaseSampler(db_infos, EasyDict(PREPARE={}, RATE=1.0, SAMPLE_GROUPS=[]), list(SAMPLE_CLASSES))
+    sampler.sampler_dict = {name: BatchSampler(infos, name, shuffle=False) for name, infos in db_infos.items()}
+    return sampler
+
+
+def indexed_collision_sampling(gt_boxes, sampler):
+    """
+    DataBaseSampler.sample_class_v2 of each class over the BEV grid index
+    :return: accepted box list of each class
+    """
+    coll_index = BEVCollisionIndex(cell_size=sampler.collision_cell_size)
+    coll_index.insert(box_utils.boxes3d_to_corners3d_lidar(gt_boxes)[:, 0:4, 0:2])
+    return [[info['id'] for info in sampler.sample_class_v2(name, len(sampler.db_infos[name]), coll_index)]
+            for name in SAMPLE_CLASSES]
+
+
+def compare_collision_sampling(scenes, num_sampled):
+    """
+    the indexed collision test must accept and reject the same gt samples as the dense one
+    """
+    inputs = [(gt_boxes, [random_db_boxes(num_sampled, size) for size in SAMPLE_CLASSES.values()])
+              for gt_boxes, _ in scenes]
+    samplers = [build_db_sampler(class_boxes) for _, class_boxes in inputs]
+    # warm up the numba kernels
+    dense_collision_sampling(*inputs[0])
+    indexed_collision_sampling(inputs[0][0], build_db_sampler(inputs[0][1]))
+
+    start = time.perf_counter()
+    dense_out = [dense_collision_sampling(*x) for x in inputs]
+    dense_time = (time.perf_counter() - start) / len(inputs)
+    start = time.perf_counter()
+    indexed_out = [indexed_collision_sampling(gt_boxes, sampler) for (gt_boxes, _), sampler in zip(inputs, samplers)]
+    indexed_time = (time.perf_counter() - start) / len(inputs)
+
+    num_diff = sum(dense != indexed for dense, indexed in zip(dense_out, indexed_out))
+    num_accepted = sum(len(valid) for accepted in dense_out for valid in accepted)
+    print('gt sampling, %d candidates per class: %d of %d accepted' % (
+        num_sampled, num_accepted, num_sampled * len(SAMPLE_CLASSES) * len(inputs)))
+    print('dense collision test:   %.3f ms/sample' % (dense_time * 1000))
+    print('indexed collision test: %.3f ms/sample (%.2fx)' % (indexed_time * 1000, dense_time / indexed_time))
+    print('samples with different accepted gt samples: %d' % num_diff)
+
+
+def main():
+    args = parse_args()
+    rotation = [-0.78539816, 0.78539816]
+    scaling = [0.95, 1.05]
+    limit_range = [0, -40, -3, 70.4, 40, 1]
+
+    np.random.seed(args.seed)
+    scenes = [random_scene(args.num_points, args.num_boxes) for _ in range(args.repeat)]
+
+    # warm up the numba kernels
+    time_augmentation(fused_augmentation, scenes[:1], rotation, scaling, limit_range, args.seed)
+
+    seq_time, seq_out = time_augmentation(sequential_augmentation, scenes, rotation, scaling, limit_range, args.seed)
+    fused_time, fused_out = time_augmentation(fused_augmentation, scenes, rotation, scaling, limit_range, args.seed)
+
+    max_point_err, max_box_err, count_diff = 0, 0, 0
+    for (seq_boxes, seq_points, _), (fused_boxes, fused_points, _) in zip(seq_out, fused_out):
+        max_box_err = max(max_box_err, np.abs(seq_boxes - fused_boxes).max())
+        if seq_points.shape != fused_points.shape:
+            count_diff += 1
+        else:
+            max_point_err = max(max_point_err, np.abs(seq_points - fused_points).max())
+    print('points per sample: %d, boxes per sample: %d, samples: %d' % (args.num_points, args.num_boxes, args.repeat))
+    print('sequential: %.3f ms/sample' % (seq_time * 1000))
+    print('fused:      %.3f ms/sample (%.2fx)' % (fused_time * 1000, seq_time / fused_time))
+    print('max point diff: %.3e, max box diff: %.3e, samples with a different masked point count: %d'
+          % (max_point_err, max_box_err, count_diff))
+
+    np.random.seed(args.seed)
+    compare_collision_sampling(scenes, args.num_sampled)
+
+
+if __name__ == '__main__':
+    main()
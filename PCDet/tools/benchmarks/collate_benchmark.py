@@ -0,0 +1,134 @@
+import argparse
+import time
+from collections import defaultdict
+from functools import partial
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from pcdet.datasets.dataset import DatasetTemplate
+from pcdet.datasets.collate_buffers import CollateBuffers
+from pcdet.models import example_convert_to_torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='end-to-end collate + host to device throughput')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_voxels', type=int, default=16000, help='voxels per sample')
+    parser.add_argument('--num_points', type=int, default=20000, help='points per sample')
+    parser.add_argument('--num_boxes', type=int, default=20, help='max gt boxes per sample')
+    parser.add_argument('--num_samples', type=int, default=64)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+class RandomExamples(torch.utils.data.Dataset):
+    def __init__(self, num_samples, num_voxels, num_points, num_boxes):
+        self.examples = []
+        for _ in range(num_samples):
+            num_voxel = np.random.randint(num_voxels // 2, num_voxels)
+            self.examples.append({
+                'voxels': np.random.rand(num_voxel, 5, 4).astype(np.float32),
+                'num_points': np.random.randint(1, 6, size=num_voxel).astype(np.int32),
+                'coordinates': np.random.randint(0, 1600, size=(num_voxel, 3)).astype(np.int32),
+                'voxel_centers': np.random.rand(num_voxel, 3).astype(np.float32),
+                'points': np.random.rand(num_points, 4).astype(np.float32),
+                'gt_boxes': np.random.rand(np.random.randint(1, num_boxes), 7).astype(np.float32),
+                'image_shape': np.array([375, 1242], dtype=np.int32),
+                'sample_idx': '%06d' % len(self.examples),
+            })
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, index):
+        return self.examples[index]
+
+
+def reference_collate_batch(batch_list, _unused=False):
+    example_merged = defaultdict(list)
+    for example in batch_list:
+        for k, v in example.items():
+            example_merged[k].append(v)
+    ret = {}
+    for key, elems in example_merged.items():
+        if key in ['voxels', 'num_points', 'voxel_centers', 'seg_labels', 'part_labels', 'bbox_reg_labels']:
+            ret[key] = np.concatenate(elems, axis=0)
+        elif key in ['coordinates', 'points']:
+            coors = []
+            for i, coor in enumerate(elems):
+                coor_pad = np.pad(coor, ((0, 0), (1, 0)), mode='constant', constant_values=i)
+                coors.append(coor_pad)
+            ret[key] = np.concatenate(coors, axis=0)
+        elif key in ['gt_boxes']:
+            max_gt = max([len(elem) for elem in elems])
+            batch_gt_boxes3d = np.zeros((len(elems), max_gt, elems[0].shape[-1]), dtype=np.float32)
+            for k in range(len(elems)):
+                batch_gt_boxes3d[k, :len(elems[k]), :] = elems[k]
+            ret[key] = batch_gt_boxes3d
+        else:
+            ret[key] = np.stack(elems, axis=0)
+    ret['batch_size'] = batch_list.__len__()
+    return ret
+
+
+def reference_convert_to_torch(example, device):
+    example_torch = {}
+    for k, v in example.items():
+        if k in ['voxels', 'gt_boxes', 'voxel_centers', 'points']:
+            example_torch[k] = torch.tensor(v, dtype=torch.float32, device=device)
+        elif k in ['coordinates', 'num_points']:
+            example_torch[k] = torch.tensor(v, dtype=torch.int32, device=device)
+        else:
+            example_torch[k] = v
+    return example_torch
+
+
+def run(dataloader, convert, device, epochs):
+    """
+    consume the batches as the training loop does: convert, then a small reduction standing in for the model
+    """
+    checksums = []
+    num_samples = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in dataloader:
+            batch_torch = convert(batch, device)
+            checksums.append(float(batch_torch['voxels'].sum() + batch_torch['coordinates'].float().sum()
+                                   + batch_torch['gt_boxes'].sum() + batch_torch['points'].sum()))
+            num_samples += batch['batch_size']
+    return num_samples / (time.perf_counter() - start), checksums
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    dataset = RandomExamples(args.num_samples, args.num_voxels, args.num_points, args.num_boxes)
+    device = torch.device(args.device)
+
+    ref_loader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=reference_collate_batch,
+                            pin_memory=device.type == 'cuda', num_workers=0)
+    buffers = CollateBuffers(pin_memory=device.type == 'cuda')
+    new_loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=0,
+                            collate_fn=partial(DatasetTemplate.collate_batch, buffers=buffers))
+
+    for batch in new_loader:
+        ref_batch = reference_collate_batch([dataset[i] for i in range(min(args.batch_size, len(dataset)))])
+        for key in ['voxels', 'num_points', 'coordinates', 'voxel_centers', 'points', 'gt_boxes', 'image_shape']:
+            assert ref_batch[key].dtype == batch[key].dtype and np.array_equal(ref_batch[key], batch[key]), key
+        break
+
+    ref_speed, ref_sums = run(ref_loader, reference_convert_to_torch, device, args.epochs)
+    new_speed, new_sums = run(new_loader, lambda batch, dev: example_convert_to_torch(batch, device=dev),
+                              device, args.epochs)
+
+    print('device: %s, batch size: %d, voxels per sample: <%d, points per sample: %d'
+          % (device, args.batch_size, args.num_voxels, args.num_points))
+    print('reference collate:          %.1f samples/s' % ref_speed)
+    print('preallocated/pinned collate: %.1f samples/s (%.2fx)' % (new_speed, new_speed / ref_speed))
+    print('identical batches: %s' % np.allclose(ref_sums, new_sums))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.models import build_network, example_convert_to_torch
+from pcdet.models.model_utils import export_utils
+from pointpillar_cpu_benchmark import RandomSceneDataset, set_pointpillar_cfg
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='eager vs TorchScript vs onnxruntime dense head of PointPillars on cpu')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml',
+                        help='the data and anchor configs are taken from it, the model is replaced by PointPillars')
+    parser.add_argument('--ckpt', type=str, default=None, help='PointPillars checkpoint, random weights if not given')
+    parser.add_argument('--num_points', type=int, default=20000)
+    parser.add_argument('--num_frames', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=4, help='batch size of the throughput of the dense head')
+    parser.add_argument('--threads', type=int, default=0, help='number of cpu threads, 0 for the default')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def time_frames(model, dataset, frames):
+    """
+    :return: ms per frame of the whole inference, predictions of each frame
+    """
+    pred_list = []
+    elapsed = 0
+    for idx, points in enumerate([frames[0]] + frames):
+        start = time.perf_counter()
+        input_dict = example_convert_to_torch(dataset.collate_batch([dataset.voxelize(points)]),
+                                              device=torch.device('cpu'))
+        pred_dicts, _ = model(input_dict)
+        if idx == 0:
+            continue  # warm up
+        elapsed += time.perf_counter() - start
+        pred_list.append(pred_dicts[0])
+    return elapsed / len(frames) * 1000, pred_list
+
+
+def max_box_diff(pred_list, ref_list):
+    """
+    :return: inf if a frame has a different number of boxes
+    """
+    max_diff = 0
+    for pred, ref in zip(pred_list, ref_list):
+        if pred['boxes'].shape != ref['boxes'].shape:
+            return float('inf')
+        if pred['boxes'].shape[0] > 0:
+            max_diff = max(max_diff, (pred['boxes'] - ref['boxes']).abs().max().item())
+    return max_diff
+
+
+def time_dense(dense_func, spatial_features, repeat=3):
+    outputs = dense_func(spatial_features)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dense_func(spatial_features)
+    return (time.perf_counter() - start) / repeat, outputs
+
+
+def main():
+    args = parse_args()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    set_pointpillar_cfg()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    dataset = RandomSceneDataset(args.num_points)
+    model = build_network(dataset)
+    if args.ckpt is not None:
+        import logging
+        model.load_params_from_file(filename=args.ckpt, logger=logging.getLogger(), to_cpu=True)
+    model.cpu()
+    model.eval()
+
+    frames = [dataset.random_points() for _ in range(args.num_frames)]
+    spatial_features = export_utils.get_dense_input(model, example_convert_to_torch(
+        dataset.collate_batch([dataset.voxelize(frames[0])]), device=torch.device('cpu')
+    ))
+    batch_features = spatial_features.repeat(args.batch_size, 1, 1, 1)
+    print('PointPillars dense head input %s, %d threads' % (tuple(spatial_features.shape), torch.get_num_threads()))
+
+    export_dir = Path(tempfile.mkdtemp())
+    runners = {'eager': None}
+    with torch.no_grad():
+        runners['torchscript'] = export_utils.TorchScriptDenseRunner(
+            export_utils.export_torchscript(model, spatial_features, str(export_dir / 'rpn_head.pt')),
+            model.rpn_head, torch.device('cpu')
+        )
+        if export_utils.onnxruntime is not None:
+            runners['onnxruntime'] = export_utils.OnnxDenseRunner(
+                export_utils.export_onnx(model, spatial_features, str(export_dir / 'rpn_head.onnx')),
+                model.rpn_head, num_threads=torch.get_num_threads()
+            )
+        else:
+            print('onnxruntime is not installed, skip it')
+
+    eager_preds = None
+    with torch.no_grad():
+        for name, runner in runners.items():
+            export_utils.set_dense_runner(model, runner)
+            frame_ms, pred_list = time_frames(model, dataset, frames)
+            dense_func = model.rpn_head.forward_dense
+            single_time, dense_outputs = time_dense(dense_func, spatial_features)
+            batch_time = time_dense(dense_func, batch_features)[0]
+            msg = '%-12s: %.1f ms/frame end to end, dense head %.1f ms at batch 1, %.1f frames/s at batch %d' \
+                % (name, frame_ms, single_time * 1000, args.batch_size / batch_time, args.batch_size)
+            if eager_preds is None:
+                eager_preds, eager_outputs = pred_list, dense_outputs
+            else:
+                dense_diff = max([(dense_outputs[key] - eager_outputs[key]).abs().max().item() for key in eager_outputs
+                                  if key in dense_outputs])
+                msg += ', max abs diff to eager: dense outputs %.2e, boxes %.2e' \
+                    % (dense_diff, max_box_diff(pred_list, eager_preds))
+            print(msg)
+    export_utils.set_dense_runner(model, None)
+
+
+if __name__ == '__main__':
+    main()
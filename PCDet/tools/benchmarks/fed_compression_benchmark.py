@@ -0,0 +1,71 @@
+import argparse
+import importlib
+import logging
+import sys
+from pathlib import Path
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # PCDet, fed_engine
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # tools, eval_utils
+from fed_engine import FedEngine, FedClient, GlobalModelEvaluator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='upload bytes per federated round vs AP of the global model')
+    parser.add_argument('--cfg_files', type=str, default='cfgs/tesla713.yaml,cfgs/tesla714.yaml',
+                        help='comma separated configs of the clients')
+    parser.add_argument('--eval_cfg_file', type=str, default='cfgs/tesla713.yaml',
+                        help='the global models are evaluated on the val split of this config')
+    parser.add_argument('--modes', type=str, default='full,delta,int8,topk',
+                        help='comma separated compressions of the client updates, the first round is always full')
+    parser.add_argument('--topk_ratio', type=float, default=0.01)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--client_class', type=str, default=None,
+                        help='module.Class of a FedClient subclass, e.g. for other datasets')
+    parser.add_argument('--skip_eval', action='store_true', default=False, help='only report the bytes')
+    parser.add_argument('--ap_key', type=str, default='Car_3d_moderate')
+    parser.add_argument('--output_dir', type=str, default='../output/fed_compression_benchmark')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def get_client_class(name):
+    if name is None:
+        return FedClient
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger()
+    client_class = get_client_class(args.client_class)
+    evaluator = GlobalModelEvaluator(args.eval_cfg_file, args.output_dir, logger) if not args.skip_eval else None
+
+    table = []
+    for mode in args.modes.split(','):
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        client_kwargs_list = [{
+            'cfg_file': cfg_file, 'batch_size': args.batch_size, 'compression': None if mode == 'full' else mode,
+            'topk_ratio': args.topk_ratio
+        } for cfg_file in args.cfg_files.split(',')]
+        engine = FedEngine(client_kwargs_list, num_procs=0, client_class=client_class, logger=logger)
+        for cur_round in range(args.rounds):
+            times = engine.run_round(cur_round)
+            ap = None
+            if evaluator is not None:
+                ap = evaluator(engine.global_state, '%s_round_%d' % (mode, cur_round)).get(args.ap_key)
+            table.append((mode, cur_round, times['upload_bytes'], ap))
+        engine.close()
+
+    print('%-6s %5s %14s %10s' % ('mode', 'round', 'upload MB', args.ap_key if not args.skip_eval else ''))
+    for mode, cur_round, upload_bytes, ap in table:
+        print('%-6s %5d %14.3f %10s' % (mode, cur_round, upload_bytes / 2 ** 20, '%.2f' % ap if ap is not None else '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import logging
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))  # PCDet, fed_engine
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # tools, train_utils
+from pcdet.config import cfg
+from pcdet.models import build_network, get_default_device
+from train_utils.optimization import build_optimizer, build_scheduler
+from fed_engine import FedClient, OPTIMIZER_STATE_POLICIES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='round restart of a federated client, rebuilt from its checkpoint as '
+                                                 'train.py --pretrained_model vs resident')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--client_class', type=str, default=None,
+                        help='module.Class of a FedClient subclass, e.g. for other datasets')
+    parser.add_argument('--num_repeats', type=int, default=5)
+    parser.add_argument('--output_dir', type=str, default='../output/fed_restart_benchmark')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def get_client_class(name):
+    if name is None:
+        return FedClient
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def timed(fn, num_repeats):
+    """
+    :return: output of the last call, mean seconds of a call
+    """
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / num_repeats
+
+
+def cold_restart(client, filename, batch_size):
+    """
+    the steps of a round of train.py with --pretrained_model after the process start
+    :return: dict of the seconds of each step
+    """
+    times = {}
+    start = time.perf_counter()
+    train_set, train_loader = client.build_dataloader(batch_size, 0)
+    times['dataset'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = build_network(train_set)
+    model.to(get_default_device())
+    times['model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    checkpoint = torch.load(filename, map_location=torch.device('cpu'))
+    model.load_state_dict(checkpoint['model_state'])
+    times['checkpoint'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    optimizer = build_optimizer(model, client.optim_cfg)
+    optimizer.load_state_dict(checkpoint['optimizer_state'])
+    build_scheduler(optimizer, total_iters_each_epoch=len(train_loader), total_epochs=client.epochs, last_epoch=1,
+                    optim_cfg=client.optim_cfg)
+    times['optimizer'] = time.perf_counter() - start
+    return times
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    client_class = get_client_class(args.client_class)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    clients = {}
+    for policy in OPTIMIZER_STATE_POLICIES:
+        clients[policy] = client_class(args.cfg_file, batch_size=args.batch_size, optimizer_state=policy)
+        # a first round for the state of the optimizer
+        clients[policy].train_round()
+
+    client = clients['keep']
+    cfg.update(client.cfg)
+    filename = output_dir / ('%s.pth' % client.name)
+    torch.save({'model_state': client.model.state_dict(), 'optimizer_state': client.optimizer.state_dict(),
+                'accumulated_iter': client.accumulated_iter}, str(filename))
+    cold_times = [cold_restart(client, filename, args.batch_size) for _ in range(args.num_repeats)]
+    cold_times = {key: np.mean([x[key] for x in cold_times]) for key in cold_times[0]}
+
+    print('%-28s %10s' % ('restart', 'ms'))
+    for key, val in cold_times.items():
+        print('%-28s %10.1f' % ('cold: ' + key, val * 1000))
+    print('%-28s %10.1f' % ('cold: total', sum(cold_times.values()) * 1000))
+    for policy, client in clients.items():
+        cfg.update(client.cfg)
+        global_state = {key: val.clone() for key, val in client.model.state_dict().items()}
+        optimizer_buffers = {key: val.clone() for key, val in client.get_optimizer_buffers().items()}
+        _, warm_time = timed(lambda: client.restart(global_state, optimizer_buffers), args.num_repeats)
+        print('%-28s %10.1f' % ('warm: ' + policy, warm_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
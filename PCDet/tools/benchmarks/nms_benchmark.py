@@ -0,0 +1,93 @@
+import argparse
+import time
+import numpy as np
+import torch
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.ops.iou3d_nms import iou3d_nms_utils
+from pcdet.utils import box_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='CPU rotated NMS at the proposal counts of a config')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml')
+    parser.add_argument('--num_objects', type=int, default=30, help='objects per scene')
+    parser.add_argument('--repeat', type=int, default=20, help='number of scenes to time')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def random_predictions(num_preds, num_objects):
+    """
+    noisy detections clustered around a few objects, as the dense head outputs after the score threshold
+    """
+    objects = np.random.uniform([0, -40, -1.5, 1.4, 3.5, 1.4, -np.pi], [70.4, 40, -0.5, 1.8, 4.5, 1.7, np.pi],
+                                size=(num_objects, 7))
+    box_preds = objects[np.random.randint(0, num_objects, size=num_preds)]
+    box_preds[:, 0:2] += np.random.normal(scale=0.8, size=(num_preds, 2))
+    box_preds[:, 3:6] *= np.random.uniform(0.8, 1.2, size=(num_preds, 3))
+    box_preds[:, 6] += np.random.normal(scale=0.3, size=num_preds)
+    scores = np.random.rand(num_preds)
+    return torch.from_numpy(box_preds).float(), torch.from_numpy(scores).float()
+
+
+def reference_nms(boxes, scores, thresh):
+    """
+    full iou matrix + greedy suppression, as the CUDA kernel does
+    """
+    order = scores.sort(0, descending=True)[1]
+    iou = iou3d_nms_utils.boxes_iou_bev_cpu(boxes[order], boxes[order]).numpy()
+    suppressed = np.zeros(order.shape[0], dtype=np.bool_)
+    keep = []
+    for i in range(order.shape[0]):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= iou[i] > thresh
+    return order[torch.LongTensor(keep)]
+
+
+def time_nms(func, scenes):
+    outputs = []
+    start = time.perf_counter()
+    for boxes, scores in scenes:
+        outputs.append(func(boxes, scores))
+    return (time.perf_counter() - start) / len(scenes), outputs
+
+
+def main():
+    args = parse_args()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    test_cfg = cfg.MODEL.TEST
+    pre_maxsize, post_maxsize, thresh = test_cfg.NMS_PRE_MAXSIZE_LAST, test_cfg.NMS_POST_MAXSIZE_LAST, test_cfg.NMS_THRESH
+
+    np.random.seed(args.seed)
+    scenes = []
+    for _ in range(args.repeat):
+        box_preds, scores = random_predictions(pre_maxsize, args.num_objects)
+        scenes.append((box_utils.boxes3d_to_bevboxes_lidar_torch(box_preds), scores))
+
+    # warm up the numba kernels
+    iou3d_nms_utils.nms_cpu(scenes[0][0][:10], scenes[0][1][:10], thresh)
+
+    ref_time, ref_out = time_nms(lambda b, s: reference_nms(b, s, thresh)[:post_maxsize], scenes)
+    cpu_time, cpu_out = time_nms(lambda b, s: iou3d_nms_utils.nms_cpu(b, s, thresh, post_maxsize=post_maxsize), scenes)
+    num_same = sum([torch.equal(ref, out) for ref, out in zip(ref_out, cpu_out)])
+
+    print('%s: %d boxes before NMS, at most %d after, thresh %.2f' % (args.cfg_file, pre_maxsize, post_maxsize, thresh))
+    print('full iou matrix: %.3f ms/scene' % (ref_time * 1000))
+    print('nms_cpu:         %.3f ms/scene (%.2fx), %.1f boxes kept on average'
+          % (cpu_time * 1000, ref_time / cpu_time, np.mean([out.shape[0] for out in cpu_out])))
+    print('same kept boxes in %d / %d scenes' % (num_same, len(scenes)))
+
+    if torch.cuda.is_available() and iou3d_nms_utils.iou3d_nms_cuda is not None:
+        scenes_gpu = [(boxes.cuda(), scores.cuda()) for boxes, scores in scenes]
+        gpu_time, gpu_out = time_nms(
+            lambda b, s: iou3d_nms_utils.nms_gpu(b, s, thresh, post_maxsize=post_maxsize).cpu(), scenes_gpu
+        )
+        num_same = sum([torch.equal(ref, out) for ref, out in zip(gpu_out, cpu_out)])
+        print('nms_gpu:         %.3f ms/scene, same kept boxes as nms_cpu in %d / %d scenes'
+              % (gpu_time * 1000, num_same, len(scenes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import time
+import numpy as np
+from easydict import EasyDict
+from pcdet.config import cfg
+from pcdet.datasets import DatasetTemplate
+from pcdet.utils import box_utils, common_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='cost of generate_voxel_part_targets at KITTI scale')
+    parser.add_argument('--num_voxels', type=int, default=16000, help='non-empty voxels per sample')
+    parser.add_argument('--num_boxes', type=int, default=30, help='gt boxes per sample')
+    parser.add_argument('--repeat', type=int, default=20, help='number of samples to time')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def per_box_part_targets(voxel_centers, gt_boxes, gt_classes, generate_bbox_reg_labels=False):
+    """the box by box in_hull implementation, as the reference"""
+    unet_target_cfg = cfg.MODEL.RPN.BACKBONE.TARGET_CONFIG
+    extend_gt_boxes = common_utils.enlarge_box3d(gt_boxes, extra_width=unet_target_cfg.GT_EXTEND_WIDTH)
+    gt_corners = box_utils.boxes3d_to_corners3d_lidar(gt_boxes)
+    extend_gt_corners = box_utils.boxes3d_to_corners3d_lidar(extend_gt_boxes)
+
+    cls_labels = np.zeros(voxel_centers.shape[0], dtype=np.int32)
+    reg_labels = np.zeros((voxel_centers.shape[0], 3), dtype=np.float32)
+    bbox_reg_labels = np.zeros((voxel_centers.shape[0], 7), dtype=np.float32) if generate_bbox_reg_labels else None
+    for k in range(gt_boxes.shape[0]):
+        fg_pt_flag = box_utils.in_hull(voxel_centers, gt_corners[k])
+        fg_voxels = voxel_centers[fg_pt_flag]
+        cls_labels[fg_pt_flag] = gt_classes[k]
+        fg_enlarge_flag = box_utils.in_hull(voxel_centers, extend_gt_corners[k])
+        cls_labels[np.logical_xor(fg_pt_flag, fg_enlarge_flag)] = -1
+
+        transformed_voxels = common_utils.rotate_pc_along_z(fg_voxels - gt_boxes[k, 0:3], -gt_boxes[k, 6])
+        reg_labels[fg_pt_flag] = (transformed_voxels / gt_boxes[k, 3:6]) + np.array([0.5, 0.5, 0], dtype=np.float32)
+
+        if generate_bbox_reg_labels:
+            center3d = gt_boxes[k, 0:3].copy()
+            center3d[2] += gt_boxes[k][5] / 2
+            bbox_reg_labels[fg_pt_flag, 0:3] = center3d - fg_voxels
+            bbox_reg_labels[fg_pt_flag, 6] = gt_boxes[k, 6]
+            cur_mean_size = unet_target_cfg.MEAN_SIZE[cfg.CLASS_NAMES[gt_classes[k] - 1]]
+            bbox_reg_labels[fg_pt_flag, 3:6] = (gt_boxes[k, 3:6] - np.array(cur_mean_size)) / cur_mean_size
+
+    return cls_labels, np.maximum(reg_labels, 0), bbox_reg_labels
+
+
+def random_sample(num_voxels, num_boxes):
+    voxel_size = np.array([0.05, 0.05, 0.1], dtype=np.float32)
+    pc_range = np.array([0, -40, -3, 70.4, 40, 1], dtype=np.float32)
+    gt_boxes = np.zeros((num_boxes, 7), dtype=np.float32)
+    gt_boxes[:, 0] = np.random.uniform(5, 65, num_boxes)
+    gt_boxes[:, 1] = np.random.uniform(-35, 35, num_boxes)
+    gt_boxes[:, 2] = np.random.uniform(-1.8, -1.5, num_boxes)
+    gt_boxes[:, 3:6] = [1.6, 3.9, 1.56]
+    gt_boxes[:, 6] = np.random.uniform(-np.pi, np.pi, num_boxes)
+    gt_classes = np.random.randint(1, len(cfg.CLASS_NAMES) + 1, num_boxes).astype(np.int32)
+
+    # half of the voxels around the objects as in a real scan, the others spread over the scene
+    num_obj = num_voxels // 2
+    centers = gt_boxes[np.random.randint(0, num_boxes, num_obj), 0:3]
+    obj_points = centers + np.random.uniform([-2.5, -2.5, 0], [2.5, 2.5, 1.6], size=(num_obj, 3))
+    scene_points = np.random.uniform(pc_range[0:3], pc_range[3:6], size=(num_voxels - num_obj, 3))
+    points = np.concatenate([obj_points, scene_points], axis=0)
+    coordinates = np.unique(np.floor((points - pc_range[0:3]) / voxel_size).astype(np.int32), axis=0)[:, ::-1]
+    voxel_centers = (coordinates[:, ::-1] + 0.5) * voxel_size + pc_range[0:3]
+    return voxel_centers, gt_boxes, gt_classes
+
+
+def main():
+    args = parse_args()
+    cfg.CLASS_NAMES = ['Car', 'Pedestrian', 'Cyclist']
+    cfg.MODEL = EasyDict({'RPN': {'BACKBONE': {'TARGET_CONFIG': {
+        'GT_EXTEND_WIDTH': 0.2,
+        'MEAN_SIZE': {'Car': [1.6, 3.9, 1.56], 'Pedestrian': [0.6, 0.8, 1.73], 'Cyclist': [0.6, 1.76, 1.73]}
+    }}}})
+
+    np.random.seed(args.seed)
+    samples = [random_sample(args.num_voxels, args.num_boxes) for _ in range(args.repeat)]
+
+    funcs = {
+        'per_box': per_box_part_targets,
+        'batched': lambda *x: DatasetTemplate.generate_voxel_part_targets(None, *x)
+    }
+    results, times = {}, {}
+    for name, func in funcs.items():
+        start = time.perf_counter()
+        results[name] = [func(*sample, True) for sample in samples]
+        times[name] = (time.perf_counter() - start) / len(samples)
+
+    num_diff = 0
+    for ref, cur in zip(results['per_box'], results['batched']):
+        num_diff += sum([not np.array_equal(x, y) for x, y in zip(ref, cur)])
+
+    num_voxels = np.mean([x[0].shape[0] for x in samples])
+    print('voxels per sample: %d, boxes per sample: %d, samples: %d' % (num_voxels, args.num_boxes, args.repeat))
+    print('per_box: %.2f ms/sample' % (times['per_box'] * 1000))
+    print('batched: %.2f ms/sample (%.1fx)' % (times['batched'] * 1000, times['per_box'] / times['batched']))
+    print('label arrays different from the per-box reference: %d' % num_diff)
+
+
+if __name__ == '__main__':
+    main()
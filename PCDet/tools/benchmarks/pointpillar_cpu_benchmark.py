@@ -0,0 +1,150 @@
+import argparse
+import time
+import numpy as np
+import torch
+import spconv
+from pcdet.config import cfg, cfg_from_yaml_file
+from pcdet.datasets import DatasetTemplate
+from pcdet.models import build_network, example_convert_to_torch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='per frame latency of PointPillars inference on cpu')
+    parser.add_argument('--cfg_file', type=str, default='cfgs/tesla713.yaml',
+                        help='the data and anchor configs are taken from it, the model is replaced by PointPillars')
+    parser.add_argument('--ckpt', type=str, default=None, help='PointPillars checkpoint, random weights if not given')
+    parser.add_argument('--num_points', type=int, default=20000,
+                        help='points per frame, ~20k is the density of a KITTI scan in the camera field of view')
+    parser.add_argument('--num_frames', type=int, default=20)
+    parser.add_argument('--threads', type=str, default='1,4', help='comma separated numbers of torch threads')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def set_pointpillar_cfg():
+    """
+    PointPillars with the pillar size and the network of the KITTI car model of the paper, the range is cropped to
+    a multiple of 8 pillars for the three strides of the backbone
+    """
+    cfg.DATA_CONFIG.POINT_CLOUD_RANGE = [0, -39.68, -3, 69.12, 39.68, 1]
+    for anchor_cfg in cfg.MODEL.RPN.RPN_HEAD.TARGET_CONFIG.ANCHOR_GENERATOR:
+        anchor_cfg['anchor_range'] = [0, -39.68, anchor_cfg['anchor_range'][2], 69.12, 39.68,
+                                      anchor_cfg['anchor_range'][5]]
+    cfg.DATA_CONFIG.VOXEL_GENERATOR.VOXEL_SIZE = [0.16, 0.16, 4]
+    cfg.DATA_CONFIG.VOXEL_GENERATOR.MAX_POINTS_PER_VOXEL = 32
+    cfg.MODEL.NAME = 'PointPillar'
+    cfg.MODEL.VFE.NAME = 'PillarFeatureNetOld2'
+    cfg.MODEL.VFE.ARGS = {'use_norm': True, 'num_filters': [64], 'with_distance': False}
+    cfg.MODEL.RPN.BACKBONE.NAME = 'PointPillarsScatter'
+    cfg.MODEL.RPN.BACKBONE.ARGS = {}
+    cfg.MODEL.RPN.RPN_HEAD.ARGS.update({
+        'num_input_features': 64,
+        'layer_nums': [3, 5, 5],
+        'layer_strides': [2, 2, 2],
+        'num_filters': [64, 128, 256],
+        'upsample_strides': [1, 2, 4],
+        'num_upsample_filters': [128, 128, 128],
+    })
+    cfg.MODEL.RPN.RPN_HEAD.TARGET_CONFIG.DOWNSAMPLED_FACTOR = 2
+
+
+class RandomSceneDataset(DatasetTemplate):
+    def __init__(self, num_points):
+        super().__init__()
+        self.training = False
+        self.class_names = cfg.CLASS_NAMES
+        self.num_points = num_points
+        self.voxel_generator = spconv.utils.VoxelGenerator(
+            voxel_size=cfg.DATA_CONFIG.VOXEL_GENERATOR.VOXEL_SIZE,
+            point_cloud_range=cfg.DATA_CONFIG.POINT_CLOUD_RANGE,
+            max_num_points=cfg.DATA_CONFIG.VOXEL_GENERATOR.MAX_POINTS_PER_VOXEL,
+            max_voxels=cfg.DATA_CONFIG.TEST.MAX_NUMBER_OF_VOXELS
+        )
+
+    def __len__(self):
+        return 1
+
+    def random_points(self):
+        """
+        a lidar scan in the field of view: a ground plane with a density decreasing with the range and some objects
+        """
+        num_ground = self.num_points * 3 // 4
+        dist = 70 * np.random.rand(num_ground) ** 2
+        angle = np.random.uniform(-np.pi / 4, np.pi / 4, num_ground)
+        ground = np.stack([dist * np.cos(angle), dist * np.sin(angle), np.random.normal(-1.7, 0.05, num_ground)], 1)
+        num_objects = self.num_points - num_ground
+        centers = np.random.uniform([5, -20, -1.7], [60, 20, -1.0], size=(30, 3))
+        objects = centers[np.random.randint(0, 30, num_objects)] + np.random.normal(scale=[1.0, 0.5, 0.4],
+                                                                                     size=(num_objects, 3))
+        points = np.concatenate([ground, objects], axis=0)
+        points = np.concatenate([points, np.random.rand(points.shape[0], 1)], axis=1).astype(np.float32)
+        mask = (points[:, 0:3] >= cfg.DATA_CONFIG.POINT_CLOUD_RANGE[0:3]).all(axis=1) & \
+            (points[:, 0:3] < cfg.DATA_CONFIG.POINT_CLOUD_RANGE[3:6]).all(axis=1)
+        return points[mask]
+
+    def voxelize(self, points):
+        voxel_grid = self.voxel_generator.generate(points)
+        # Support spconv 1.0 and 1.1
+        try:
+            voxels, coordinates, num_points = voxel_grid
+        except (ValueError, TypeError):
+            voxels = voxel_grid['voxels']
+            coordinates = voxel_grid['coordinates']
+            num_points = voxel_grid['num_points_per_voxel']
+        voxel_centers = (coordinates[:, ::-1] + 0.5) * self.voxel_generator.voxel_size \
+            + self.voxel_generator.point_cloud_range[0:3]
+        return {
+            'voxels': voxels, 'coordinates': coordinates, 'num_points': num_points, 'voxel_centers': voxel_centers,
+            'points': points
+        }
+
+    @staticmethod
+    def generate_prediction_dict(input_dict, index, record_dict):
+        return record_dict
+
+
+def main():
+    args = parse_args()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    set_pointpillar_cfg()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    dataset = RandomSceneDataset(args.num_points)
+    model = build_network(dataset)
+    if args.ckpt is not None:
+        import logging
+        model.load_params_from_file(filename=args.ckpt, logger=logging.getLogger(), to_cpu=True)
+    model.cpu()
+    model.eval()
+
+    frames = [dataset.random_points() for _ in range(args.num_frames)]
+    print('%s with PointPillars: %.0f points/frame in range, %d frames'
+          % (args.cfg_file, np.mean([x.shape[0] for x in frames]), len(frames)))
+
+    for num_threads in [int(x) for x in args.threads.split(',')]:
+        torch.set_num_threads(num_threads)
+        voxel_time = model_time = 0
+        num_voxels = num_boxes = 0
+        with torch.inference_mode():
+            for idx, points in enumerate([frames[0]] + frames):
+                start = time.perf_counter()
+                batch_dict = dataset.collate_batch([dataset.voxelize(points)])
+                input_dict = example_convert_to_torch(batch_dict, device=torch.device('cpu'))
+                mid = time.perf_counter()
+                pred_dicts, _ = model(input_dict)
+                end = time.perf_counter()
+                if idx == 0:
+                    continue  # warm up
+                voxel_time += mid - start
+                model_time += end - mid
+                num_voxels += batch_dict['voxels'].shape[0]
+                num_boxes += pred_dicts[0]['boxes'].shape[0]
+        print('threads %2d: %.1f ms/frame (voxelization %.1f ms, network + post processing %.1f ms), '
+              '%.0f pillars and %.1f boxes per frame'
+              % (num_threads, (voxel_time + model_time) / len(frames) * 1000, voxel_time / len(frames) * 1000,
+                 model_time / len(frames) * 1000, num_voxels / len(frames), num_boxes / len(frames)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import time
+import numpy as np
+import torch
+from easydict import EasyDict
+from pcdet.config import cfg
+from pcdet.models.model_utils import proposal_target_layer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='batched RoI sampling of the proposal target layer')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_rois', type=int, default=512, help='rois per sample')
+    parser.add_argument('--max_num_gt', type=int, default=30, help='gt boxes per sample')
+    parser.add_argument('--num_classes', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10, help='number of batches to time')
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def get_roi_sampler_cfg():
+    # RCNN.TARGET_CONFIG of PartA2
+    return EasyDict({
+        'ROI_PER_IMAGE': 128, 'FG_RATIO': 0.5, 'HARD_BG_RATIO': 0.8, 'CLS_SCORE_TYPE': 'roi_iou',
+        'CLS_FG_THRESH': 0.75, 'CLS_BG_THRESH': 0.25, 'CLS_BG_THRESH_LO': 0.1, 'REG_FG_THRESH': 0.55
+    })
+
+
+def random_batch(batch_size, num_rois, max_num_gt, num_classes, device):
+    """
+    the gt boxes are zero padded to max_num_gt, half of the rois are jittered gt boxes and the others are random
+    """
+    gt_boxes = np.zeros((batch_size, max_num_gt, 8), dtype=np.float32)
+    rois = np.zeros((batch_size, num_rois, 7), dtype=np.float32)
+    roi_labels = np.zeros((batch_size, num_rois), dtype=np.int64)
+    for k in range(batch_size):
+        num_gt = np.random.randint(1, max_num_gt + 1)
+        gt_boxes[k, :num_gt] = np.concatenate([
+            np.random.uniform([0, -40, -1.8], [70, 40, -0.6], size=(num_gt, 3)),
+            np.random.uniform([1.5, 3.5, 1.4], [1.8, 4.5, 1.7], size=(num_gt, 3)),
+            np.random.uniform(-np.pi, np.pi, size=(num_gt, 1)),
+            np.random.randint(1, num_classes + 1, size=(num_gt, 1))
+        ], axis=1)
+        num_near = num_rois // 2
+        near_gt = np.random.randint(0, num_gt, size=num_near)
+        rois[k, :num_near] = gt_boxes[k, near_gt, 0:7] + np.random.normal(
+            scale=[0.5, 0.5, 0.2, 0.1, 0.2, 0.1, 0.1], size=(num_near, 7))
+        rois[k, num_near:] = np.concatenate([
+            np.random.uniform([0, -40, -1.8], [70, 40, -0.6], size=(num_rois - num_near, 3)),
+            np.random.uniform([1.5, 3.5, 1.4], [1.8, 4.5, 1.7], size=(num_rois - num_near, 3)),
+            np.random.uniform(-np.pi, np.pi, size=(num_rois - num_near, 1))
+        ], axis=1)
+        roi_labels[k, :num_near] = gt_boxes[k, near_gt, 7]
+        roi_labels[k, num_near:] = np.random.randint(1, num_classes + 1, size=num_rois - num_near)
+
+    return {
+        'rois': torch.from_numpy(rois).to(device),
+        'roi_raw_scores': torch.randn(batch_size, num_rois, device=device),
+        'roi_labels': torch.from_numpy(roi_labels).to(device),
+        'gt_boxes': torch.from_numpy(gt_boxes).to(device)
+    }
+
+
+def expected_counts(max_overlaps, roi_sampler_cfg):
+    """
+    number of fg / hard bg / easy bg rois of a sample drawn by the per sample sampler
+    """
+    roi_per_image = roi_sampler_cfg.ROI_PER_IMAGE
+    fg_num = int((max_overlaps >= min(roi_sampler_cfg.REG_FG_THRESH, roi_sampler_cfg.CLS_FG_THRESH)).sum())
+    easy_num = int((max_overlaps < roi_sampler_cfg.CLS_BG_THRESH_LO).sum())
+    hard_num = int(((max_overlaps < roi_sampler_cfg.REG_FG_THRESH) &
+                    (max_overlaps >= roi_sampler_cfg.CLS_BG_THRESH_LO)).sum())
+    if easy_num + hard_num == 0:
+        return roi_per_image, 0, 0
+    fg_this = min(int(np.round(roi_sampler_cfg.FG_RATIO * roi_per_image)), fg_num)
+    bg_this = roi_per_image - fg_this
+    if hard_num > 0 and easy_num > 0:
+        hard_this = int(bg_this * roi_sampler_cfg.HARD_BG_RATIO)
+    else:
+        hard_this = bg_this if hard_num > 0 else 0
+    return fg_this, hard_this, bg_this - hard_this
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    cfg.CLASS_NAMES = ['Class%d' % k for k in range(args.num_classes)]
+    roi_sampler_cfg = get_roi_sampler_cfg()
+
+    batches = [random_batch(args.batch_size, args.num_rois, args.max_num_gt, args.num_classes, device)
+               for _ in range(args.repeat)]
+    proposal_target_layer.proposal_target_layer(batches[0], roi_sampler_cfg)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    outputs = [proposal_target_layer.proposal_target_layer(batch, roi_sampler_cfg) for batch in batches]
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    print('%s: %.3f ms/batch of %d, %d rois and up to %d gt boxes per sample, %d classes'
+          % (device, (time.perf_counter() - start) / args.repeat * 1000, args.batch_size, args.num_rois,
+             args.max_num_gt, args.num_classes))
+
+    num_same, fg_iou, bg_iou = 0, [], []
+    for batch, output in zip(batches, outputs):
+        max_overlaps = proposal_target_layer.get_max_iou3d_of_rois(
+            batch['rois'], batch['roi_labels'], batch['gt_boxes'])[0].cpu().numpy()
+        for k in range(args.batch_size):
+            gt_iou = output['gt_iou'][k].cpu().numpy()
+            fg_this, hard_this, easy_this = expected_counts(max_overlaps[k], roi_sampler_cfg)
+            is_fg = gt_iou >= min(roi_sampler_cfg.REG_FG_THRESH, roi_sampler_cfg.CLS_FG_THRESH)
+            is_easy = gt_iou < roi_sampler_cfg.CLS_BG_THRESH_LO
+            is_hard = (gt_iou < roi_sampler_cfg.REG_FG_THRESH) & (gt_iou >= roi_sampler_cfg.CLS_BG_THRESH_LO)
+            num_same += bool(is_fg[:fg_this].all() and is_hard[fg_this:fg_this + hard_this].all() and
+                             is_easy[fg_this + hard_this:].all() and len(gt_iou) == fg_this + hard_this + easy_this)
+            fg_iou.append(gt_iou[:fg_this])
+            bg_iou.append(gt_iou[fg_this:])
+    print('expected fg / hard bg / easy bg counts in %d / %d samples, mean iou of fg %.3f, of bg %.3f'
+          % (num_same, args.repeat * args.batch_size, np.concatenate(fg_iou).mean(), np.concatenate(bg_iou).mean()))
+
+
+if __name__ == '__main__':
+    main()
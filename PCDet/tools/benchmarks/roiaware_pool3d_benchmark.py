@@ -0,0 +1,97 @@
+import argparse
+import time
+import numpy as np
+import torch
+from pcdet.ops.roiaware_pool3d import roiaware_pool3d_torch, roiaware_pool3d_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='points-in-boxes and RoI-aware pooling, pytorch fallback vs extension')
+    parser.add_argument('--num_points', type=int, default=16384)
+    parser.add_argument('--num_rois', type=int, default=128)
+    parser.add_argument('--num_channels', type=int, default=128)
+    parser.add_argument('--out_size', type=int, default=14)
+    parser.add_argument('--max_pts_each_voxel', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def random_scene(num_points, num_rois, num_channels):
+    """
+    points scattered around the rois, so that the pooled voxels are not empty
+    """
+    rois = np.random.uniform([0, -40, -2, 1.4, 3.5, 1.4, -np.pi], [70.4, 40, -1, 1.8, 4.5, 1.7, np.pi],
+                             size=(num_rois, 7))
+    pts = rois[np.random.randint(0, num_rois, size=num_points), 0:3]
+    pts += np.random.normal(scale=[1.5, 1.5, 0.6], size=(num_points, 3))
+    pts_feature = np.random.randn(num_points, num_channels)
+    return torch.from_numpy(rois).float(), torch.from_numpy(pts).float(), torch.from_numpy(pts_feature).float()
+
+
+def time_func(func, repeat):
+    out = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat, out
+
+
+def pool_forward_backward(pool_layer, rois, pts, pts_feature, pool_method, grad_out):
+    pts_feature = pts_feature.detach().requires_grad_()
+    pooled_features = pool_layer(rois, pts, pts_feature, pool_method)
+    pooled_features.backward(grad_out)
+    return pooled_features.detach(), pts_feature.grad
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    rois, pts, pts_feature = random_scene(args.num_points, args.num_rois, args.num_channels)
+    out_size = (args.out_size, ) * 3
+    pool_layer = roiaware_pool3d_utils.RoIAwarePool3d(out_size, args.max_pts_each_voxel)
+    grad_out = torch.randn((args.num_rois, *out_size, args.num_channels))
+    use_gpu = torch.cuda.is_available() and roiaware_pool3d_utils.roiaware_pool3d_cuda is not None
+    print('%d points, %d rois, %d channels, out size %s, gpu: %s'
+          % (args.num_points, args.num_rois, args.num_channels, out_size, use_gpu))
+
+    cpu_time, cpu_idx = time_func(lambda: roiaware_pool3d_torch.points_in_boxes_cpu(pts, rois), args.repeat)
+    msg = 'points_in_boxes_cpu: torch %.3f ms, %d (point, box) pairs' % (cpu_time * 1000, cpu_idx.sum())
+    if roiaware_pool3d_utils.roiaware_pool3d_cuda is not None:
+        ext_time, ext_idx = time_func(lambda: roiaware_pool3d_utils.points_in_boxes_cpu(pts, rois), args.repeat)
+        msg += ', extension %.3f ms, %d mismatches' % (ext_time * 1000, (ext_idx != cpu_idx).sum())
+    print(msg)
+
+    cpu_time, cpu_idx = time_func(
+        lambda: roiaware_pool3d_torch.points_in_boxes_batch(pts[None], rois[None]), args.repeat
+    )
+    msg = 'points_in_boxes_gpu: torch %.3f ms (cpu)' % (cpu_time * 1000)
+    if use_gpu:
+        gpu_time, gpu_idx = time_func(
+            lambda: roiaware_pool3d_utils.points_in_boxes_gpu(pts[None].cuda(), rois[None].cuda()), args.repeat
+        )
+        msg += ', extension %.3f ms, %d mismatches' % (gpu_time * 1000, (gpu_idx.cpu() != cpu_idx).sum())
+    print(msg)
+
+    for pool_method in ['max', 'avg']:
+        cpu_time, (cpu_pooled, cpu_grad) = time_func(
+            lambda: pool_forward_backward(pool_layer, rois, pts, pts_feature, pool_method, grad_out), args.repeat
+        )
+        msg = 'roiaware_pool3d %s: torch %.3f ms (cpu, forward + backward)' % (pool_method, cpu_time * 1000)
+        if use_gpu:
+            gpu_time, (gpu_pooled, gpu_grad) = time_func(
+                lambda: pool_forward_backward(pool_layer, rois.cuda(), pts.cuda(), pts_feature.cuda(), pool_method,
+                                              grad_out.cuda()), args.repeat
+            )
+            msg += ', extension %.3f ms, max abs diff pooled %.3e grad %.3e' % (
+                gpu_time * 1000, (gpu_pooled.cpu() - cpu_pooled).abs().max(), (gpu_grad.cpu() - cpu_grad).abs().max()
+            )
+        print(msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import time
+import numpy as np
+from numba import cuda
+from pcdet.datasets.kitti.kitti_object_eval_python import eval as kitti_eval
+from pcdet.datasets.kitti.kitti_object_eval_python.rotate_iou_cpu import rotate_iou_cpu_eval
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='rotated iou of the kitti evaluation, cpu vs gpu')
+    parser.add_argument('--sizes', type=str, default='20x100,500x2000,1500x7000',
+                        help='comma separated (gt x det) sizes, the last ones match one part of calculate_iou_partly')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=666)
+    return parser.parse_args()
+
+
+def random_bev_boxes(num_boxes):
+    """
+    :return: (N, 5) [x, z, l, w, ry] in camera coords, as bev_box_overlap gets them
+    """
+    boxes = np.random.uniform([-40, 0, 3.2, 1.4, -np.pi], [40, 70, 4.6, 1.9, np.pi], size=(num_boxes, 5))
+    return boxes.astype(np.float32)
+
+
+def time_iou(func, boxes, qboxes, repeat):
+    iou = func(boxes, qboxes, -1)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        iou = func(boxes, qboxes, -1)
+    return (time.perf_counter() - start) / repeat, iou
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    use_gpu = kitti_eval.rotate_iou_gpu_eval is not None and cuda.is_available()
+    print('numba threads: %d, gpu: %s' % (kitti_eval.numba.config.NUMBA_NUM_THREADS, use_gpu))
+
+    for size in args.sizes.split(','):
+        num_gt, num_det = [int(x) for x in size.split('x')]
+        gt_boxes, dt_boxes = random_bev_boxes(num_gt), random_bev_boxes(num_det)
+        cpu_time, cpu_iou = time_iou(rotate_iou_cpu_eval, gt_boxes, dt_boxes, args.repeat)
+        msg = '%5d x %5d: cpu %.3f ms' % (num_gt, num_det, cpu_time * 1000)
+        if use_gpu:
+            gpu_time, gpu_iou = time_iou(kitti_eval.rotate_iou_gpu_eval, gt_boxes, dt_boxes, args.repeat)
+            msg += ', gpu %.3f ms, max abs diff %.3e' % (gpu_time * 1000, np.abs(cpu_iou - gpu_iou).max())
+        print(msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,8 @@ def statistics_info(ret_dict, metric, disp_dict):
             '(%d, %d) / %d' % (metric['recall_roi_%s' % str(min_thresh)], metric['recall_rcnn_%s' % str(min_thresh)], metric['gt_num'])
 
 
-def eval_one_epoch(model, dataloader, epoch_id, logger, save_to_file=False, result_dir=None, test_mode=False):
+def eval_one_epoch(model, dataloader, epoch_id, logger, save_to_file=False, result_dir=None, test_mode=False,
+                   device=None):
     result_dir.mkdir(parents=True, exist_ok=True)
 
     if save_to_file:
@@ -48,7 +49,7 @@ def eval_one_epoch(model, dataloader, epoch_id, logger, save_to_file=False, resu
     progress_bar = tqdm.tqdm(total=len(dataloader), leave=True, desc='eval', dynamic_ncols=True)
     start_time = time.time()
     for i, data in enumerate(dataloader):
-        input_dict = example_convert_to_torch(data)
+        input_dict = example_convert_to_torch(data, device=device)
         pred_dicts, ret_dict = model(input_dict)
         disp_dict = {}
 
@@ -65,7 +66,7 @@ def eval_one_epoch(model, dataloader, epoch_id, logger, save_to_file=False, resu
     sec_per_example = (time.time() - start_time) / len(dataloader.dataset)
     logger.info('Generate label finished(sec_per_example: %.4f second).' % sec_per_example)
 
-    ret_dict = {}
+    ret_dict = {'sec_per_example': sec_per_example}
     if cfg.MODEL.RCNN.ENABLED:
         gt_num_cnt = metric['gt_num']
         for cur_thresh in cfg.MODEL.TEST.RECALL_THRESH_LIST:
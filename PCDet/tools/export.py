@@ -0,0 +1,88 @@
+import argparse
+import logging
+from pathlib import Path
+import torch
+from pcdet.config import cfg, cfg_from_list, cfg_from_yaml_file
+from pcdet.datasets import build_dataloader
+from pcdet.models import build_network, example_convert_to_torch
+from pcdet.models.model_utils import export_utils
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='export the dense head of a detector to TorchScript and ONNX')
+    parser.add_argument('--cfg_file', type=str, default=None, help='specify the config of the model')
+    parser.add_argument('--ckpt', type=str, default=None, help='checkpoint to export')
+    parser.add_argument('--output_dir', type=str, default=None, help='default is output/export/<cfg tag>')
+    parser.add_argument('--formats', type=str, default='torchscript,onnx', help='comma separated export formats')
+    parser.add_argument('--opset', type=int, default=11, help='ONNX opset version')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER,
+                        help='set extra config keys if needed')
+
+    args = parser.parse_args()
+
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    cfg.TAG = Path(args.cfg_file).stem
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs, cfg)
+
+    return args, cfg
+
+
+def export_model(model, spatial_features, output_dir, formats, opset_version, logger):
+    """
+    :return: {format: filename}, each export is checked against the eager head on spatial_features
+    """
+    eager_outputs = export_utils.DenseHead(model.rpn_head)(spatial_features)
+    exported = {}
+    for export_format in formats:
+        if export_format == 'torchscript':
+            filename = export_utils.export_torchscript(model, spatial_features, str(output_dir / 'rpn_head.pt'))
+            runner = export_utils.TorchScriptDenseRunner(filename, model.rpn_head, spatial_features.device)
+        elif export_format == 'onnx':
+            filename = export_utils.export_onnx(model, spatial_features, str(output_dir / 'rpn_head.onnx'),
+                                               opset_version=opset_version)
+            runner = export_utils.OnnxDenseRunner(filename, model.rpn_head) \
+                if export_utils.onnxruntime is not None else None
+        else:
+            raise NotImplementedError(export_format)
+
+        exported[export_format] = filename
+        logger.info('%s: %s' % (export_format, filename))
+        if runner is None:
+            logger.info('onnxruntime is not installed, skip the check of %s' % filename)
+            continue
+        outputs = runner(spatial_features)
+        for key, val in zip(runner.output_names, eager_outputs):
+            logger.info('  %s %s: max abs diff to eager %.3e' % (key, tuple(val.shape), (outputs[key] - val).abs().max()))
+    return exported
+
+
+def main():
+    args, cfg = parse_config()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger()
+
+    output_dir = Path(args.output_dir) if args.output_dir is not None else cfg.ROOT_DIR / 'output' / 'export' / cfg.TAG
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # the exported graphs run on cpu, the batch size is dynamic
+    test_set, test_loader, sampler = build_dataloader(
+        cfg.DATA_CONFIG.DATA_DIR, 1, False, workers=0, logger=logger, training=False
+    )
+    model = build_network(test_set)
+    if args.ckpt is not None:
+        model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=True)
+    model.cpu()
+    model.eval()
+
+    # the spatial features of a real sample give the input shape of the dense head
+    input_dict = example_convert_to_torch(next(iter(test_loader)), device=torch.device('cpu'))
+    spatial_features = export_utils.get_dense_input(model, input_dict)
+    logger.info('dense head input %s: %s' % (export_utils.DENSE_INPUT_NAME, tuple(spatial_features.shape)))
+
+    with torch.no_grad():
+        export_model(model, spatial_features, output_dir, args.formats.split(','), args.opset, logger)
+
+
+if __name__ == '__main__':
+    main()
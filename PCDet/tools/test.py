@@ -1,4 +1,6 @@
 import os
+import copy
+import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 import time
@@ -9,9 +11,11 @@ import argparse
 from pathlib import Path
 import torch.distributed as dist
 from pcdet.datasets import build_dataloader
-from pcdet.models import build_network
+from pcdet.models import build_network, get_default_device, example_convert_to_torch
+from pcdet.models.model_utils import quantization_utils
 from pcdet.utils import common_utils
 from pcdet.config import cfg, cfg_from_list, cfg_from_yaml_file, log_config_to_file
+from pcdet.datasets.kitti.kitti_object_eval_python import eval as kitti_eval
 from eval_utils import eval_utils
 
 
@@ -38,6 +42,16 @@ def parge_config():
     parser.add_argument('--eval_all', action='store_true', default=False, help='whether to evaluate all checkpoints')
     parser.add_argument('--ckpt_dir', type=str, default=None, help='specify a ckpt directory to be evaluated if needed')
     parser.add_argument('--save_to_file', action='store_true', default=True, help='')
+    parser.add_argument('--voxel_cache_dir', type=str, default=None,
+                        help='cache the voxelized test samples in this directory to be reused by later evaluations')
+    parser.add_argument('--eval_iou_cpu', action='store_true', default=False,
+                        help='compute the rotated iou of the kitti evaluation on cpu even if CUDA is available')
+    parser.add_argument('--cpu', action='store_true', default=False, help='run the model on cpu')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of cpu threads of torch, 0 for the default')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='evaluate an int8 copy of the model on cpu after the fp32 one and report the difference')
+    parser.add_argument('--quant_calib_samples', type=int, default=32,
+                        help='number of train split samples to calibrate the static quantization of the RPN')
 
     args = parser.parse_args()
 
@@ -45,29 +59,78 @@ def parge_config():
     cfg.TAG = Path(args.cfg_file).stem
     if args.set_cfgs is not None:
         cfg_from_list(args.set_cfgs, cfg)
+    if args.voxel_cache_dir is not None:
+        cfg.DATA_CONFIG.VOXEL_CACHE_DIR = args.voxel_cache_dir
+    if args.eval_iou_cpu:
+        kitti_eval.FORCE_CPU_ROTATE_IOU = True
+    if args.quantize:
+        # the quantized kernels run on cpu only, the fp32 reference runs on the same device
+        args.cpu = True
 
     return args, cfg
 
 
 def eval_single_ckpt(model, test_loader, args, eval_output_dir, logger, epoch_id):
     # load checkpoint
-    model_path = os.path.join('../model', args.ckpt)
-    model.load_params_from_file(filename=model_path, logger=logger)
-    model.cuda()
+    model_path = args.ckpt if os.path.isfile(args.ckpt) else os.path.join('../model', args.ckpt)
+    model.load_params_from_file(filename=model_path, logger=logger, to_cpu=(args.device.type == 'cpu'))
+    model.to(args.device)
 
     # start evaluation
-    eval_utils.eval_one_epoch(
-        model, test_loader, epoch_id, logger, result_dir=eval_output_dir, save_to_file=args.save_to_file
+    ret_dict = eval_utils.eval_one_epoch(
+        model, test_loader, epoch_id, logger, result_dir=eval_output_dir, save_to_file=args.save_to_file,
+        device=args.device
+    )
+    if args.quantize:
+        eval_quantized_model(model, test_loader, args, eval_output_dir, logger, epoch_id, ret_dict)
+
+
+def get_calib_batches(dataset, num_samples, device):
+    """
+    samples evenly spread over the dataset, one per batch
+    """
+    num_samples = min(num_samples, len(dataset))
+    for idx in np.linspace(0, len(dataset) - 1, num_samples).astype(np.int64):
+        yield example_convert_to_torch(dataset.collate_batch([dataset[idx]]), device=device)
+
+
+def eval_quantized_model(model, test_loader, args, eval_output_dir, logger, epoch_id, fp32_ret_dict):
+    """
+    evaluate an int8 copy of the model, the fp32 model is kept for the next checkpoints
+    :return: ret_dict of the int8 model
+    """
+    qmodel = copy.deepcopy(model)
+    num_calib = quantization_utils.quantize_model(
+        qmodel, get_calib_batches(args.quant_calib_set, args.quant_calib_samples, args.device)
+    )
+    logger.info('int8 model (%s engine) calibrated on %d %s samples' % (
+        torch.backends.quantized.engine, num_calib, args.quant_calib_set.split))
+    int8_ret_dict = eval_utils.eval_one_epoch(
+        qmodel, test_loader, epoch_id, logger, result_dir=eval_output_dir / 'int8', save_to_file=args.save_to_file,
+        device=args.device
     )
 
+    logger.info('****************INT8 quantization report*****************')
+    logger.info('sec_per_example: fp32 %.4f, int8 %.4f, speedup %.2fx' % (
+        fp32_ret_dict['sec_per_example'], int8_ret_dict['sec_per_example'],
+        fp32_ret_dict['sec_per_example'] / int8_ret_dict['sec_per_example']
+    ))
+    for key, val in fp32_ret_dict.items():
+        if key == 'sec_per_example' or key not in int8_ret_dict:
+            continue
+        logger.info('%s: fp32 %.4f, int8 %.4f, delta %+.4f' % (key, val, int8_ret_dict[key], int8_ret_dict[key] - val))
+    return int8_ret_dict
+
 
 def get_no_evaluated_ckpt(ckpt_dir, ckpt_record_file, args):
-    ckpt_list = glob.glob(os.path.join(ckpt_dir, '*checkpoint_epoch_*.pth'))
+    # torch.save files or manifests of a CheckpointStore
+    ckpt_list = glob.glob(os.path.join(ckpt_dir, '*checkpoint_epoch_*.pth')) + \
+        glob.glob(os.path.join(ckpt_dir, '*checkpoint_epoch_*.ckpt'))
     ckpt_list.sort(key=os.path.getmtime)
     evaluated_ckpt_list = [float(x.strip()) for x in open(ckpt_record_file, 'r').readlines()]
 
     for cur_ckpt in ckpt_list:
-        num_list = re.findall('checkpoint_epoch_(.*).pth', cur_ckpt)
+        num_list = re.findall('checkpoint_epoch_(.*).(?:pth|ckpt)', cur_ckpt)
         if num_list.__len__() == 0:
             continue
 
@@ -106,17 +169,24 @@ def repeat_eval_ckpt(model, test_loader, args, eval_output_dir, logger, ckpt_dir
         total_time = 0
         first_eval = False
 
-        model.load_params_from_file(filename=cur_ckpt, logger=logger)
-        model.cuda()
+        model.load_params_from_file(filename=cur_ckpt, logger=logger, to_cpu=(args.device.type == 'cpu'))
+        model.to(args.device)
 
         # start evaluation
         cur_result_dir = eval_output_dir / ('epoch_%s' % cur_epoch_id) / cfg.MODEL.TEST.SPLIT
         tb_dict = eval_utils.eval_one_epoch(
-            model, test_loader, cur_epoch_id, logger, result_dir=cur_result_dir, save_to_file=args.save_to_file
+            model, test_loader, cur_epoch_id, logger, result_dir=cur_result_dir, save_to_file=args.save_to_file,
+            device=args.device
         )
 
         for key, val in tb_dict.items():
             tb_log.add_scalar(key, val, cur_epoch_id)
+        if args.quantize:
+            int8_tb_dict = eval_quantized_model(
+                model, test_loader, args, cur_result_dir, logger, cur_epoch_id, tb_dict
+            )
+            for key, val in int8_tb_dict.items():
+                tb_log.add_scalar('int8/' + key, val, cur_epoch_id)
 
         # record this epoch which has been evaluated
         with open(ckpt_record_file, 'a') as f:
@@ -171,7 +241,16 @@ def main():
         cfg.DATA_CONFIG.DATA_DIR, args.batch_size, dist_test, workers=args.workers, logger=logger, training=False
     )
     model = build_network(test_set)
-    with torch.no_grad():
+    if args.quantize:
+        # the quantization is calibrated on the train split, not on the test samples it is evaluated on
+        args.quant_calib_set, _, _ = build_dataloader(
+            cfg.DATA_CONFIG.DATA_DIR, 1, False, workers=0, logger=logger, training=True
+        )
+    args.device = torch.device('cpu') if args.cpu else get_default_device()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    # inference_mode skips the autograd bookkeeping of no_grad, available from torch 1.9
+    with getattr(torch, 'inference_mode', torch.no_grad)():
         if args.eval_all:
             repeat_eval_ckpt(model, test_loader, args, eval_output_dir, logger, ckpt_dir)
         else:
@@ -4,10 +4,11 @@ import torch.nn as nn
 from tensorboardX import SummaryWriter
 from pcdet.config import cfg, log_config_to_file, cfg_from_list, cfg_from_yaml_file
 from pcdet.utils import common_utils
+from pcdet.utils.checkpoint_store import load_checkpoint
 from pcdet.datasets import build_dataloader
-from pcdet.models import build_network, model_fn_decorator
+from pcdet.models import build_network, model_fn_decorator, to_channels_last
 from train_utils.optimization import build_optimizer, build_scheduler
-from train_utils.train_utils import train_model
+from train_utils.train_utils import train_model, LossScaler
 import torch.distributed as dist
 
 from pathlib import Path
@@ -38,6 +39,12 @@ def parge_config():
     parser.add_argument('--ckpt_save_interval', type=int, default=2, help='number of training epochs')
     parser.add_argument('--local_rank', type=int, default=0, help='local rank for distributed training')
     parser.add_argument('--max_ckpt_save_num', type=int, default=30, help='max number of saved checkpoint')
+    parser.add_argument('--ckpt_save_dir', type=str, default='../model',
+                        help='checkpoint store of the trained models, shared by the runs of train.py')
+    parser.add_argument('--amp', choices=['none', 'auto', 'fp16', 'bf16'], default='none',
+                        help='mixed precision training, auto is fp16 with CUDA and bf16 on cpu')
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help='channels last memory format for the 2D convolutions')
     parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER,
                         help='set extra config keys if needed')
 
@@ -103,7 +110,7 @@ def main():
     start_epoch = it = 0
     if args.pretrained_model is not None:                           # not first time
         model.load_params_from_file(filename=args.pretrained_model, to_cpu=dist, logger=logger)
-        model_dict  = torch.load(args.pretrained_model)
+        model_dict  = load_checkpoint(args.pretrained_model)
         # start_epoch = model_dict['epoch']
         it          = model_dict['accumulated_iter']
         optimizer.load_state_dict( model_dict['optimizer_state'] )
@@ -130,6 +137,14 @@ def main():
     #         )
     #         last_epoch = start_epoch + 1
 
+    if args.channels_last:
+        logger.info('channels_last: %d 2D convolutions' % to_channels_last(model))
+    if args.amp == 'auto':
+        args.amp = 'fp16' if torch.cuda.is_available() else 'bf16'
+    amp_dtype = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args.amp]
+    # the gradients of fp16 need the loss scaling, bf16 has the range of fp32
+    loss_scaler = LossScaler('cuda' if torch.cuda.is_available() else 'cpu') if args.amp == 'fp16' else None
+
     model.train()  # before wrap to DistributedDataParallel to support fixed some parameters
     if dist_train:
         model = nn.parallel.DistributedDataParallel(model, device_ids=[cfg.LOCAL_RANK % torch.cuda.device_count()])
@@ -147,7 +162,7 @@ def main():
         model,
         optimizer,
         train_loader,
-        model_func=model_fn_decorator(),
+        model_func=model_fn_decorator(amp_dtype=amp_dtype),
         lr_scheduler=lr_scheduler,
         optim_cfg=cfg.MODEL.TRAIN.OPTIMIZATION,
         start_epoch=start_epoch,
@@ -155,11 +170,12 @@ def main():
         start_iter=it,
         rank=cfg.LOCAL_RANK,
         tb_log=tb_log,
-        ckpt_save_dir=ckpt_dir,
+        ckpt_save_dir=args.ckpt_save_dir,
         train_sampler=train_sampler,
         lr_warmup_scheduler=lr_warmup_scheduler,
         ckpt_save_interval=args.ckpt_save_interval,
-        max_ckpt_save_num=args.max_ckpt_save_num
+        max_ckpt_save_num=args.max_ckpt_save_num,
+        loss_scaler=loss_scaler
     )
 
     logger.info('**********************End training**********************')
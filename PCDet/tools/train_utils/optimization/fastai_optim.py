@@ -1,6 +1,9 @@
 # This file is modified from https://github.com/traveller59/second.pytorch
 
-from collections import Iterable
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 
 import torch
 from torch import nn
@@ -1,14 +1,37 @@
 import torch
-import os
-import glob
 import tqdm
 from torch.nn.utils import clip_grad_norm_
-import random
-import pdb
-import numpy as np
+from pcdet.utils.checkpoint_store import CheckpointStore
+
+class LossScaler(object):
+    """
+    GradScaler of the fp16 training, counts the steps skipped for inf / nan gradients
+    """
+    def __init__(self, device_type='cuda'):
+        self.scaler = torch.amp.GradScaler(device_type) if hasattr(torch.amp, 'GradScaler') \
+            else torch.cuda.amp.GradScaler()
+        self.num_overflow_skips = 0
+
+    def backward_and_step(self, loss, optimizer, parameters, grad_norm_clip):
+        """
+        :param optimizer: torch optimizer or fastai_optim.OptimWrapper, its weight decay is skipped with the step
+        """
+        self.scaler.scale(loss).backward()
+        # the gradients are clipped at their true scale
+        self.scaler.unscale_(optimizer)
+        clip_grad_norm_(parameters, grad_norm_clip)
+        cur_scale = self.scaler.get_scale()
+        self.scaler.step(optimizer)
+        self.scaler.update()
+        if self.scaler.get_scale() < cur_scale:
+            self.num_overflow_skips += 1
+
+    def get_scale(self):
+        return self.scaler.get_scale()
+
 
 def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, accumulated_iter, optim_cfg,
-                    rank, tbar, tb_log=None, leave_pbar=False):
+                    rank, tbar, tb_log=None, leave_pbar=False, loss_scaler=None):
 
     dataloader_iter = iter(train_loader)
     # _tmp = 0
@@ -43,9 +66,12 @@ def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, ac
 
         loss, tb_dict, disp_dict = model_func(model, batch)
 
-        loss.backward()
-        clip_grad_norm_(model.parameters(), optim_cfg.GRAD_NORM_CLIP)
-        optimizer.step()
+        if loss_scaler is None:
+            loss.backward()
+            clip_grad_norm_(model.parameters(), optim_cfg.GRAD_NORM_CLIP)
+            optimizer.step()
+        else:
+            loss_scaler.backward_and_step(loss, optimizer, model.parameters(), optim_cfg.GRAD_NORM_CLIP)
 
         accumulated_iter += 1
         disp_dict.update({'loss': loss.item(), 'lr': cur_lr})
@@ -64,6 +90,9 @@ def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, ac
                 tb_log.add_scalar('learning_rate', cur_lr, accumulated_iter)
                 for key, val in tb_dict.items():
                     tb_log.add_scalar('train_' + key, val, accumulated_iter)
+                if loss_scaler is not None:
+                    tb_log.add_scalar('amp_loss_scale', loss_scaler.get_scale(), accumulated_iter)
+                    tb_log.add_scalar('amp_overflow_skips', loss_scaler.num_overflow_skips, accumulated_iter)
     if rank == 0:
         pbar.close()
     return accumulated_iter
@@ -71,7 +100,7 @@ def train_one_epoch(model, optimizer, train_loader, model_func, lr_scheduler, ac
 
 def train_model(model, optimizer, train_loader, model_func, lr_scheduler, optim_cfg,
                 start_epoch, total_epochs, start_iter, rank, tb_log, ckpt_save_dir, train_sampler=None,
-                lr_warmup_scheduler=None, ckpt_save_interval=1, max_ckpt_save_num=50):
+                lr_warmup_scheduler=None, ckpt_save_interval=1, max_ckpt_save_num=50, loss_scaler=None):
     
     accumulated_iter = start_iter
     with tqdm.trange(start_epoch, total_epochs, desc='epochs', dynamic_ncols=True, leave=(rank == 0)) as tbar:
@@ -90,32 +119,26 @@ def train_model(model, optimizer, train_loader, model_func, lr_scheduler, optim_
                 lr_scheduler=cur_scheduler,
                 accumulated_iter=accumulated_iter, optim_cfg=optim_cfg,
                 rank=rank, tbar=tbar, tb_log=tb_log,
-                leave_pbar=(cur_epoch + 1 == total_epochs)
+                leave_pbar=(cur_epoch + 1 == total_epochs),
+                loss_scaler=loss_scaler
             )
 
             # save trained model
             trained_epoch = cur_epoch + 1
-            if trained_epoch % (total_epochs) == 0 and rank == 0:
-                ckpt_save_dir = '../model' #FIXME: remove this
-                ckpt_list = glob.glob( os.path.join(ckpt_save_dir, 'checkpoint_epoch_*.pth') )
-                ckpt_list.sort(key=os.path.getmtime)
-
-                # if ckpt_list.__len__() >= max_ckpt_save_num:
-                #     for cur_file_idx in range(0, len(ckpt_list) - max_ckpt_save_num + 1):
-                #         os.remove(ckpt_list[cur_file_idx])
-
-                #NOTE: save model and epoch
-                # ckpt_name = ckpt_save_dir / ('checkpoint_epoch_%d' % trained_epoch)
-                ckpt_name = os.path.join(ckpt_save_dir,  ('checkpoint_epoch_%d.pth' % len(ckpt_list)))
-                torch.save({
-                    'model_state':model.state_dict(),
+            if (trained_epoch % ckpt_save_interval == 0 or trained_epoch == total_epochs) and rank == 0:
+                # the tensors unchanged since the last checkpoint are not written again
+                ckpt_store = CheckpointStore(ckpt_save_dir)
+                # numbered after the checkpoints in the store, which may come from the earlier runs of train.py
+                ckpt_ids = [int(name.split('_')[-1]) for name in ckpt_store.list()
+                            if name.startswith('checkpoint_epoch_')]
+                ckpt_id = max(ckpt_ids) + 1 if len(ckpt_ids) > 0 else 0
+                ckpt_store.save('checkpoint_epoch_%d' % ckpt_id, {
+                    'model_state': model_state_to_cpu(model.state_dict()),
                     'optimizer_state': optimizer.state_dict(),
-                    # 'epoch': start_epoch + total_epochs,
+                    'epoch': trained_epoch,
                     'accumulated_iter': accumulated_iter
-                    }, ckpt_name)
-                # save_checkpoint(
-                #     checkpoint_state(model, optimizer, trained_epoch, accumulated_iter), filename=ckpt_name,
-                # )
+                }, step=ckpt_id)
+                ckpt_store.apply_retention(keep_last=max_ckpt_save_num)
 
 
 def model_state_to_cpu(model_state):
@@ -577,6 +577,8 @@ def dbscan(data,vis=None,geometry_list=None,frame_id=None,map_file=None,times=1,
             else:
                 pass
                 # print(fusion_item[-2])
+        if vis is None:
+            continue
         if not os.path.exists(map_file):
             os.makedirs(map_file)
         fusion_path = map_file+'/'+frame_id[:-4] +'-'+ str(index)+'.png'
@@ -597,6 +599,176 @@ def _read_imageset_file(path):
         lines = f.readlines()
     return [int(line) for line in lines]
 
+def get_ego_label_list(test_path, test_id, frame_id, frame_label, global_vehicle_list, geometry_list):
+    """
+    project the fused global labels into the camera of an ego vehicle
+    :return: KITTI label rows of the fused labels seen by the vehicle, a DontCare row if none
+    """
+    ego_calib_file = test_path + '/calib00/' + frame_id
+    calib = Calibration(ego_calib_file)
+    ego_pointcloud_file = test_path + '/velodyne/' + frame_id[:-3] + 'bin'
+    ego_point_cloud = np.fromfile(
+        ego_pointcloud_file, dtype=np.dtype('f4'), count=-1).reshape([-1, 4])
+    ego_location, ego_rotation,ego_extend = get_ego_location(
+        test_id[-3:], frame_label)
+    tmp_point_cloud = get_global_pcd(ego_point_cloud, color=[0.9,0.9,0.9], sensor_center=ego_location,sensor_rotation=ego_rotation,location=ego_location,calib=calib)
+    # tmp_point_cloud = get_pcd(ego_point_cloud,sensor_center=ego_location,sensor_rotation=ego_rotation)
+    geometry_list += tmp_point_cloud
+    sensor_world_matrix = get_matrix(ego_location,ego_rotation)
+    world_sensor_matrix = np.linalg.inv(sensor_world_matrix)
+
+    label_list = []
+    for other_vehicle in global_vehicle_list:
+        number = other_vehicle[-1].copy()
+        # print(number,'-------------')
+        other_vehicle = other_vehicle[:-1]
+        tmp_pcd = tmp_point_cloud.copy()
+        R = o3d.geometry.OrientedBoundingBox.get_rotation_matrix_from_xyz([0,0,other_vehicle[6]])
+        bbox = o3d.geometry.OrientedBoundingBox(other_vehicle[:3],R,other_vehicle[3:6]+0.2)
+        tmp_points = tmp_pcd[0].crop(bbox)
+        # print(len(tmp_points.points))
+        points = np.array(bbox.get_box_points())
+        points = np.concatenate((points,np.ones((8,1))),axis=1)
+
+        points = np.dot(world_sensor_matrix, points.T).T[:,:3]
+        points = np.asarray(points).reshape(8,3)
+
+        img_points,img_depths = calib.lidar_to_img(points)
+        other_vehicle_location = np.array(other_vehicle[:3])
+        other_vehicle_location = np.append(other_vehicle_location, 1).reshape(4, 1)
+        other_location = np.dot(world_sensor_matrix, other_vehicle_location).flatten().tolist()[0][:3]
+        # print('nb',other_location)
+        # other_location = np.array(other_vehicle_location) - np.array(ego_location)
+        other_location[2] -= other_vehicle[5]/2
+        if all(img_depths > 0) and len(tmp_points.points) > 5:
+            x_min,y_min = np.min(img_points,axis=0)
+            x_max,y_max = np.max(img_points,axis=0)
+            if x_max < 0 or y_max < 0 or x_min > 1242 or y_min > 375 or x_max-x_min > 1242 or y_max-y_min > 375:
+                continue
+            if x_min < 0:
+                x_min = 0
+            if x_max > 1242:
+                x_max = 1242
+            if y_min < 0:
+                y_min = 0
+            if y_max > 375:
+                y_max =375
+            coordinate_camera = calib.lidar_to_rect(np.array(other_location).reshape(1,3)).flatten()
+            delta =  - other_vehicle[6] + ego_rotation[2] - np.pi/2
+            delta = process_theta(delta)
+            alpha = - delta - math.atan(other_location[0]/other_location[2]) - np.pi
+            alpha = process_theta(alpha)
+
+            if len(tmp_points.points) > 5:
+                size = 0
+                if len(tmp_points.points) + other_location[0] < 250:
+                    size = 1
+                if len(tmp_points.points) + other_location[0] < 125:
+                    size = 2
+            label_list.append(['Car',
+                                    str(int(number)),str(size),str(alpha),x_min,y_min,x_max,y_max,
+                                    str(other_vehicle[5]), str(other_vehicle[4]), str(other_vehicle[3]),
+                                    str(coordinate_camera[0]), str(coordinate_camera[1]), str(coordinate_camera[2]),
+                                    str(delta),str(other_vehicle[-1])])
+    if len(label_list) == 0:
+        label_list.append(['DontCare','-1','-1','-10','522.25','202.35','547.77','219.71','-1','-1','-1','-1000','-1000','-1000','-10','-10'])
+    return label_list
+
+
+def fuse_frame(root_path, test_list, frame_id, task, fusion_task='dynamic', vis=None, ego_detections=None):
+    """
+    fuse the detections of the ego vehicles of a frame
+    :param frame_id: label file of the frame, e.g. 008058.txt
+    :param task: folder of the detections in each vehicle dir (pretrain, federated, distill)
+    :param vis: open3d Visualizer to draw the fusion map, None to not draw it
+    :param ego_detections: {vehicle dir: KITTI label rows with score} of the frame instead of the files of task
+    :return: fused global labels, {vehicle dir: KITTI label rows of the fused labels seen by the vehicle} and the
+             indices in test_list of the vehicles with a detection far from its fused label
+    """
+    test_list_path = root_path
+    geometry_list = []
+
+    #global label
+    frame_global_label_path = root_path + '/global_label/' + frame_id
+    frame_label = np.loadtxt(
+        frame_global_label_path, dtype='str', delimiter=' ')
+
+    cluster_data = []
+    for index,test_id in enumerate(test_list):
+        test_path = test_list_path + '/' + test_id
+        ego_calib_file, ego_label_file, ego_data_file, ego_pointcloud_file = get_ego_file(
+            test_path, frame_id, task)
+        calib = Calibration(ego_calib_file)
+        ego_location, ego_rotation, ego_vehicle = get_ego_location(
+            test_id[-3:], frame_label)
+        ego_data = get_ego_data(ego_data_file) if ego_detections is None else ego_detections.get(test_id, [])
+        ego_bboxes,ego_cluster_data = get_ego_bboxes(ego_data, ego_location, ego_rotation, calib, color=color[index], ego_vehicle_data=ego_vehicle,index=index)
+        cluster_data += ego_cluster_data
+        if vis is not None:
+            ego_gt_bboxes,__ = get_ego_bboxes(get_ego_data(ego_label_file), ego_location, ego_rotation, calib)
+            geometry_list += ego_gt_bboxes #+ ego_bboxes
+    fusion_path = test_list_path+'/'+fusion_task+'/'+task +'_fusion_map' #(debug) <task>_fusion_map
+    fusion_list,global_vehicle_list,distill_flag = dbscan(cluster_data,vis,geometry_list,frame_id,fusion_path,fusion_task=fusion_task)
+    geometry_list += fusion_list
+
+    ego_labels = {}
+    for index,test_id in enumerate(test_list):
+        test_path = test_list_path + '/' + test_id
+        ego_labels[test_id] = get_ego_label_list(test_path, test_id, frame_id, frame_label, global_vehicle_list, geometry_list)
+    return global_vehicle_list, ego_labels, distill_flag
+
+
+def run_fusion(root_path, frame_id_list, task, fusion_task='dynamic', vis=None, label_sink=None, detections=None, min_frame=None):
+    """
+    fuse the frames of a recording, the labels are written to <root_path>/<fusion_task>/<task>_fusion/<vehicle>/ or
+    given to label_sink
+    :param frame_id_list: frames without extension, e.g. 008058
+    :param label_sink: label_sink(vehicle dir, frame id, KITTI label rows) instead of the label files, e.g. the label
+                       overlay of the dataset of the vehicle
+    :param detections: {vehicle dir: {frame id: KITTI label rows with score}} instead of the files of task
+    :param min_frame: skip the frames before
+    :return: {vehicle dir: frame ids to distill}
+    """
+    test_list_path = root_path
+    test_list = [v for v in os.listdir(test_list_path) if 'vehicle' in v]
+    print('vehicle numbers:',len(test_list))
+    print('frame_id_list numbers:',len(frame_id_list))
+    distill_id = {}
+    for test in test_list:
+        distill_id[test] = []
+    for frame_id in frame_id_list:
+        frame_id = frame_id + '.txt'
+        if min_frame is not None and not int(frame_id[:-4]) >= min_frame:
+            continue
+        ego_detections = None
+        if detections is not None:
+            ego_detections = {test_id: detections.get(test_id, {}).get(frame_id[:-4], []) for test_id in test_list}
+        global_vehicle_list,ego_labels,distill_flag = fuse_frame(root_path, test_list, frame_id, task, fusion_task, vis, ego_detections)
+
+        if label_sink is not None:
+            for test_id,label_list in ego_labels.items():
+                label_sink(test_id, frame_id[:-4], label_list)
+        else:
+            fusion_global_path = test_list_path+'/'+fusion_task+'/'+task +'_fusion/global/' #(label) <task>_fusion/global
+            if not os.path.exists(fusion_global_path):
+                os.makedirs(fusion_global_path)
+            np.savetxt(fusion_global_path + frame_id, np.array(global_vehicle_list)[:,:], fmt='%s', delimiter=' ')
+            for test_id,label_list in ego_labels.items():
+                ego_fusion_path = test_list_path + '/'+fusion_task+'/'+ task + '_fusion/' + test_id
+                if not os.path.exists(ego_fusion_path):
+                    os.makedirs(ego_fusion_path)
+                np.savetxt(ego_fusion_path + '/' + frame_id, np.array(label_list), fmt='%s', delimiter=' ')
+            print(frame_id, 'fused')
+        distill_flag = [test_list[t] for t in list(map(int,set(distill_flag)))]
+        for tmp in distill_flag:
+            distill_id[tmp].append(frame_id[:-4])
+    if label_sink is None:
+        for tmp,value in distill_id.items():
+            tmp_path = test_list_path + '/'+fusion_task+'/'+ task + '_fusion/' + tmp
+            np.savetxt(tmp_path + '_distill_list.txt', np.array(value), fmt='%s', delimiter=' ')
+    return distill_id
+
+
 if __name__ == "__main__":
     visualization_o3d = True
     one_frame = False
@@ -605,6 +777,7 @@ if __name__ == "__main__":
         tmp_frame_id = '8202'
         tmp_vehicle_id = '590'
 
+    vis = None
     if visualization_o3d:
         vis = o3d.visualization.Visualizer()
         vis.create_window(width=960*2, height=640*2)
@@ -612,7 +785,7 @@ if __name__ == "__main__":
         vis.get_render_option().show_coordinate_frame = False
         vis.get_render_option().point_size = 1
         mesh = o3d.geometry.TriangleMesh.create_coordinate_frame(size=10)
-    
+
     root_path = sys.argv[1] #dataset path
     if len(sys.argv)==4:
         img_list = sys.argv[2] #dataset list path 'txt'
@@ -620,199 +793,15 @@ if __name__ == "__main__":
     else:
         img_list = None
     test_list_path = root_path
-    test_list = [v for v in os.listdir(test_list_path) if 'vehicle' in v]
-    print('vehicle numbers:',len(test_list))
     global_gt_path = root_path + '/global_label'
-    frame_id_list = os.listdir(global_gt_path)
+    frame_id_list = [v[:-4] for v in os.listdir(global_gt_path)]
     if img_list is not None:
         img_list_file = root_path + '/' + img_list + '.txt'
         frame_id_list = np.loadtxt(img_list_file, dtype='str', delimiter=' ')
     frame_id_list.sort()
-    print('frame_id_list numbers:',len(frame_id_list))
-    distill_id = {}
-    for test in test_list:
-        distill_id[test] = []
-    for frame_id in frame_id_list:
-        frame_id = frame_id + '.txt'
-        # if '7986' not in frame_id:
-        #     continue
-        print(int(frame_id[:-4]))
-        if not int(frame_id[:-4]) >= 8058:
-            continue
-        if one_frame:
-            if tmp_frame_id not in frame_id:
-                continue
-            else:
-                tmp_frame_id = frame_id
-        else:
-            pass
-        if visualization_o3d:
-            geometry_list = []
-
-        #global label
-        frame_global_label_path = global_gt_path + '/' + frame_id
-        frame_label = np.loadtxt(
-            frame_global_label_path, dtype='str', delimiter=' ')
-        global_bboxes = get_global_bboxes(frame_label)
-        # geometry_list += global_bboxes
-
-        cluster_data = []
-        for index,test_id in enumerate(test_list):
-            # if one_frame:
-            #     if tmp_vehicle_id not in test_id:
-            #         continue
-            #     else:
-            #         tmp_vehicle_id = test_id
-            # else:
-            #     pass
-            test_path = test_list_path + '/' + test_id
-            ego_calib_file, ego_label_file, ego_data_file, ego_pointcloud_file = get_ego_file(
-                test_path, frame_id, task)
-            calib = Calibration(ego_calib_file)
-            ego_location, ego_rotation, ego_vehicle = get_ego_location(
-                test_id[-3:], frame_label)
-            ego_bboxes,ego_cluster_data = get_ego_bboxes(get_ego_data(ego_data_file), ego_location, ego_rotation, calib, color=color[index], ego_vehicle_data=ego_vehicle,index=index)
-            ego_gt_bboxes,__ = get_ego_bboxes(get_ego_data(ego_label_file), ego_location, ego_rotation, calib)
-            cluster_data += ego_cluster_data
-            if visualization_o3d:
-                geometry_list += ego_gt_bboxes #+ ego_bboxes
-        fusion_path = test_list_path+'/'+fusion_task+'/'+task +'_fusion_map' #(debug) <task>_fusion_map
-        fusion_global_path = test_list_path+'/'+fusion_task+'/'+task +'_fusion/global/' #(label) <task>_fusion/global
-        print(fusion_global_path)
-
-        
-        if not os.path.exists(fusion_global_path):
-            os.makedirs(fusion_global_path)
-        fusion_list,global_vehicle_list,distill_flag = dbscan(cluster_data,vis,geometry_list,frame_id,fusion_path,fusion_task=fusion_task)
-        # def process_global(labels):
-        #     global_labels = []
-        #     for label in labels:
-        #         global_labels.append(['Car','0','0',str(alpha),x_min,y_min,x_max,y_max,
-        #                                             str(other_vehicle[5]), str(other_vehicle[4]), str(other_vehicle[3]),
-        #                                             str(coordinate_camera[0]), str(coordinate_camera[1]), str(coordinate_camera[2]), 
-        #                                             str(delta),str(other_vehicle[-1])])
-        # global_label = process_global(global_vehicle_list)
-        np.savetxt(fusion_global_path + frame_id, np.array(global_vehicle_list)[:,:], fmt='%s', delimiter=' ')
-        print(np.array(global_vehicle_list)[:,-1])
-        if visualization_o3d:
-            geometry_list += fusion_list
-
-        for index,test_id in enumerate(test_list):
-            if one_frame:
-                if tmp_vehicle_id not in test_id:
-                    continue
-                else:
-                    tmp_vehicle_id = test_id
-            else:
-                pass
-            test_path = test_list_path + '/' + test_id
-            ego_fusion_path = test_list_path + '/'+fusion_task+'/'+ task + '_fusion/' + test_id 
-            if not os.path.exists(ego_fusion_path):
-                os.makedirs(ego_fusion_path)
-            ego_calib_file = test_path + '/calib00/' + frame_id
-            calib = Calibration(ego_calib_file)
-            ego_pointcloud_file = test_path + '/velodyne/' + frame_id[:-3] + 'bin'
-            ego_point_cloud = np.fromfile(
-                ego_pointcloud_file, dtype=np.dtype('f4'), count=-1).reshape([-1, 4])
-            ego_location, ego_rotation,ego_extend = get_ego_location(
-                test_id[-3:], frame_label)
-            tmp_point_cloud = get_global_pcd(ego_point_cloud, color=[0.9,0.9,0.9], sensor_center=ego_location,sensor_rotation=ego_rotation,location=ego_location,calib=calib)
-            # tmp_point_cloud = get_pcd(ego_point_cloud,sensor_center=ego_location,sensor_rotation=ego_rotation)
-            geometry_list += tmp_point_cloud
-            sensor_world_matrix = get_matrix(ego_location,ego_rotation)
-            world_sensor_matrix = np.linalg.inv(sensor_world_matrix)
-
-            label_list = []
-            for other_vehicle in global_vehicle_list:
-                number = other_vehicle[-1].copy()
-                # print(number,'-------------')
-                other_vehicle = other_vehicle[:-1]
-                tmp_pcd = tmp_point_cloud.copy()
-                R = o3d.geometry.OrientedBoundingBox.get_rotation_matrix_from_xyz([0,0,other_vehicle[6]])
-                bbox = o3d.geometry.OrientedBoundingBox(other_vehicle[:3],R,other_vehicle[3:6]+0.2)
-                tmp_points = tmp_pcd[0].crop(bbox)
-                # print(len(tmp_points.points))
-                points = np.array(bbox.get_box_points())
-                points = np.concatenate((points,np.ones((8,1))),axis=1)
-
-                points = np.dot(world_sensor_matrix, points.T).T[:,:3]
-                points = np.asarray(points).reshape(8,3)
-
-                img_points,img_depths = calib.lidar_to_img(points)
-                other_vehicle_location = np.array(other_vehicle[:3])
-                other_vehicle_location = np.append(other_vehicle_location, 1).reshape(4, 1)
-                other_location = np.dot(world_sensor_matrix, other_vehicle_location).flatten().tolist()[0][:3]
-                # print('nb',other_location)
-                # other_location = np.array(other_vehicle_location) - np.array(ego_location)
-                other_location[2] -= other_vehicle[5]/2
-                if all(img_depths > 0) and len(tmp_points.points) > 5:
-                    x_min,y_min = np.min(img_points,axis=0)
-                    x_max,y_max = np.max(img_points,axis=0)
-                    if x_max < 0 or y_max < 0 or x_min > 1242 or y_min > 375 or x_max-x_min > 1242 or y_max-y_min > 375:
-                        continue
-                    if x_min < 0:
-                        x_min = 0
-                    if x_max > 1242:
-                        x_max = 1242
-                    if y_min < 0:
-                        y_min = 0
-                    if y_max > 375:
-                        y_max =375
-                    coordinate_camera = calib.lidar_to_rect(np.array(other_location).reshape(1,3)).flatten()
-                    delta =  - other_vehicle[6] + ego_rotation[2] - np.pi/2
-                    delta = process_theta(delta)
-                    alpha = - delta - math.atan(other_location[0]/other_location[2]) - np.pi
-                    alpha = process_theta(alpha)
-
-                    if len(tmp_points.points) > 5:
-                        size = 0
-                        if len(tmp_points.points) + other_location[0] < 250:
-                            size = 1
-                        if len(tmp_points.points) + other_location[0] < 125:
-                            size = 2
-                    label_list.append(['Car',
-                                            str(int(number)),str(size),str(alpha),x_min,y_min,x_max,y_max,
-                                            str(other_vehicle[5]), str(other_vehicle[4]), str(other_vehicle[3]),
-                                            str(coordinate_camera[0]), str(coordinate_camera[1]), str(coordinate_camera[2]), 
-                                            str(delta),str(other_vehicle[-1])])
-            if len(label_list) == 0:
-                label_list.append(['DontCare','-1','-1','-10','522.25','202.35','547.77','219.71','-1','-1','-1','-1000','-1000','-1000','-10','-10'])
-            np.savetxt(ego_fusion_path + '/' + frame_id, np.array(label_list), fmt='%s', delimiter=' ')
-            # custom_draw_geometry(vis, geometry_list,param='test_fusion.json')
-            print(ego_fusion_path)
-        distill_flag = [test_list[t] for t in list(map(int,set(distill_flag)))]
-        for tmp in distill_flag:
-            distill_id[tmp].append(frame_id[:-4])
-        # if one_frame and visualization_o3d:
-        #     custom_draw_geometry(vis, geometry_list)
-    for tmp,value in distill_id.items():
-        tmp_path = test_list_path + '/'+fusion_task+'/'+ task + '_fusion/' + tmp
-        np.savetxt(tmp_path + '_distill_list.txt', np.array(value), fmt='%s', delimiter=' ')
-    exit()
-    #evalutae 
     if one_frame:
-        print(tmp_vehicle_id,tmp_frame_id)
-        test_path = test_list_path + '/' + tmp_vehicle_id
-        dt_annos_path = test_path + '/fed_fusion/' + tmp_frame_id
-        gt_annos_path = test_path + '/label00/' + tmp_frame_id
-        dt_annos = [kitti.get_label_anno(dt_annos_path)]
-        gt_annos = [kitti.get_label_anno(gt_annos_path)]
-        print(len(dt_annos))
-        # test = get_official_eval_result(gt_annos, dt_annos, 0) # 6s in my computer
-        # for t in test:
-        #     print(t)
-
-    else:
-        dt_annos = []
-        gt_annos = []
-        for test_id in test_list:
-            test_path = test_list_path + '/' + test_id
-            dt_annos += kitti.get_label_annos(test_path+'/'+'label_2')
-            gt_annos += kitti.get_label_annos(test_path+'/'+'label_2')
-        test = get_official_eval_result(gt_annos, dt_annos, 0) # 6s in my computer
-        for t in test:
-            print(t)
-
+        frame_id_list = [v for v in frame_id_list if tmp_frame_id in v][:1]
+    run_fusion(root_path, frame_id_list, task, fusion_task, vis, min_frame=8058)
     exit()
     # visualization_global = False
     # if visualization_global: